@@ -1,3 +1,5 @@
+from functools import cache
+from typing import Literal, cast
 from pydantic_settings import BaseSettings
 
 
@@ -22,6 +24,69 @@ class Settings(BaseSettings):
     proxmox_vm_config_dir: str
     allowed_csv_fields: list[str]
     default_user_passwd_length: int = 8
+    database_url: str = "sqlite:///database.db"
+    database_pool_size: int = 5
+    database_max_overflow: int = 10
+    database_pool_timeout: float = 30
+    database_pool_recycle: int = 1800
+    database_pool_pre_ping: bool = True
+    ldap_cache_ttl: int = 60
+    ldap_cache_size: int = 1024
+    ldap_page_size: int = 500
+    ldap_timeout: float = 10
+    lease_seconds: int = 180
+    job_max_attempts: int = 3
+    worker_poll_interval: float = 2
+    expiry_interval: float = 60
+    provision_retries: int = 4
+    provision_retry_delay: float = 0.5
+    provision_retry_max_delay: float = 8
+    reconcile_interval: float = 900
+    reconcile_repair: bool = False
+    reconcile_delete_orphan_vms: bool = False
+    reconcile_grace_period: int = 600
+    reconcile_workers: int = 8
+    reconcile_max_missing_fraction: float = 0.1
+    cohort_workers: int = 16
+    vm_status_cache_ttl: float = 10
+    idle_action: Literal["none", "suspend", "shutdown"] = "none"
+    idle_interval: float = 300
+    idle_timeout: int = 1800
+    idle_cpu_threshold: float = 0.05
+    idle_net_threshold: int = 2048
+    preboot_wave_size: int = 10
+    preboot_wave_interval: float = 60
+    preboot_margin: int = 300
+    preboot_task_timeout: float = 120
+    vm_stop_timeout: float = 60
+    trace_exporter: Literal["file", "console", "none"] = "file"
+    trace_file: str = "traces.jsonl"
+    journal_file: str = "journal.jsonl"
+    journal_max_bytes: int = 10_000_000
+    journal_backups: int = 5
+    expiry_warning: int = 900
+    event_retention: int = 86400
+    event_poll_interval: float = 1
+    event_keepalive: float = 15
+    event_gap_timeout: float = 10
 
 
-settings = Settings()
+@cache
+def get_settings() -> Settings:
+    return Settings()
+
+
+class _LazySettings:
+    """
+    Reads and validates the environment on first attribute access instead of at import,
+    so that importing the app (tests, tools, worker boot) does not require every setting.
+    """
+
+    def __getattr__(self, name: str):
+        return getattr(get_settings(), name)
+
+    def __setattr__(self, name: str, value):
+        setattr(get_settings(), name, value)
+
+
+settings = cast(Settings, _LazySettings())
@@ -1,7 +1,51 @@
+from functools import cache
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
 from sqlmodel import Session, create_engine
+from app.config import settings
+
+
+def _engine_options(backend: str) -> dict:
+    if backend == "sqlite":
+        # Requests, background jobs and the expiry sweep use the file from different threads
+        return {"connect_args": {"check_same_thread": False}}
+    options = {
+        "pool_size": settings.database_pool_size,
+        "max_overflow": settings.database_max_overflow,
+        "pool_timeout": settings.database_pool_timeout,
+        "pool_recycle": settings.database_pool_recycle,
+        "pool_pre_ping": settings.database_pool_pre_ping,
+    }
+    if backend == "postgresql":
+        # Datetimes are stored without a time zone, always in UTC whatever the server's zone is
+        options["connect_args"] = {"options": "-c timezone=utc"}
+    return options
+
+
+# Created on first use so that importing the app does not open the database
+@cache
+def get_engine():
+    url = make_url(settings.database_url)
+    engine = create_engine(url, **_engine_options(url.get_backend_name()))
+    if url.get_backend_name() == "sqlite":
+
+        @event.listens_for(engine, "connect")
+        def _configure_sqlite(dbapi_connection, connection_record):
+            # WAL lets readers run alongside the single writer, and writers wait for the
+            # lock instead of failing when several worker processes share the file
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute(f"PRAGMA busy_timeout={int(settings.database_pool_timeout * 1000)}")
+            cursor.close()
+
+    return engine
 
-engine = create_engine("sqlite:///database.db")
 
 def get_session():
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         yield session
+
+
+def ping_database():
+    with get_engine().connect() as conn:
+        conn.execute(text("SELECT 1"))
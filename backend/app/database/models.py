@@ -1,7 +1,8 @@
 from typing import Optional
 import datetime
+from sqlalchemy import JSON, Column, inspect, text
 from sqlmodel import Field, SQLModel
-from app.database.main import engine
+from app.database.main import get_engine
 
 
 class DBVirtualMachine(SQLModel, table=True):
@@ -11,11 +12,105 @@ class DBVirtualMachine(SQLModel, table=True):
     core_count: int
     memory: int
     port: int
-    owner: str
+    owner: str = Field(index=True)
+    node: Optional[str] = Field(default=None, index=True)
+    job_id: Optional[str] = Field(default=None, index=True)  # Set for VMs created through a bulk (CSV) job
+    prefix: Optional[str] = Field(default=None, index=True)  # Home directory prefix of the bulk job users, eg: /home
     created_at: datetime.datetime = Field(
         default_factory=datetime.datetime.utcnow,
     )
-    expiry: datetime.datetime = Field()
+    expiry: datetime.datetime = Field(index=True)
+    last_active_at: Optional[datetime.datetime] = None  # Last time it was seen in use, see check_idle()
+    warned_at: Optional[datetime.datetime] = None  # When the vm_expiring event was sent, see warn_expiring()
 
 
-SQLModel.metadata.create_all(engine)
+class DBRevision(SQLModel, table=True):
+    """
+    Change counter per VM owner, bumped on every write to that owner's VMs.
+    Used to answer conditional GETs without querying the VM table.
+    """
+    owner: str = Field(primary_key=True)
+    revision: int = 0
+
+
+class DBLease(SQLModel, table=True):
+    """
+    A named lease held by one worker process until expires_at, used to elect the single
+    worker that runs a periodic task such as the expiry sweep.
+    """
+    name: str = Field(primary_key=True)
+    holder: str
+    expires_at: datetime.datetime
+    last_run_at: Optional[datetime.datetime] = None  # Start of the last run of the task, by any worker
+
+
+class DBJob(SQLModel, table=True):
+    """
+    Background job queue shared by all worker processes.
+    A job is claimed by one worker at a time. If that worker dies, its claim runs out at
+    locked_until and another worker picks the job up again.
+    """
+    id: str = Field(primary_key=True)
+    kind: str
+    status: str = Field(default="queued", index=True)  # queued, running, done or failed
+    payload: Optional[dict] = Field(default=None, sa_column=Column(JSON))
+    result: Optional[dict] = Field(default=None, sa_column=Column(JSON))
+    error: Optional[str] = None
+    attempts: int = 0
+    locked_by: Optional[str] = None
+    locked_until: Optional[datetime.datetime] = None
+    run_after: Optional[datetime.datetime] = Field(default=None, index=True)  # Not claimed before then
+    created_at: datetime.datetime = Field(
+        default_factory=lambda: datetime.datetime.now(datetime.UTC),
+    )
+    finished_at: Optional[datetime.datetime] = None
+
+
+class DBEvent(SQLModel, table=True):
+    """
+    Provisioning and expiry events, streamed to clients by GET /events.
+    The id orders events across all worker processes and doubles as the SSE event id.
+    """
+    __table_args__ = {"sqlite_autoincrement": True}  # Ids are never reused once older events are pruned
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    type: str
+    owner: str = Field(index=True)  # User the event is about, or the API admin for job events
+    job_id: Optional[str] = Field(default=None, index=True)
+    vm_id: Optional[int] = Field(default=None, index=True)  # DBVirtualMachine.id
+    data: Optional[dict] = Field(default=None, sa_column=Column(JSON))
+    created_at: datetime.datetime = Field(
+        default_factory=lambda: datetime.datetime.now(datetime.UTC), index=True
+    )
+
+
+def add_missing_columns():
+    """
+    create_all() only creates missing tables, it never alters existing ones.
+    Add any column and index introduced after the table was first created, so that
+    an existing database.db keeps working without a manual migration.
+    """
+    engine = get_engine()
+    inspector = inspect(engine)
+    for table in SQLModel.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        with engine.begin() as conn:
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(
+                    text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+                )
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
+def init_db():
+    """
+    Creates missing tables, columns and indexes. Safe to call more than once.
+    """
+    SQLModel.metadata.create_all(get_engine())
+    add_missing_columns()
@@ -1,13 +1,80 @@
 # LDAP use bytes for data in and out, instead of regular strings.
 # Almost all of the data that goes into and out of LDAP needs to encoded using str.encode()
 # or use byte strings like: b"steve" and decoded using bytes.decode('utf-8')
+import threading
+from functools import cache
 import ldap
+import ldap.filter
 import ldap.modlist
+from ldap.controls import SimplePagedResultsControl
 from app.models.vms import VirtualMachine
 from app.config import settings
+from app.utils.cache import TTLCache
+from app.utils.metrics import instrument, BACKEND_CALL_SECONDS
 
 
-conn = ldap.initialize(uri=settings.ldap_url)
+_local = threading.local()
+_generation = 0
+_generation_lock = threading.Lock()
+
+
+def _open_conn():
+    """
+    Opens a new, unbound connection to the LDAP server.
+    """
+    conn = ldap.initialize(uri=settings.ldap_url)
+    conn.set_option(ldap.OPT_NETWORK_TIMEOUT, settings.ldap_timeout)
+    return conn
+
+
+def get_conn():
+    """
+    Returns the calling thread's connection, bound as the LDAP admin, opening it on first use so
+    that importing this module does not touch the directory server.
+    Each thread gets its own connection: a bind changes the identity of every operation sent on a
+    connection, so a shared one lets a user login run in between an admin bind and the write it is for.
+    The connection is closed when its thread ends.
+    """
+    if getattr(_local, "generation", None) != _generation:
+        conn = _open_conn()
+        conn.bind_s(admin_dn_builder(settings.ldap_admin_user), settings.ldap_admin_pass)
+        _local.conn, _local.generation = conn, _generation
+    return _local.conn
+
+
+def reset_conn():
+    """
+    Drops the connections after the server went away, every thread opens a new one on its next call.
+    """
+    global _generation
+    with _generation_lock:
+        _generation += 1
+
+
+# Lookups are cached for ldap_cache_ttl seconds and invalidated by the writes done through this module.
+# Changes made directly on the LDAP server show up once the entry expires.
+@cache
+def user_cache() -> TTLCache:
+    return TTLCache(maxsize=settings.ldap_cache_size, ttl=settings.ldap_cache_ttl)
+
+
+@cache
+def vms_cache() -> TTLCache:
+    return TTLCache(maxsize=settings.ldap_cache_size, ttl=settings.ldap_cache_ttl)
+
+
+# Only these attributes are fetched for user lookups. Notably leaves out userPassword.
+USER_ATTRIBUTES = [
+    "uid",
+    "cn",
+    "givenName",
+    "sn",
+    "uidNumber",
+    "gidNumber",
+    "homeDirectory",
+    "loginShell",
+]
+VM_ATTRIBUTES = ["cn", "guacConfigParameter"]
 
 
 def user_dn_builder(username: str) -> str:
@@ -22,17 +89,30 @@ def vm_dn_builder(vmid: str) -> str:
     return f"cn={vmid},ou=Groups,{settings.ldap_dn}"
 
 
+@instrument("ldap")
 def verify_password(username: str, password: str) -> bool:
+    # Bound on a connection of its own, the admin connections must stay bound as admin
+    conn = _open_conn()
     try:
         conn.bind_s(admin_dn_builder(username), password)
     except ldap.INVALID_CREDENTIALS:
         return False
+    finally:
+        conn.unbind_s()
     return True
 
 
 def get_user(username: str):
-    result = conn.search_s(
-        settings.ldap_dn, ldap.SCOPE_SUBTREE, filterstr=f"uid={username}"
+    return user_cache().get_or_load(username, lambda: _search_user(username))
+
+
+@instrument("ldap", "get_user")
+def _search_user(username: str):
+    result = get_conn().search_s(
+        settings.ldap_dn,
+        ldap.SCOPE_SUBTREE,
+        filterstr=f"uid={ldap.filter.escape_filter_chars(username)}",
+        attrlist=USER_ATTRIBUTES,
     )
     # LDAP returns enties in bytes, decode to get usable data
     return (
@@ -42,21 +122,57 @@ def get_user(username: str):
     )
 
 
-def get_all_users():
+def ping_ldap():
+    get_conn().whoami_s()
+
+
+def cache_stats() -> dict:
+    return {"users": user_cache().stats(), "vms": vms_cache().stats()}
+
+
+def paged_search(
+    base: str,
+    filterstr: str = "(objectClass=*)",
+    attrlist: list[str] | None = None,
+    page_size: int | None = None,
+):
+    """
+    Subtree search using the Simple Paged Results control (RFC 2696).
+    Yields (dn, attributes) tuples one page at a time, so large trees neither hit the
+    server's size limit nor get loaded into memory at once.
+    Pass attrlist to fetch only the attributes you need, None fetches all of them.
     """
-    Sample search result:
+    control = SimplePagedResultsControl(
+        True, size=page_size or settings.ldap_page_size, cookie=""
+    )
+    # Every page is fetched on the connection that started the search
+    conn = get_conn()
+    while True:
+        # Timed per page, timing the generator itself would include the caller's work
+        with BACKEND_CALL_SECONDS.labels("ldap", "paged_search_page").time():
+            msgid = conn.search_ext(
+                base, ldap.SCOPE_SUBTREE, filterstr, attrlist=attrlist, serverctrls=[control]
+            )
+            _, data, _, serverctrls = conn.result3(msgid)
+        yield from data
+        cookie = next(
+            (
+                ctrl.cookie
+                for ctrl in serverctrls
+                if ctrl.controlType == SimplePagedResultsControl.controlType
+            ),
+            None,
+        )
+        if not cookie:  # Empty cookie marks the last page
+            break
+        control.cookie = cookie
+
+
+def get_all_users(attrlist: list[str] | None = None):
+    """
+    Lazily yields every user entry under ldap_user_dn, fetched page by page.
+    Sample entries, with attrlist=None:
      [
-       [
-         "ou=People,dc=trcldap,dc=icfoss,dc=org",
-         {
-           "objectClass": [
-             "organizationalUnit"
-           ],
-           "ou": [
-             "People"
-           ]
-         }
-       ],
        [
          "uid=g1,ou=People,dc=trcldap,dc=icfoss,dc=org",
          {
@@ -94,12 +210,21 @@ def get_all_users():
        ]
      ]
      """
-    # the first entry in the list is metadata of the scope subtree, hence skipping
-    return conn.search_s(settings.ldap_user_dn, ldap.SCOPE_SUBTREE)[1:]
+    # Filtering on uid skips the organizationalUnit entry of the subtree itself
+    return paged_search(settings.ldap_user_dn, "(uid=*)", attrlist)
+
+
+def get_all_vm_entries():
+    """
+    Lazily yields every VM (guacConfigGroup) entry under ldap_vm_dn, fetched page by page.
+    """
+    return paged_search(
+        settings.ldap_vm_dn, "(objectClass=guacConfigGroup)", [*VM_ATTRIBUTES, "member"]
+    )
 
 
 def generate_unique_username(first_name: str, last_name: str):
-    uids = [user[1].get("uid")[0].decode("utf-8") for user in get_all_users()]
+    uids = {user[1].get("uid")[0].decode("utf-8") for user in get_all_users(["uid"])}
     lim = 1
     while lim < len(first_name):
         if first_name[:lim] + last_name not in uids:
@@ -114,10 +239,32 @@ def generate_unique_username(first_name: str, last_name: str):
 def generate_unique_uid() -> int:
     # This approach will not reuse UIDs unless all of the succeeding UIDs are also deleted
     # But that is safe anyway since we do not want a new user getting access to a previous user's UID and hence their home dir
-    uids = sorted([int(user[1].get("uidNumber")[0]) for user in get_all_users()])
-    return uids[-1] + 1
+    return (
+        max(
+            int(user[1]["uidNumber"][0])
+            for user in get_all_users(["uidNumber"])
+            if "uidNumber" in user[1]
+        )
+        + 1
+    )
 
 
+@instrument("ldap")
+def uid_number_taken(uid_number: int, username: str) -> bool:
+    """
+    Whether a user other than username has uid_number.
+    generate_unique_uid() does not reserve the number, two users created at once can get the same one.
+    """
+    result = get_conn().search_s(
+        settings.ldap_user_dn,
+        ldap.SCOPE_SUBTREE,
+        filterstr=f"uidNumber={uid_number}",
+        attrlist=["uid"],
+    )
+    return any(attrs["uid"][0].decode("utf-8") != username for dn, attrs in result if dn)
+
+
+@instrument("ldap")
 def create_user(
     first_name: str,
     last_name: str,
@@ -126,8 +273,6 @@ def create_user(
     password: str,
     homedir_prefix: str,
 ):
-    conn.bind_s(admin_dn_builder(settings.ldap_admin_user), settings.ldap_admin_pass)
-
     dn = f"uid={username},{settings.ldap_user_dn}"
     modlist = ldap.modlist.addModlist(
         {
@@ -147,23 +292,41 @@ def create_user(
             "givenName": [f"{first_name}".encode()],
         }
     )
-    conn.add_s(dn=dn, modlist=modlist)
-    conn.passwd_s(user=dn, oldpw=None, newpw=password)  # Set user password
+    get_conn().add_s(dn=dn, modlist=modlist)
+    get_conn().passwd_s(user=dn, oldpw=None, newpw=password)  # Set user password
+    user_cache().invalidate(username)  # Drop a cached "no such user"
+
+
+@instrument("ldap")
+def set_password(username: str, password: str):
+    get_conn().passwd_s(
+        user=f"uid={username},{settings.ldap_user_dn}", oldpw=None, newpw=password
+    )
+
+
+@instrument("ldap")
+def delete_user(username: str):
+    get_conn().delete_s(f"uid={username},{settings.ldap_user_dn}")
+    user_cache().invalidate(username)
 
 
 def get_vms(username: str):
-    result = conn.search_s(
+    return vms_cache().get_or_load(username, lambda: _search_vms(username))
+
+
+@instrument("ldap", "get_vms")
+def _search_vms(username: str):
+    result = get_conn().search_s(
         settings.ldap_vm_dn,
         ldap.SCOPE_SUBTREE,
-        f"member=uid={username},{settings.ldap_user_dn}",
-        attrlist=["cn", "guacConfigParameter"],
+        f"member=uid={ldap.filter.escape_filter_chars(username)},{settings.ldap_user_dn}",
+        attrlist=VM_ATTRIBUTES,
     )
     return result if result else None
 
 
+@instrument("ldap")
 def create_vm_entry(vm: VirtualMachine, uid: str, port: int, mac_addr: str):
-    conn.bind_s(admin_dn_builder(settings.ldap_admin_user), settings.ldap_admin_pass)
-
     dn = f"cn={vm.name},{settings.ldap_vm_dn}"
     modlist = ldap.modlist.addModlist(
         {
@@ -186,12 +349,15 @@ def create_vm_entry(vm: VirtualMachine, uid: str, port: int, mac_addr: str):
             ],
         }
     )
-    conn.add_s(dn=dn, modlist=modlist)
+    get_conn().add_s(dn=dn, modlist=modlist)
+    vms_cache().invalidate(uid)
 
 
+@instrument("ldap")
 def delete_vm_entry(vmname: str):
     # This may throw ldap.INVALID_CREDENTIALS. Instead of catching it here, let it propagate to router, we don't have any reason to catch it here
     # other than to log, which is already being done at router along with other possible exceptions.
-    conn.bind_s(admin_dn_builder(settings.ldap_admin_user), settings.ldap_admin_pass)
     dn = f"cn={vmname},{settings.ldap_vm_dn}"
-    conn.delete_s(dn)
+    get_conn().delete_s(dn)
+    # The entry does not tell us its members without another search, drop every cached VM list instead
+    vms_cache().clear()
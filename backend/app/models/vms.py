@@ -6,3 +6,9 @@ class VirtualMachine(BaseModel):
     memory: int
     duration: float | None
 
+
+class VMResize(BaseModel):
+    id: int  # DBVirtualMachine.id
+    core_count: int
+    memory: int
+
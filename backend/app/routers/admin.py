@@ -1,6 +1,9 @@
 import json
 import csv
+import uuid
+import base64
 from typing import Annotated
+from collections import Counter
 from datetime import datetime
 from codecs import iterdecode
 from fastapi import (
@@ -8,17 +11,36 @@ from fastapi import (
     HTTPException,
     UploadFile,
     status,
-    BackgroundTasks,
     Depends,
+    Query,
+    Request,
+    Response,
 )
+from fastapi.concurrency import run_in_threadpool
+from sqlmodel import select, Session
 from app.config import settings
-from app.models.vms import VirtualMachine
+from app.database.main import get_session
+from app.database.models import DBVirtualMachine, DBJob
+from app.utils.etag import get_etag, etag_matches, CACHE_CONTROL, ALL_OWNERS
+from app.models.vms import VirtualMachine, VMResize
 from app.models.token import TokenData
 from app.utils.vms import validate_specs
-from app.utils.tasks import bulk_create
+from app.utils.workers import enqueue_job
+from app.utils.reconcile import reconcile
+from app.utils.cohorts import (
+    extend_cohort,
+    resize_cohort,
+    resize_vms,
+    stop_cohort,
+    delete_cohort,
+)
+from app.utils.preboot import schedule_preboot, check_start_at
+from app.utils.exceptions import PrebootScheduleException
+from app.utils.journal import record, find_records
+from app.utils.events import publish
 from app.utils.auth import generate_password
 from app.routers.auth import get_current_user
-from app.ldap.main import generate_unique_username
+from app.ldap.main import generate_unique_username, cache_stats
 
 router = APIRouter(prefix="/admin", tags=["Admin Routes"])
 
@@ -30,8 +52,10 @@ async def process_csv(
     memory: int,
     duration: int,
     prefix: str,
-    bg_tasks: BackgroundTasks,
+    response: Response,
     current_user: Annotated[TokenData, Depends(get_current_user)],
+    session: Session = Depends(get_session),
+    start_at: datetime | None = None,
 ):
     """
     This is an admin only route to bulk create users and their virtual machines.
@@ -52,6 +76,9 @@ async def process_csv(
         - last_name
         - unique username
         - password
+    The id of the bulk job is returned in the X-Job-Id header. It can be used to follow the job
+    through GET /admin/jobs/{job_id} and to filter GET /admin/vms.
+    With start_at, the start time of the course, the VMs are booted ahead of it (see /admin/cohort/preboot).
     """
     if current_user.username != settings.api_admin_user:  # Only allowd for admin
         raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Unauthorized")
@@ -92,21 +119,387 @@ async def process_csv(
         raise HTTPException(
             status.HTTP_400_BAD_REQUEST, "Empty or corrupted csv file. Check contents."
         )
+    if start_at is not None:
+        try:
+            check_start_at(start_at, len(entries) - 1)
+        except PrebootScheduleException as e:
+            raise HTTPException(status.HTTP_400_BAD_REQUEST, str(e))
 
     for user in entries[1:]:  # Generate username and password for each user
         user.append(
             generate_unique_username(user[0].replace(" ", "").lower(), user[1].replace(" ", "").lower())
         )
         user.append(generate_password(settings.default_user_passwd_length))
-    with open("creation_log.json", "a") as logfile:  # log the creation to a file
-        logfile.write(str(datetime.now()))
-        logfile.write(
-            f"\nUser count: {len(entries)-1}\nCore Count: {core_count}\nMemory: {memory}\nDuration: {duration}\nHome Directory prefix: {prefix}\n"
+    job_id = uuid.uuid4().hex
+    # Written to the journal in the background, passwords are stored hashed
+    record(
+        "bulk_job_queued",
+        job_id=job_id,
+        requested_by=current_user.username,
+        users=len(entries) - 1,
+        core_count=core_count,
+        memory=memory,
+        duration=duration,
+        prefix=prefix,
+    )
+    for first_name, last_name, username, password in entries[1:]:
+        record(
+            "user_issued",
+            job_id=job_id,
+            username=username,
+            first_name=first_name,
+            last_name=last_name,
+            password=password,
         )
-        json.dump(entries, logfile)
-        logfile.write("\n\n")
 
-    bg_tasks.add_task(
-        bulk_create, entries[1:], core_count, memory, duration, prefix
-    )  # Call background task
+    # Committed together with the job, so that clients never see events of a job that was not queued
+    publish(
+        "job_queued", current_user.username, session=session, job_id=job_id, users=len(entries) - 1
+    )
+    for _, _, username, _ in entries[1:]:
+        publish("vm_queued", username, session=session, job_id=job_id, name=f"{username}-vm")
+
+    # Queued in the database, the first free API worker picks it up
+    enqueue_job(
+        session,
+        "bulk_create",
+        {
+            "users": entries[1:],
+            "core_count": core_count,
+            "memory": memory,
+            "duration": duration,
+            "prefix": prefix,
+            "job_id": job_id,
+        },
+        job_id=job_id,
+    )
+    if start_at is not None:
+        try:
+            schedule_preboot(session, job_id, None, start_at)
+        except PrebootScheduleException as e:
+            raise HTTPException(status.HTTP_400_BAD_REQUEST, str(e))
+    session.commit()
+    response.headers["X-Job-Id"] = job_id
     return entries
+
+
+VM_LIST_FIELDS = list(DBVirtualMachine.model_fields)
+
+
+def encode_cursor(last_id: int) -> str:
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except ValueError:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "Invalid cursor")
+
+
+@router.get("/vms")
+async def list_all_vms(
+    *,
+    session: Session = Depends(get_session),
+    request: Request,
+    current_user: Annotated[TokenData, Depends(get_current_user)],
+    cursor: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=1000)] = 100,
+    owner_prefix: str | None = None,
+    expires_after: datetime | None = None,
+    expires_before: datetime | None = None,
+    job_id: str | None = None,
+    prefix: str | None = None,
+    node: str | None = None,
+    core_count: int | None = None,
+    memory: int | None = None,
+    fields: str | None = None,
+):
+    """
+    Admin only listing of every virtual machine in the fleet.
+    Results are ordered by id and paginated by cursor, pass the returned next_cursor to get the next page.
+    next_cursor is null on the last page.
+    Filters:
+        - owner_prefix: owners starting with the given string
+        - expires_after / expires_before: expiry window
+        - job_id: VMs created by a bulk CSV job (see X-Job-Id of POST /admin/csv)
+        - prefix: VMs created by bulk CSV jobs whose users got this home directory prefix, eg: /home
+        - node: proxmox node the VM lives on
+        - core_count / memory: exact specs
+    fields is a comma separated list of columns to return, eg: fields=vmid,name,owner
+    Supports conditional requests through ETag / If-None-Match, like GET /vms.
+    """
+    if current_user.username != settings.api_admin_user:  # Only allowd for admin
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Unauthorized")
+
+    selected = fields.split(",") if fields else VM_LIST_FIELDS
+    unknown = [field for field in selected if field not in VM_LIST_FIELDS]
+    if unknown:
+        raise HTTPException(
+            status.HTTP_400_BAD_REQUEST,
+            {"reason": "Unknown fields", "expected": VM_LIST_FIELDS, "received": unknown},
+        )
+    if "id" not in selected:
+        selected = ["id", *selected]  # Needed to build the cursor
+
+    etag = get_etag(session, ALL_OWNERS)
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    # Select only the requested columns, rows come back as plain tuples instead of ORM objects
+    statement = select(*(getattr(DBVirtualMachine, field) for field in selected))
+    if cursor is not None:
+        statement = statement.where(DBVirtualMachine.id > decode_cursor(cursor))
+    if owner_prefix:
+        # Range instead of LIKE so that the owner index can be used
+        statement = statement.where(
+            DBVirtualMachine.owner >= owner_prefix,
+            DBVirtualMachine.owner < owner_prefix + "\U0010ffff",
+        )
+    if expires_after is not None:
+        statement = statement.where(DBVirtualMachine.expiry >= expires_after)
+    if expires_before is not None:
+        statement = statement.where(DBVirtualMachine.expiry < expires_before)
+    if job_id is not None:
+        statement = statement.where(DBVirtualMachine.job_id == job_id)
+    if prefix is not None:
+        statement = statement.where(DBVirtualMachine.prefix == prefix)
+    if node is not None:
+        statement = statement.where(DBVirtualMachine.node == node)
+    if core_count is not None:
+        statement = statement.where(DBVirtualMachine.core_count == core_count)
+    if memory is not None:
+        statement = statement.where(DBVirtualMachine.memory == memory)
+    statement = statement.order_by(DBVirtualMachine.id).limit(limit + 1)
+
+    rows = session.exec(statement).all()
+    if len(selected) == 1:  # A single column comes back as scalars instead of tuples
+        rows = [(row,) for row in rows]
+    next_cursor = encode_cursor(rows[limit - 1][0]) if len(rows) > limit else None
+    items = [dict(zip(selected, row)) for row in rows[:limit]]
+
+    # Serialize directly, skipping response model validation of every row
+    return Response(
+        json.dumps(
+            {"items": items, "next_cursor": next_cursor},
+            default=datetime.isoformat,
+            separators=(",", ":"),
+        ),
+        media_type="application/json",
+        headers=headers,
+    )
+
+
+@router.post("/vms/resize")
+async def resize_virtual_machines(
+    current_user: Annotated[TokenData, Depends(get_current_user)],
+    changes: list[VMResize],
+):
+    """
+    Applies a CPU core count and memory change to each given VM (by id, as listed by GET /admin/vms),
+    all at once. Running VMs are resized live when their config allows it:
+        - CPU: cpu hotplug enabled, up to sockets * cores of the VM
+        - Memory: memory hotplug enabled with NUMA, or lowered through the balloon driver
+    Other changes are left pending by Proxmox until the VM is restarted.
+    Returns the outcome of each change: applied, pending, failed (with the error) or not_found.
+    """
+    if current_user.username != settings.api_admin_user:  # Only allowd for admin
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Unauthorized")
+    if len(changes) > 1000:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "At most 1000 VMs per request")
+    invalid = [
+        change.id
+        for change in changes
+        if not validate_specs(
+            VirtualMachine(core_count=change.core_count, memory=change.memory, duration=0)
+        )
+    ]
+    if invalid:
+        raise HTTPException(
+            status.HTTP_400_BAD_REQUEST,
+            {"reason": "Invalid virtual machine specs", "ids": invalid},
+        )
+    counts = Counter(change.id for change in changes)
+    duplicates = sorted(vm_id for vm_id, count in counts.items() if count > 1)
+    if duplicates:
+        raise HTTPException(
+            status.HTTP_400_BAD_REQUEST,
+            {"reason": "More than one change for the same VM", "ids": duplicates},
+        )
+    return await run_in_threadpool(resize_vms, changes)
+
+
+@router.get("/ldap/cache")
+async def ldap_cache_stats(
+    current_user: Annotated[TokenData, Depends(get_current_user)],
+):
+    """
+    Hit/miss statistics of the LDAP user and VM lookup caches.
+    """
+    if current_user.username != settings.api_admin_user:  # Only allowd for admin
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Unauthorized")
+    return cache_stats()
+
+
+@router.get("/jobs/{job_id}")
+async def get_job(
+    *,
+    job_id: str,
+    session: Session = Depends(get_session),
+    current_user: Annotated[TokenData, Depends(get_current_user)],
+):
+    """
+    Status of a background job, eg: a bulk creation started through POST /admin/csv.
+    """
+    if current_user.username != settings.api_admin_user:  # Only allowd for admin
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Unauthorized")
+    job = session.get(DBJob, job_id)
+    if job is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "Job not found")
+    return job.model_dump(exclude={"payload"})
+
+
+@router.post("/reconcile")
+async def reconcile_vms(
+    current_user: Annotated[TokenData, Depends(get_current_user)],
+    repair: bool = False,
+):
+    """
+    Compares Proxmox, LDAP and the database and returns the VMs that are out of sync:
+        - missing_vm: database entries whose Proxmox VM is gone
+        - missing_ldap: VMs without an LDAP entry, their owner cannot reach them
+        - orphan_ldap: LDAP entries of VMs that no longer exist
+        - orphan_vm: Proxmox VMs unknown to the database
+    With repair=true they are also fixed, except orphan VMs which are only deleted when
+    RECONCILE_DELETE_ORPHAN_VMS is set. Nothing is repaired, and refused gives the reason, when the
+    Proxmox listing looks partial (see RECONCILE_MAX_MISSING_FRACTION).
+    The same check runs every RECONCILE_INTERVAL seconds.
+    """
+    if current_user.username != settings.api_admin_user:  # Only allowd for admin
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Unauthorized")
+    return await run_in_threadpool(reconcile, repair)
+
+
+@router.get("/journal")
+async def search_journal(
+    current_user: Annotated[TokenData, Depends(get_current_user)],
+    username: str | None = None,
+    job_id: str | None = None,
+    event: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=1000)] = 20,
+):
+    """
+    Most recent journal records of bulk jobs and VM provisioning, newest first.
+    eg: username=jdoe returns the job that created jdoe, the password hash issued to them
+    and the outcome of their VM creation.
+    """
+    if current_user.username != settings.api_admin_user:  # Only allowd for admin
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Unauthorized")
+    return await run_in_threadpool(find_records, username, job_id, event, limit)
+
+
+def check_cohort(job_id: str | None, prefix: str | None):
+    if job_id is None and prefix is None:
+        raise HTTPException(
+            status.HTTP_400_BAD_REQUEST, "Select the cohort with job_id, prefix or both"
+        )
+
+
+@router.post("/cohort/extend")
+async def extend_cohort_expiry(
+    current_user: Annotated[TokenData, Depends(get_current_user)],
+    minutes: Annotated[int, Query(ge=1)],
+    job_id: str | None = None,
+    prefix: str | None = None,
+):
+    """
+    Pushes back the expiry of every VM of a cohort by the given number of minutes.
+    A cohort is the VMs of a bulk job (job_id, the X-Job-Id of POST /admin/csv). prefix, the home directory
+    prefix given to POST /admin/csv (eg: /home), selects the VMs of every bulk job created with it instead,
+    or narrows down job_id. Unrelated jobs often share it, so stopping and deleting need job_id.
+    Every cohort operation returns a summary:
+        {"matched": 120, "succeeded": 118, "failed": [{"vmid": ..., "name": ..., "owner": ..., "error": ...}]}
+    """
+    if current_user.username != settings.api_admin_user:  # Only allowd for admin
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Unauthorized")
+    check_cohort(job_id, prefix)
+    return await run_in_threadpool(extend_cohort, job_id, prefix, minutes)
+
+
+@router.post("/cohort/resize")
+async def resize_cohort_vms(
+    current_user: Annotated[TokenData, Depends(get_current_user)],
+    core_count: int,
+    memory: int,
+    job_id: str | None = None,
+    prefix: str | None = None,
+):
+    """
+    Changes the CPU core count and memory of every VM of a cohort, see /admin/cohort/extend.
+    Running VMs are resized live where their config allows it (see POST /admin/vms/resize),
+    pending counts the VMs that get their new specs on their next restart.
+    """
+    if current_user.username != settings.api_admin_user:  # Only allowd for admin
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Unauthorized")
+    check_cohort(job_id, prefix)
+    if not validate_specs(VirtualMachine(core_count=core_count, memory=memory, duration=0)):
+        raise HTTPException(
+            status.HTTP_400_BAD_REQUEST, "Invalid virtual machine specs"
+        )
+    return await run_in_threadpool(resize_cohort, job_id, prefix, core_count, memory)
+
+
+@router.post("/cohort/stop")
+async def stop_cohort_vms(
+    current_user: Annotated[TokenData, Depends(get_current_user)],
+    job_id: str,
+):
+    """
+    Shuts down every VM of a bulk job, see /admin/cohort/extend.
+    Guacamole starts them again with Wake-on-LAN when their owners connect.
+    """
+    if current_user.username != settings.api_admin_user:  # Only allowd for admin
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Unauthorized")
+    return await run_in_threadpool(stop_cohort, job_id)
+
+
+@router.post("/cohort/preboot")
+async def preboot_cohort_vms(
+    *,
+    session: Session = Depends(get_session),
+    current_user: Annotated[TokenData, Depends(get_current_user)],
+    start_at: datetime,
+    job_id: str | None = None,
+    prefix: str | None = None,
+):
+    """
+    Boots the VMs of a cohort (see /admin/cohort/extend) ahead of a class starting at start_at,
+    so that they are not all cold booted by Guacamole at once when the students connect.
+    They are started in waves of PREBOOT_WAVE_SIZE VMs, the first one early enough for the last one
+    to be up PREBOOT_MARGIN seconds before the class. Returns when the first wave boots (boot_at)
+    and the id of the job, to follow it through GET /admin/jobs/{job_id}.
+    400 if start_at is too close for that. The VMs of a bulk job still being created are booted once it is over.
+    """
+    if current_user.username != settings.api_admin_user:  # Only allowd for admin
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Unauthorized")
+    check_cohort(job_id, prefix)
+    try:
+        scheduled = schedule_preboot(session, job_id, prefix, start_at)
+    except PrebootScheduleException as e:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, str(e))
+    session.commit()
+    return scheduled
+
+
+@router.delete("/cohort")
+async def delete_cohort_vms(
+    current_user: Annotated[TokenData, Depends(get_current_user)],
+    job_id: str,
+):
+    """
+    Deletes every VM of a bulk job, see /admin/cohort/extend. The users and their data are kept.
+    """
+    if current_user.username != settings.api_admin_user:  # Only allowd for admin
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Unauthorized")
+    return await run_in_threadpool(delete_cohort, job_id)
@@ -0,0 +1,41 @@
+from typing import Annotated
+from fastapi import APIRouter, Depends, Header
+from fastapi.responses import StreamingResponse
+from app.config import settings
+from app.models.token import TokenData
+from app.routers.auth import get_current_user
+from app.utils.events import stream_events
+
+router = APIRouter(prefix="/events", tags=["Events"])
+
+
+@router.get("")
+async def get_events(
+    current_user: Annotated[TokenData, Depends(get_current_user)],
+    job_id: str | None = None,
+    last_event_id: Annotated[int | None, Header()] = None,
+):
+    """
+    Server-Sent Events stream of the provisioning and expiry events of the current user's VMs,
+    replacing the polling of GET /vms. The API admin receives the events of every user,
+    plus job_queued and job_finished for bulk jobs. job_id only streams the events of a bulk job.
+    Events:
+        - job_queued / job_finished: bulk job started through POST /admin/csv / done
+        - vm_queued: the user's VM is part of a bulk job
+        - vm_created / port_exposed: provisioning steps done
+        - vm_ready: the VM can be used, it is visible on guacamole after logging in again
+        - vm_failed: provisioning failed and was undone
+        - vm_expiring: the VM expires within EXPIRY_WARNING seconds
+        - vm_extended: the expiry of the VM was pushed back, see /admin/cohort/extend
+        - vm_suspended: the VM was idle and got suspended or shut down, it starts again on the next connection
+        - vm_started: the VM was booted ahead of its class, see /admin/cohort/preboot
+        - vm_deleted: the VM expired or was deleted
+    On reconnect, send the id of the last event received in the Last-Event-ID header
+    to receive the events missed in the meantime.
+    """
+    owner = None if current_user.username == settings.api_admin_user else current_user.username
+    return StreamingResponse(
+        stream_events(owner, job_id, last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},  # No proxy buffering
+    )
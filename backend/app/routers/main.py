@@ -1,18 +1,49 @@
+import time
 import asyncio
 from contextlib import asynccontextmanager
 from typing import Literal
-from fastapi import FastAPI
+from fastapi import FastAPI, Response, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
+from prometheus_client import CONTENT_TYPE_LATEST
 from fastapi.middleware.cors import CORSMiddleware
-from app.routers import vms, auth, admin
+from app.routers import vms, auth, admin, events
+from app.database.main import ping_database
+from app.database.models import init_db
+from app.ldap.main import ping_ldap
+from app.utils.vms import ping_proxmox
+from app.config import settings
 from app.utils.tasks import check_expiry
+from app.utils.reconcile import scheduled_reconcile
+from app.utils.idle import check_idle
+from app.utils.workers import run_jobs, run_periodic, release_leases
+from app.utils.journal import flush_journal
+from app.utils.metrics import latest_metrics, mark_worker_stopped
+from app.utils.events import run_event_dispatcher, prune_events
 
 
-# Runs check_expiry() func on startup and tear down on shutdown
+# Prepares the database and starts the background workers on startup, tears them down on shutdown.
+# Every uvicorn worker runs this: jobs are spread over all of them, periodic tasks run in one at a time.
+# LDAP and proxmox connections are opened on first use.
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    task = asyncio.create_task(check_expiry())
+    await run_in_threadpool(init_db)
+    tasks = [
+        asyncio.create_task(run_periodic("expiry", settings.expiry_interval, check_expiry)),
+        asyncio.create_task(
+            run_periodic("reconcile", settings.reconcile_interval, scheduled_reconcile)
+        ),
+        asyncio.create_task(run_periodic("idle", settings.idle_interval, check_idle)),
+        asyncio.create_task(run_periodic("events_prune", 3600, prune_events)),
+        asyncio.create_task(run_jobs()),
+        asyncio.create_task(run_event_dispatcher()),
+    ]
     yield
-    task.cancel()
+    for task in tasks:
+        task.cancel()
+    await run_in_threadpool(release_leases)  # Let another worker take over right away
+    await run_in_threadpool(flush_journal)
+    mark_worker_stopped()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -24,9 +55,11 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Job-Id", "ETag"],
 )
 app.include_router(auth.router)
 app.include_router(admin.router)
+app.include_router(events.router)
 
 # Can be used by regular users to manage their VMs. all CRUD operations supported.
 # app.include_router(vms.router)
@@ -36,3 +69,32 @@ app.include_router(admin.router)
 @app.get("/ping")
 async def pong() -> Literal["pong"]:
     return "pong"
+
+
+async def check_backend(check) -> dict:
+    start = time.perf_counter()
+    try:
+        await run_in_threadpool(check)
+    except Exception as e:
+        return {"status": "error", "detail": str(e)}
+    return {"status": "ok", "latency_ms": (time.perf_counter() - start) * 1000}
+
+
+# Readiness check, unlike /ping this reports whether each backend is reachable
+@app.get("/ready")
+async def ready() -> JSONResponse:
+    checks = {"database": ping_database, "ldap": ping_ldap, "proxmox": ping_proxmox}
+    results = dict(
+        zip(checks, await asyncio.gather(*(check_backend(check) for check in checks.values())))
+    )
+    all_ok = all(result["status"] == "ok" for result in results.values())
+    return JSONResponse(
+        results,
+        status.HTTP_200_OK if all_ok else status.HTTP_503_SERVICE_UNAVAILABLE,
+    )
+
+
+# Prometheus scrape endpoint. See app/utils/metrics.py to run several uvicorn workers
+@app.get("/metrics", include_in_schema=False)
+async def metrics() -> Response:
+    return Response(await run_in_threadpool(latest_metrics), media_type=CONTENT_TYPE_LATEST)
@@ -1,7 +1,8 @@
 import datetime
 from typing import Annotated
-from fastapi import APIRouter, Depends, status
+from fastapi import APIRouter, Depends, Request, Response, status
 from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.exceptions import HTTPException
 from sqlmodel import select, Session
 from sqlalchemy.exc import NoResultFound
@@ -9,23 +10,20 @@ from ldap import INVALID_CREDENTIALS
 from app.models.vms import VirtualMachine
 from app.models.token import TokenData
 from app.routers.auth import get_current_user
-from app.ldap.main import delete_vm_entry, create_vm_entry, get_user
+from app.ldap.main import delete_vm_entry, get_user
 from app.database.models import DBVirtualMachine
 from app.database.main import get_session
+from app.utils.provisioning import provision_vm
+from app.utils.events import publish
+from app.utils.etag import bump_revision, get_etag, etag_matches, CACHE_CONTROL
 from app.utils.vms import (
-    create_vm,
-    new_free_port,
-    new_free_id,
-    expose_vnc_port,
-    get_vm_mac_addr,
     validate_specs,
     update_vm_specs,
     delete_vm,
 )
 from app.utils.exceptions import (
-    VMCreationException,
+    VMProvisioningException,
     VMDeletionException,
-    VMPortExposeException,
     VMRunningException,
     VMUpdationException,
 )
@@ -37,11 +35,20 @@ router = APIRouter(prefix="/vms", tags=["Virtual Machines"])
 async def get_vms_of_current_user(
     *,
     session: Session = Depends(get_session),
+    request: Request,
+    response: Response,
     current_user: Annotated[TokenData, Depends(get_current_user)],
 ):
     """
     Returns all available Virtual machines belonging to the user who is currently logged in.
+    Supports conditional requests: send the returned ETag back in If-None-Match and
+    a 304 with no body is returned if nothing changed since.
     """
+    etag = get_etag(session, current_user.username)
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
     res = []
     statement = select(DBVirtualMachine).where(
         DBVirtualMachine.owner == current_user.username
@@ -69,34 +76,20 @@ async def add_new_vm_for_user(
             {"message": "Invalid Virtual Machine details."},
         )
     try:
-        id = new_free_id()
-        create_vm(id=id, name=vm.name, core_count=vm.core_count, memory=vm.memory)
-        port = new_free_port()
-        expose_vnc_port(vmid=id, port=port)
-        mac_addr = get_vm_mac_addr(id)
-
-        # port = port + 5900: The real port where proxmox listens for VNC clients is at 5900+<selected_num>
-        # This needs to be the entry in LDAP so that guacamole connects to the correct port
-        create_vm_entry(vm, current_user.username, port=port + 5900, mac_addr=mac_addr)
-    except (VMCreationException, VMPortExposeException, INVALID_CREDENTIALS) as e:
-        print(f"VM creation failed: {e}")
-        # TODO: Handle rollback here.
+        # Blocks for the whole saga (Proxmox tasks, config file, LDAP), keep it off the event loop
+        await run_in_threadpool(
+            provision_vm,
+            session,
+            vm,
+            current_user.username,
+            expiry=datetime.datetime.now(datetime.UTC)
+            + datetime.timedelta(minutes=vm.duration),
+        )
+    except VMProvisioningException as e:
+        print(e)
         raise HTTPException(
             status.HTTP_500_INTERNAL_SERVER_ERROR, "VM creation failed."
         )
-    # Add an entry to the db for future queries. LDAP query and data parsing is unnecessarily complicated
-    vm_db_entry = DBVirtualMachine(
-        vmid=id,
-        name=vm.name,
-        core_count=vm.core_count,
-        memory=vm.memory,
-        port=port,
-        owner=current_user.username,
-        expiry=datetime.datetime.now(datetime.UTC)
-        + datetime.timedelta(minutes=vm.duration),
-    )
-    session.add(vm_db_entry)
-    session.commit()
 
     return JSONResponse("VM Created Successfully", status.HTTP_201_CREATED)
 
@@ -113,6 +106,7 @@ async def update_vm(
     - CPU Core count
     - Total memory
     - Duration
+    The new specs apply right away if the VM supports CPU and memory hotplug, otherwise once it is restarted.
     """
     statement = (
         select(DBVirtualMachine)
@@ -125,12 +119,13 @@ async def update_vm(
         vm_pydantic = VirtualMachine(
             name=vm.name, core_count=vm.core_count, memory=vm.memory, duration=vm.expiry
         )
-        update_vm_specs(
+        pending_restart = update_vm_specs(
             vmid=vm.vmid,
             vm=vm_pydantic,
         )
         vm_db.core_count, vm_db.memory = vm.core_count, vm.memory
         session.add(vm_db)
+        bump_revision(session, current_user.username)
         session.commit()
     except NoResultFound:
         raise HTTPException(status.HTTP_404_NOT_FOUND, "VM not found")
@@ -139,7 +134,10 @@ async def update_vm(
         raise HTTPException(
             status.HTTP_500_INTERNAL_SERVER_ERROR, "Failed to update VM specs"
         )
-    return JSONResponse({"detail": "VM updated successfully"}, status.HTTP_200_OK)
+    return JSONResponse(
+        {"detail": "VM updated successfully", "pending_restart": pending_restart},
+        status.HTTP_200_OK,
+    )
 
 
 @router.delete("")
@@ -167,6 +165,8 @@ async def delete_virtual_machine(
         delete_vm(vm.vmid) # Proxmox
         delete_vm_entry(vm.name) # LDAP
         session.delete(vm) # DB
+        bump_revision(session, current_user.username)
+        publish("vm_deleted", vm.owner, session=session, vm_id=vm.id, name=vm.name, reason="deleted")
         session.commit()
     except VMRunningException:
         print("Refusing to delete running VM.")
@@ -0,0 +1,214 @@
+import datetime
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+from ldap import NO_SUCH_OBJECT
+from sqlalchemy import delete
+from sqlmodel import Session, select
+from app.config import settings
+from app.database.main import get_engine
+from app.database.models import DBVirtualMachine
+from app.models.vms import VirtualMachine, VMResize
+from app.utils.etag import bump_revision
+from app.utils.events import publish
+from app.utils.metrics import COHORT_OPERATIONS
+from app.utils.vms import update_vm_specs, stop_vm, destroy_vm
+from app.ldap.main import delete_vm_entry
+
+# A cohort is the group of VMs created for one course: every VM of a bulk (CSV) job. Extending, resizing
+# and prebooting can also select the VMs by prefix, the home directory prefix the bulk job gave its users
+# (eg: /home), alone or within a job. Unrelated jobs often share it, so stopping and deleting take the job only.
+# Cohort operations select the VMs with one query, run the Proxmox and LDAP calls of up to
+# COHORT_WORKERS VMs at once and write the database changes of the whole cohort in a single transaction.
+# Each returns a summary: {"matched": <VMs in the cohort>, "succeeded": <count>, "failed": [...]}
+# Resizes also return "pending": VMs that only get their new specs once restarted, see update_vm_specs().
+
+
+def select_cohort(session: Session, job_id: str | None, prefix: str | None) -> list[DBVirtualMachine]:
+    statement = select(DBVirtualMachine).order_by(DBVirtualMachine.id)
+    if job_id is not None:
+        statement = statement.where(DBVirtualMachine.job_id == job_id)
+    if prefix is not None:
+        statement = statement.where(DBVirtualMachine.prefix == prefix)
+    return session.exec(statement).all()
+
+
+def run_for_each(
+    operation: str, vms: list[DBVirtualMachine], func: Callable[[DBVirtualMachine], None]
+) -> tuple[list[DBVirtualMachine], list[dict]]:
+    """
+    Calls func for every VM, COHORT_WORKERS at a time. Returns the VMs it succeeded for and the failures.
+    """
+
+    def run(vm: DBVirtualMachine) -> str | None:
+        try:
+            func(vm)
+        except Exception as e:
+            print(f"Cohort {operation} failed for VM {vm.vmid}: {e}")
+            COHORT_OPERATIONS.labels(operation, "failure").inc()
+            return str(e) or repr(e)
+        COHORT_OPERATIONS.labels(operation, "success").inc()
+        return None
+
+    with ThreadPoolExecutor(max_workers=settings.cohort_workers) as executor:
+        errors = list(executor.map(run, vms))
+    succeeded = [vm for vm, error in zip(vms, errors) if error is None]
+    failed = [
+        {"id": vm.id, "vmid": vm.vmid, "name": vm.name, "owner": vm.owner, "error": error}
+        for vm, error in zip(vms, errors)
+        if error is not None
+    ]
+    return succeeded, failed
+
+
+def _summary(vms: list, succeeded: list, failed: list[dict]) -> dict:
+    return {"matched": len(vms), "succeeded": len(succeeded), "failed": failed}
+
+
+def extend_cohort(job_id: str | None, prefix: str | None, minutes: int) -> dict:
+    """
+    Pushes the expiry of every VM of the cohort back by minutes. VMs that never expire are left alone.
+    Only the database is involved, so this is a single transaction.
+    """
+    with Session(get_engine()) as session:
+        vms = select_cohort(session, job_id, prefix)
+        extended = [vm for vm in vms if vm.expiry.year < datetime.MAXYEAR]
+        for vm in extended:
+            vm.expiry += datetime.timedelta(minutes=minutes)
+            vm.warned_at = None  # Warn about the new expiry again
+            session.add(vm)
+            publish(
+                "vm_extended",
+                vm.owner,
+                session=session,
+                job_id=vm.job_id,
+                vm_id=vm.id,
+                name=vm.name,
+                expiry=vm.expiry,
+            )
+        for owner in {vm.owner for vm in extended}:
+            bump_revision(session, owner)
+        session.commit()
+    COHORT_OPERATIONS.labels("extend", "success").inc(len(extended))
+    return _summary(vms, extended, [])
+
+
+def _resize(
+    session: Session, vms: list[DBVirtualMachine], specs: dict[int, VirtualMachine]
+) -> tuple[list[DBVirtualMachine], set[int], list[dict]]:
+    """
+    Applies specs (by VM id) to the VMs, live where possible, and saves the new specs.
+    Returns the resized VMs, the ids of those waiting for a restart and the failures.
+    """
+    pending = set()
+
+    def resize(vm: DBVirtualMachine):
+        if update_vm_specs(vmid=vm.vmid, vm=specs[vm.id]):
+            pending.add(vm.id)
+
+    succeeded, failed = run_for_each("resize", vms, resize)
+    for vm in succeeded:
+        vm.core_count, vm.memory = specs[vm.id].core_count, specs[vm.id].memory
+        session.add(vm)
+    for owner in {vm.owner for vm in succeeded}:
+        bump_revision(session, owner)
+    session.commit()
+    return succeeded, pending, failed
+
+
+def resize_cohort(job_id: str | None, prefix: str | None, core_count: int, memory: int) -> dict:
+    """
+    Changes the core count and memory of every VM of the cohort.
+    """
+    with Session(get_engine()) as session:
+        vms = select_cohort(session, job_id, prefix)
+        specs = VirtualMachine(core_count=core_count, memory=memory, duration=None)
+        succeeded, pending, failed = _resize(session, vms, {vm.id: specs for vm in vms})
+    return {**_summary(vms, succeeded, failed), "pending": len(pending)}
+
+
+def resize_vms(changes: list[VMResize]) -> dict:
+    """
+    Applies a spec change to each VM, all at once. Returns the outcome of each change:
+    applied (live if the VM is running), pending (applied on the next restart), failed or not_found,
+    with the count of each. At most one change per VM.
+    """
+    with Session(get_engine()) as session:
+        vms = session.exec(
+            select(DBVirtualMachine).where(
+                DBVirtualMachine.id.in_([change.id for change in changes])
+            )
+        ).all()
+        specs = {
+            change.id: VirtualMachine(
+                core_count=change.core_count, memory=change.memory, duration=None
+            )
+            for change in changes
+        }
+        vmids = {vm.id: vm.vmid for vm in vms}
+        succeeded, pending, failed = _resize(session, vms, specs)
+    errors = {failure["id"]: failure["error"] for failure in failed}
+    results = []
+    for change in changes:
+        result = {"id": change.id, "vmid": vmids.get(change.id)}
+        if change.id not in vmids:
+            result["status"] = "not_found"
+        elif change.id in errors:
+            result.update(status="failed", error=errors[change.id])
+        else:
+            result["status"] = "pending" if change.id in pending else "applied"
+        results.append(result)
+    return {
+        **{
+            outcome: sum(result["status"] == outcome for result in results)
+            for outcome in ("applied", "pending", "failed", "not_found")
+        },
+        "results": results,
+    }
+
+
+def stop_cohort(job_id: str) -> dict:
+    """
+    Shuts down every VM of the bulk job. They are started again by Wake-on-LAN when their owner connects.
+    """
+    with Session(get_engine()) as session:
+        vms = select_cohort(session, job_id, None)
+    succeeded, failed = run_for_each("stop", vms, lambda vm: stop_vm(vm.vmid))
+    return _summary(vms, succeeded, failed)
+
+
+def _destroy(vm: DBVirtualMachine):
+    destroy_vm(vm.vmid)
+    try:
+        delete_vm_entry(vm.name)
+    except NO_SUCH_OBJECT:
+        pass
+
+
+def delete_cohort(job_id: str) -> dict:
+    """
+    Deletes every VM of the bulk job from Proxmox, LDAP and the database, like their expiry would.
+    The LDAP users are kept, their home directories live on the LTSP server.
+    """
+    with Session(get_engine()) as session:
+        vms = select_cohort(session, job_id, None)
+        succeeded, failed = run_for_each("delete", vms, _destroy)
+        if succeeded:
+            session.exec(
+                delete(DBVirtualMachine).where(
+                    DBVirtualMachine.id.in_([vm.id for vm in succeeded])
+                )
+            )
+        for vm in succeeded:
+            publish(
+                "vm_deleted",
+                vm.owner,
+                session=session,
+                job_id=vm.job_id,
+                vm_id=vm.id,
+                name=vm.name,
+                reason="deleted",
+            )
+        for owner in {vm.owner for vm in succeeded}:
+            bump_revision(session, owner)
+        session.commit()
+    return _summary(vms, succeeded, failed)
@@ -0,0 +1,43 @@
+from fastapi import Request
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlmodel import Session
+from app.database.models import DBRevision
+
+# Revision row bumped on every write regardless of owner, used by admin listings.
+ALL_OWNERS = "*"
+
+CACHE_CONTROL = "private, no-cache"  # Clients may cache but must revalidate on every poll
+
+
+def bump_revision(session: Session, owner: str):
+    """
+    Marks the VMs of owner as changed. Must be called in the same transaction as the write.
+    """
+    # Upsert incrementing in SQL, so that concurrent writers (possibly on other API servers)
+    # never reuse a revision nor race to create the first one
+    insert = postgresql.insert if session.get_bind().dialect.name == "postgresql" else sqlite.insert
+    for key in (owner, ALL_OWNERS):
+        session.exec(
+            insert(DBRevision)
+            .values(owner=key, revision=1)
+            .on_conflict_do_update(
+                index_elements=[DBRevision.owner],
+                set_={"revision": DBRevision.revision + 1},
+            )
+        )
+
+
+def get_etag(session: Session, owner: str) -> str:
+    revision = session.get(DBRevision, owner)
+    return f'W/"{revision.revision if revision else 0}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    # Weak comparison, as required for If-None-Match
+    return any(
+        tag.strip().removeprefix("W/") in (etag.removeprefix("W/"), "*")
+        for tag in if_none_match.split(",")
+    )
@@ -0,0 +1,232 @@
+import json
+import time
+import asyncio
+import datetime
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import delete, func
+from sqlmodel import Session, select
+from app.config import settings
+from app.database.main import get_engine
+from app.database.models import DBEvent
+
+# Events are written to the database by whichever worker process does the work (an API request,
+# a bulk job, the expiry sweep), so that clients connected to any process receive them.
+# Every process runs one dispatcher, which polls for new events and hands them to the GET /events
+# streams open in that process, in id order. Clients reconnect with Last-Event-ID and miss nothing.
+# Ids are assigned when an event is written, but transactions commit in any order: on PostgreSQL an id
+# can show up after greater ones. The dispatcher holds the events after a missing id back until it
+# is committed, for up to EVENT_GAP_TIMEOUT seconds, as the ids of rolled back transactions never are.
+#
+# Event types:
+#   job_queued, job_finished: bulk (CSV) jobs, sent to the API admin
+#   vm_queued: a VM for this user is part of a bulk job
+#   vm_created, port_exposed, vm_ready, vm_failed: provisioning steps
+#   vm_expiring: the VM expires within EXPIRY_WARNING seconds
+#   vm_extended: the expiry of the VM was pushed back
+#   vm_suspended: the VM was idle and got suspended or shut down
+#   vm_started: the VM was booted ahead of its class
+#   vm_deleted: the VM expired or was deleted
+
+
+def publish(
+    type: str,
+    owner: str,
+    *,
+    session: Session | None = None,
+    job_id: str | None = None,
+    vm_id: int | None = None,
+    **data,
+):
+    """
+    Records an event. With session it is committed with the caller's transaction,
+    otherwise right away. Publishing never fails the caller's operation in the latter case.
+    """
+    data = {key: _serialize(value) for key, value in data.items()}
+    event = DBEvent(type=type, owner=owner, job_id=job_id, vm_id=vm_id, data=data)
+    if session is not None:
+        session.add(event)
+        return
+    try:
+        with Session(get_engine()) as own_session:
+            own_session.add(event)
+            own_session.commit()
+    except Exception as e:
+        print(f"Failed to publish {type} event for {owner}: {e}")
+
+
+def _serialize(value):
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:  # Naive datetimes, as read back from SQLite, are in UTC
+            value = value.replace(tzinfo=datetime.UTC)
+        return value.isoformat()
+    return value
+
+
+def event_filter(owner: str | None, job_id: str | None):
+    """
+    owner None means every owner, as seen by the API admin.
+    """
+    conditions = []
+    if owner is not None:
+        conditions.append(DBEvent.owner == owner)
+    if job_id is not None:
+        conditions.append(DBEvent.job_id == job_id)
+    return conditions
+
+
+def events_since(
+    last_id: int, owner: str | None, job_id: str | None, until: int | None = None, limit: int = 1000
+) -> list[DBEvent]:
+    conditions = event_filter(owner, job_id)
+    if until is not None:
+        conditions.append(DBEvent.id <= until)
+    with Session(get_engine()) as session:
+        return session.exec(
+            select(DBEvent)
+            .where(DBEvent.id > last_id, *conditions)
+            .order_by(DBEvent.id)
+            .limit(limit)
+        ).all()
+
+
+def latest_event_id() -> int:
+    with Session(get_engine()) as session:
+        return session.exec(select(func.max(DBEvent.id))).one() or 0
+
+
+def prune_events():
+    """
+    Deletes events older than EVENT_RETENTION seconds. Run periodically by a single elected worker.
+    """
+    cutoff = datetime.datetime.now(datetime.UTC) - datetime.timedelta(
+        seconds=settings.event_retention
+    )
+    with Session(get_engine()) as session:
+        session.exec(delete(DBEvent).where(DBEvent.created_at < cutoff))
+        session.commit()
+
+
+def format_event(event: DBEvent) -> str:
+    data = {
+        "owner": event.owner,
+        "job_id": event.job_id,
+        "vm_id": event.vm_id,
+        "created_at": _serialize(event.created_at),
+        **(event.data or {}),
+    }
+    return f"id: {event.id}\nevent: {event.type}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+class Subscriber:
+    def __init__(self, owner: str | None, job_id: str | None):
+        self.owner = owner
+        self.job_id = job_id
+        self.queue: asyncio.Queue[DBEvent | None] = asyncio.Queue(maxsize=1000)
+
+    def wants(self, event: DBEvent) -> bool:
+        return (self.owner is None or event.owner == self.owner) and (
+            self.job_id is None or event.job_id == self.job_id
+        )
+
+    def push(self, event: DBEvent) -> bool:
+        """
+        Returns False if the client fell too far behind. Its stream is then closed, and
+        it catches up from the database when it reconnects with Last-Event-ID.
+        """
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)  # Ends the stream
+            return False
+        return True
+
+
+_subscribers: set[Subscriber] = set()
+# Every event up to this id was handed to the streams of this process, or given up on. None until the dispatcher starts.
+_delivered_id: int | None = None
+
+
+def subscribe(owner: str | None, job_id: str | None) -> Subscriber:
+    subscriber = Subscriber(owner, job_id)
+    _subscribers.add(subscriber)
+    return subscriber
+
+
+def unsubscribe(subscriber: Subscriber):
+    _subscribers.discard(subscriber)
+
+
+async def run_event_dispatcher():
+    """
+    Polls for new events every EVENT_POLL_INTERVAL seconds and hands them to the streams of this process,
+    in id order, see above.
+    """
+    global _delivered_id
+    waiting = None  # (_delivered_id, time.monotonic()) as of when the next id was found missing
+    while True:
+        try:
+            if _delivered_id is None:
+                _delivered_id = await run_in_threadpool(latest_event_id)
+            events = await run_in_threadpool(events_since, _delivered_id, None, None)
+            for event in events:
+                if event.id != _delivered_id + 1:
+                    if waiting is None or waiting[0] != _delivered_id:
+                        waiting = (_delivered_id, time.monotonic())
+                    if time.monotonic() - waiting[1] < settings.event_gap_timeout:
+                        break  # Not committed yet
+                    print(f"Events {_delivered_id + 1} to {event.id - 1} never showed up, skipping them")
+                for subscriber in list(_subscribers):
+                    if subscriber.wants(event) and not subscriber.push(event):
+                        unsubscribe(subscriber)
+                _delivered_id = event.id
+            else:
+                if len(events) == 1000:
+                    continue  # There are more
+        except Exception as e:
+            print(f"Event dispatcher failed: {e}")
+        await asyncio.sleep(settings.event_poll_interval)
+
+
+async def stream_events(owner: str | None, job_id: str | None, last_event_id: int | None):
+    """
+    Server-Sent Events stream: the events after last_event_id, then new ones as they are published.
+    """
+    while _delivered_id is None:  # Dispatcher starting
+        await asyncio.sleep(settings.event_poll_interval)
+    # The events up to delivered_id come from the database, the ones after it from the dispatcher
+    subscriber = subscribe(owner, job_id)
+    delivered_id = _delivered_id
+    try:
+        yield f"retry: {int(settings.event_poll_interval * 1000) + 1000}\n\n"
+        if last_event_id is None:
+            last_sent = delivered_id
+        else:
+            last_sent = last_event_id
+            # Replay what was missed while disconnected, in pages
+            while last_sent < delivered_id:
+                missed = await run_in_threadpool(
+                    events_since, last_sent, owner, job_id, delivered_id
+                )
+                for event in missed:
+                    yield format_event(event)
+                    last_sent = event.id
+                if len(missed) < 1000:
+                    break
+        while True:
+            try:
+                event = await asyncio.wait_for(
+                    subscriber.queue.get(), timeout=settings.event_keepalive
+                )
+            except TimeoutError:
+                yield ": keepalive\n\n"  # Keeps proxies from closing an idle connection
+                continue
+            if event is None:
+                return
+            if event.id <= last_sent:
+                continue  # Already sent before reconnecting, through a process further ahead
+            yield format_event(event)
+            last_sent = event.id
+    finally:
+        unsubscribe(subscriber)
@@ -21,3 +21,29 @@ class VMRunningException(Exception):
 
 class VMStopException(Exception):
     pass
+
+class VMSuspendException(Exception):
+    pass
+
+class VMStartException(Exception):
+    pass
+
+class VMQueryException(Exception):
+    pass
+
+class ProxmoxUnavailableException(Exception):
+    pass
+
+class VMProvisioningException(Exception):
+    pass
+
+class PrebootScheduleException(Exception):
+    pass
+
+class JobDeferredException(Exception):
+    """
+    Raised by a job handler that cannot run yet, the job is queued again to run after run_after.
+    """
+    def __init__(self, run_after):
+        super().__init__(f"Deferred until {run_after}")
+        self.run_after = run_after
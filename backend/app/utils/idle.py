@@ -0,0 +1,144 @@
+import time
+import datetime
+from sqlalchemy import update, or_
+from sqlmodel import Session, select
+from app.config import settings
+from app.database.main import get_engine
+from app.database.models import DBVirtualMachine
+from app.utils.events import publish
+from app.utils.metrics import IDLE_VMS, IDLE_ACTIONS
+from app.utils.vms import get_vm_statuses, vm_status_cache, suspend_vm, stop_vm
+
+# Course VMs are often left running outside class hours. Every IDLE_INTERVAL seconds, each running
+# VM of this node is checked for activity:
+# - CPU: usage above IDLE_CPU_THRESHOLD (a fraction of its cores), from the cluster resources call
+# - Network: more than IDLE_NET_THRESHOLD bytes/s in and out since the previous check
+# - VNC: an established connection to its VNC port, ie: someone is connected through Guacamole.
+#   The backend runs on the Proxmox host (it reads PROXMOX_VM_CONFIG_DIR), so this is read from /proc/net/tcp.
+# VMs with no activity for IDLE_TIMEOUT seconds are hibernated (IDLE_ACTION=suspend) or shut down
+# (IDLE_ACTION=shutdown), freeing their RAM. Their LDAP entry has wol-send-packet=true, so Guacamole
+# wakes them up when their owner connects again. With IDLE_ACTION=none idle VMs are only counted.
+
+# vmid -> (time.monotonic(), netin + netout) as of the previous check, to turn the counters into rates.
+# Only kept by the worker running the check; after a takeover network activity is ignored for one check.
+_net_samples: dict[int, tuple[float, int]] = {}
+
+
+def vnc_connected_ports() -> set[int]:
+    """
+    Local TCP ports with an established connection.
+    """
+    ports = set()
+    for path in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            with open(path) as table:
+                next(table)  # Header
+                for line in table:
+                    fields = line.split()
+                    if fields[3] == "01":  # ESTABLISHED
+                        ports.add(int(fields[1].rsplit(":", 1)[1], 16))
+        except OSError:
+            continue
+    return ports
+
+
+def _net_rate(vmid: int, status: dict) -> float | None:
+    now = time.monotonic()
+    total = status.get("netin", 0) + status.get("netout", 0)
+    previous = _net_samples.get(vmid)
+    _net_samples[vmid] = (now, total)
+    if previous is None or now <= previous[0] or total < previous[1]:  # Counters reset on reboot
+        return None
+    return (total - previous[1]) / (now - previous[0])
+
+
+def is_active(status: dict, vnc_port: int, connected: set[int], net_rate: float | None) -> bool:
+    return (
+        status.get("cpu", 0) >= settings.idle_cpu_threshold
+        or (net_rate is not None and net_rate >= settings.idle_net_threshold)
+        or vnc_port in connected
+    )
+
+
+def find_idle_vms(session: Session) -> list[dict]:
+    """
+    Returns the running VMs of this node that have been idle for IDLE_TIMEOUT seconds,
+    and records the activity of the others.
+    """
+    statuses = get_vm_statuses()
+    connected = vnc_connected_ports()
+    rows = session.exec(
+        select(DBVirtualMachine).where(
+            or_(
+                DBVirtualMachine.node == settings.proxmox_node_name,
+                DBVirtualMachine.node.is_(None),
+            )
+        )
+    ).all()
+    now = datetime.datetime.now(datetime.UTC)
+    cutoff = now - datetime.timedelta(seconds=settings.idle_timeout)
+    active, idle = [], []
+    for row in rows:
+        status = statuses.get(row.vmid)
+        if status is None or status.get("status") != "running":
+            _net_samples.pop(row.vmid, None)
+            continue
+        # port + 5900: the VNC port proxmox listens on, see create_vm_entry()
+        if is_active(status, row.port + 5900, connected, _net_rate(row.vmid, status)):
+            active.append(row.id)
+            continue
+        last_active = row.last_active_at
+        if last_active is None:
+            active.append(row.id)  # First time seen, give it IDLE_TIMEOUT from now
+            continue
+        if last_active.tzinfo is None:  # Naive datetimes, as read back from SQLite, are in UTC
+            last_active = last_active.replace(tzinfo=datetime.UTC)
+        # Uptime restarts when a VM is resumed, so a VM woken up by its owner is not put back to sleep
+        # before they get to use it
+        if last_active <= cutoff and status.get("uptime", 0) >= settings.idle_timeout:
+            idle.append(
+                {"id": row.id, "vmid": row.vmid, "name": row.name, "owner": row.owner, "job_id": row.job_id}
+            )
+    if active:
+        session.exec(
+            update(DBVirtualMachine)
+            .where(DBVirtualMachine.id.in_(active))
+            .values(last_active_at=now)
+        )
+        session.commit()
+    IDLE_VMS.set(len(idle))
+    return idle
+
+
+def check_idle():
+    """
+    Suspends or shuts down the VMs idle for IDLE_TIMEOUT seconds, according to IDLE_ACTION.
+    Run periodically by a single elected worker, see run_periodic().
+    """
+    with Session(get_engine()) as session:
+        idle = find_idle_vms(session)
+    if settings.idle_action == "none":
+        return
+    action = suspend_vm if settings.idle_action == "suspend" else stop_vm
+    for vm in idle:
+        print(
+            f"Virtual machine {vm['vmid']} with name {vm['name']} is idle. proceeding to {settings.idle_action}"
+        )
+        try:
+            action(vm["vmid"])
+        except Exception as e:
+            print(e)
+            IDLE_ACTIONS.labels(settings.idle_action, "failure").inc()
+            continue
+        IDLE_ACTIONS.labels(settings.idle_action, "success").inc()
+        _net_samples.pop(vm["vmid"], None)
+        publish(
+            "vm_suspended",
+            vm["owner"],
+            job_id=vm["job_id"],
+            vm_id=vm["id"],
+            name=vm["name"],
+            action=settings.idle_action,
+        )
+    if idle:
+        vm_status_cache().clear()  # The statuses changed
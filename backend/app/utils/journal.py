@@ -0,0 +1,211 @@
+import os
+import json
+import base64
+import fcntl
+import queue
+import atexit
+import hashlib
+import secrets
+import argparse
+import datetime
+import threading
+from app.config import settings
+
+# Append-only JSONL journal of bulk jobs and per-user provisioning outcomes, one record per line:
+#   {"ts": "2024-08-20T10:00:00+00:00", "event": "user_issued", "job_id": "...", "username": "...", ...}
+# record() only queues the record, a background thread appends the queue to JOURNAL_FILE in batches.
+# Passwords are never written, only a salted scrypt hash of them (see verify_password_hash()).
+# The file is rotated once it reaches JOURNAL_MAX_BYTES, keeping JOURNAL_BACKUPS older files
+# (journal.jsonl.1 being the most recent).
+#
+# Query it from the backend directory with:
+#   python -m app.utils.journal [--username <username>] [--job-id <job_id>] [--event <event>] [--limit 20]
+#   python -m app.utils.journal --username <username> --check-password <password>
+# or through GET /admin/journal.
+
+SECRET_FIELDS = {"password"}
+
+_queue: queue.Queue = queue.Queue()
+_writer: threading.Thread | None = None
+_writer_lock = threading.Lock()
+
+
+def hash_password(password: str) -> str:
+    salt = secrets.token_bytes(16)
+    digest = hashlib.scrypt(password.encode(), salt=salt, n=2**14, r=8, p=1)
+    return "scrypt$" + "$".join(base64.b64encode(part).decode() for part in (salt, digest))
+
+
+def verify_password_hash(password: str, hashed: str) -> bool:
+    _, salt, digest = hashed.split("$")
+    candidate = hashlib.scrypt(password.encode(), salt=base64.b64decode(salt), n=2**14, r=8, p=1)
+    return secrets.compare_digest(candidate, base64.b64decode(digest))
+
+
+def record(event: str, **fields):
+    """
+    Queues a record for the journal and returns right away.
+    """
+    _start_writer()
+    _queue.put(
+        {"ts": datetime.datetime.now(datetime.UTC).isoformat(), "event": event, **fields}
+    )
+
+
+def _start_writer():
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = threading.Thread(target=_run_writer, name="journal-writer", daemon=True)
+                _writer.start()
+
+
+def flush_journal():
+    """
+    Writes out every queued record and stops the writer thread. It is started again by the next record().
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            return
+        _queue.put(None)
+        _writer.join()
+        _writer = None
+
+
+# Registered once, flush_journal() does nothing while the writer is stopped
+atexit.register(flush_journal)
+
+
+def _run_writer():
+    while True:
+        batch = [_queue.get()]
+        # Whatever else queued up meanwhile goes in the same write
+        while batch[-1] is not None and len(batch) < 1000:
+            try:
+                batch.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+        stop = batch[-1] is None
+        records = [entry for entry in batch if entry is not None]
+        if records:
+            try:
+                _append(records)
+            except Exception as e:
+                print(f"Failed to write {len(records)} journal records: {e}")
+        if stop:
+            return
+
+
+def _protect(entry: dict) -> dict:
+    for field in SECRET_FIELDS & entry.keys():
+        entry[f"{field}_hash"] = hash_password(entry.pop(field))
+    return entry
+
+
+def _append(records: list[dict]):
+    data = "".join(
+        json.dumps(_protect(entry), default=str, separators=(",", ":")) + "\n"
+        for entry in records
+    ).encode()
+    path = settings.journal_file
+    # Every API process appends to the same file, the lock keeps rotation and writes from interleaving
+    with open(f"{path}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            size = 0
+        if size and size + len(data) > settings.journal_max_bytes:
+            _rotate(path)
+        with open(path, "ab") as journal:
+            journal.write(data)
+
+
+def _rotate(path: str):
+    for index in range(settings.journal_backups, 0, -1):
+        source = f"{path}.{index - 1}" if index > 1 else path
+        if os.path.exists(source):
+            os.replace(source, f"{path}.{index}")  # Overwrites the oldest one
+    if settings.journal_backups == 0:
+        os.remove(path)
+
+
+def _lines_backwards(path: str, block_size: int = 64 * 1024):
+    """
+    Yields the lines of a file from the last to the first, reading it block by block from the end.
+    """
+    try:
+        journal = open(path, "rb")
+    except FileNotFoundError:
+        return
+    with journal:
+        position = journal.seek(0, os.SEEK_END)
+        rest = b""
+        while position > 0:
+            read_size = min(block_size, position)
+            position -= read_size
+            journal.seek(position)
+            lines = (journal.read(read_size) + rest).split(b"\n")
+            rest = lines.pop(0)  # May be the end of a line that starts in the previous block
+            yield from (line for line in reversed(lines) if line)
+        if rest:
+            yield rest
+
+
+def find_records(
+    username: str | None = None,
+    job_id: str | None = None,
+    event: str | None = None,
+    limit: int = 20,
+) -> list[dict]:
+    """
+    Returns the most recent records matching every given filter, newest first.
+    Files are read backwards from the end and reading stops at limit matches,
+    so recent records are found without going through the whole journal.
+    """
+    filters = {"username": username, "job_id": job_id, "event": event}
+    filters = {key: value for key, value in filters.items() if value is not None}
+    # Cheap substring check before parsing, most lines are skipped without decoding them
+    needles = [json.dumps(value).encode() for value in filters.values()]
+    path = settings.journal_file
+    found = []
+    for name in [path] + [f"{path}.{index}" for index in range(1, settings.journal_backups + 1)]:
+        for line in _lines_backwards(name):
+            if not all(needle in line for needle in needles):
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # Partly written line
+            if all(entry.get(key) == value for key, value in filters.items()):
+                found.append(entry)
+                if len(found) >= limit:
+                    return found
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search the bulk job journal, newest records first.")
+    parser.add_argument("--username")
+    parser.add_argument("--job-id")
+    parser.add_argument("--event")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument(
+        "--check-password",
+        metavar="PASSWORD",
+        help="Tell whether this is the password issued to --username",
+    )
+    args = parser.parse_args()
+    if args.check_password is not None:
+        if not args.username:
+            parser.error("--check-password needs --username")
+        issued = find_records(username=args.username, event="user_issued", limit=1)
+        if not issued:
+            raise SystemExit(f"No password was issued to {args.username}")
+        matches = verify_password_hash(args.check_password, issued[0]["password_hash"])
+        print("match" if matches else "no match")
+        raise SystemExit(0 if matches else 1)
+    for entry in find_records(args.username, args.job_id, args.event, args.limit):
+        print(json.dumps(entry))
@@ -0,0 +1,180 @@
+import os
+import time
+import functools
+from typing import Callable
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app.utils.tracing import start_span
+
+# Every uvicorn worker process has its own metrics. To serve the metrics of all of them on /metrics
+# (prometheus_client multiprocess mode), set PROMETHEUS_MULTIPROC_DIR in the environment uvicorn is
+# started with, to an empty directory the workers can write to. Without it, /metrics only shows the
+# metrics of the worker that answered the scrape, so run a single worker.
+# Each gauge says how the values of the workers are combined: the ones set by a periodic task or an
+# allocation are current in the worker that set them last ("mostrecent"), the others are summed over
+# the live workers ("livesum").
+
+BACKEND_CALL_SECONDS = Histogram(
+    "webvirt_backend_call_seconds",
+    "Time spent in calls to Proxmox, LDAP, the VM config dir and the database",
+    ["backend", "operation"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+BACKEND_CALL_ERRORS = Counter(
+    "webvirt_backend_call_errors_total",
+    "Calls to a backend that raised an exception",
+    ["backend", "operation"],
+)
+PROVISIONING = Counter(
+    "webvirt_provisioning_total",
+    "VM provisioning attempts by outcome",
+    ["outcome"],
+)
+PROVISIONING_RETRIES = Counter(
+    "webvirt_provisioning_retries_total",
+    "Provisioning steps retried after a transient Proxmox or LDAP error",
+    ["step"],
+)
+COMPENSATIONS = Counter(
+    "webvirt_provisioning_compensations_total",
+    "Provisioning steps undone after a later step failed, by outcome",
+    ["step", "outcome"],
+)
+TEARDOWN = Counter(
+    "webvirt_teardown_total",
+    "Expired VM teardowns by outcome",
+    ["outcome"],
+)
+EXPIRY_BACKLOG = Gauge(
+    "webvirt_expiry_backlog",
+    "Expired VMs found by the last expiry sweep",
+    multiprocess_mode="mostrecent",
+)
+BULK_JOBS_RUNNING = Gauge(
+    "webvirt_bulk_jobs_running",
+    "Bulk (CSV) creation jobs currently running",
+    multiprocess_mode="livesum",
+)
+ALLOCATED = Gauge(
+    "webvirt_allocated",
+    "VM ids and VNC ports in use, as seen by the last allocation",
+    ["pool"],
+    multiprocess_mode="mostrecent",
+)
+
+RECONCILE_DRIFT = Gauge(
+    "webvirt_reconcile_drift",
+    "VMs out of sync between Proxmox, LDAP and the database, as found by the last reconciliation",
+    ["kind"],
+    multiprocess_mode="mostrecent",
+)
+RECONCILE_REPAIRS = Counter(
+    "webvirt_reconcile_repairs_total",
+    "Repairs attempted by the reconciler by kind and outcome",
+    ["kind", "outcome"],
+)
+IDLE_VMS = Gauge(
+    "webvirt_idle_vms",
+    "Running VMs idle for longer than IDLE_TIMEOUT, as found by the last check",
+    multiprocess_mode="mostrecent",
+)
+IDLE_ACTIONS = Counter(
+    "webvirt_idle_actions_total",
+    "Idle VMs suspended or shut down by outcome",
+    ["action", "outcome"],
+)
+PREBOOTS = Counter(
+    "webvirt_preboots_total",
+    "VMs started ahead of their class by outcome",
+    ["outcome"],
+)
+COHORT_OPERATIONS = Counter(
+    "webvirt_cohort_operations_total",
+    "VMs changed by cohort operations (extend, resize, stop, delete) by outcome",
+    ["operation", "outcome"],
+)
+
+def latest_metrics() -> bytes:
+    """
+    Returns the metrics in the Prometheus text format, of all the workers in multiprocess mode.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return generate_latest()
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+
+def mark_worker_stopped():
+    """
+    Drops the live gauges of this worker in multiprocess mode, so they no longer count once it exits.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+def instrument(backend: str, operation: str | None = None) -> Callable:
+    """
+    Records the duration of every call to the decorated function, and counts the ones that raise.
+    operation defaults to the function name.
+    Calls made inside a trace also get a span of their own.
+    """
+
+    def decorator(func: Callable) -> Callable:
+        histogram = BACKEND_CALL_SECONDS.labels(backend, operation or func.__name__)
+        errors = BACKEND_CALL_ERRORS.labels(backend, operation or func.__name__)
+
+        span_name = f"{backend}.{operation or func.__name__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                with start_span(span_name):
+                    return func(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def _statement_type(statement: str | None) -> str:
+    return statement.split(None, 1)[0].upper() if statement and statement.strip() else "UNKNOWN"
+
+
+# Database queries are timed through SQLAlchemy's cursor events, labelled by statement type
+# (SELECT, INSERT, ...) to keep the label set small. Listening on the Engine class covers
+# the engine whenever it gets created.
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info["query_start_time"].pop()
+    BACKEND_CALL_SECONDS.labels("db", _statement_type(statement)).observe(
+        time.perf_counter() - start
+    )
+
+
+@event.listens_for(Engine, "handle_error")
+def _count_query_error(exception_context):
+    BACKEND_CALL_ERRORS.labels("db", _statement_type(exception_context.statement)).inc()
+    if exception_context.connection is not None:
+        timers = exception_context.connection.info.get("query_start_time")
+        if timers:
+            timers.pop()
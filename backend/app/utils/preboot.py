@@ -0,0 +1,151 @@
+import math
+import time
+import datetime
+from sqlalchemy import update
+from sqlmodel import Session
+from app.config import settings
+from app.database.main import get_engine
+from app.database.models import DBVirtualMachine, DBJob
+from app.utils.cohorts import select_cohort
+from app.utils.events import publish
+from app.utils.metrics import PREBOOTS
+from app.utils.exceptions import PrebootScheduleException, JobDeferredException
+from app.utils.workers import enqueue_job, job_handler
+from app.utils.vms import get_vm_statuses, vm_status_cache, start_vm, task_finished
+
+# Guacamole wakes a VM up with Wake-on-LAN when its owner connects, so when a class starts the whole
+# cohort cold boots within the same minute and the storage cannot keep up. Instead, the cohort can be
+# booted ahead of the course start time in waves of PREBOOT_WAVE_SIZE VMs, PREBOOT_WAVE_INTERVAL seconds
+# apart, so that every VM is up PREBOOT_MARGIN seconds before the class connects.
+# The boot is a "preboot" job scheduled to run at:
+#   start_at - (number of waves * PREBOOT_WAVE_INTERVAL + PREBOOT_MARGIN)
+# so start_at must be at least that far away. The preboot of a bulk job waits for the bulk job to be over.
+
+
+def lead_time(vm_count: int) -> datetime.timedelta:
+    waves = math.ceil(vm_count / settings.preboot_wave_size)
+    return datetime.timedelta(
+        seconds=waves * settings.preboot_wave_interval + settings.preboot_margin
+    )
+
+
+def check_start_at(start_at: datetime.datetime, vm_count: int) -> datetime.datetime:
+    """
+    Returns when the boot of vm_count VMs must begin for a class starting at start_at (naive datetimes are in UTC).
+    Raises PrebootScheduleException if that time has already passed.
+    """
+    if start_at.tzinfo is None:
+        start_at = start_at.replace(tzinfo=datetime.UTC)
+    lead = lead_time(vm_count)
+    if start_at - lead < datetime.datetime.now(datetime.UTC):
+        raise PrebootScheduleException(
+            f"Booting {vm_count} VMs takes {math.ceil(lead.total_seconds())} seconds, start_at must be at least that far away"
+        )
+    return start_at - lead
+
+
+def _cohort_size(session: Session, job_id: str | None, prefix: str | None) -> int:
+    size = len(select_cohort(session, job_id, prefix))
+    if job_id is not None:
+        bulk_job = session.get(DBJob, job_id)
+        if bulk_job is not None and bulk_job.payload:  # Not created yet, or only partly
+            size = max(size, len(bulk_job.payload.get("users", [])))
+    return size
+
+
+def schedule_preboot(
+    session: Session, job_id: str | None, prefix: str | None, start_at: datetime.datetime
+) -> dict:
+    """
+    Queues the boot of a cohort (see select_cohort()) ahead of start_at. Committed with the caller's session.
+    Raises PrebootScheduleException if start_at is too close, see check_start_at().
+    """
+    if start_at.tzinfo is None:
+        start_at = start_at.replace(tzinfo=datetime.UTC)
+    size = _cohort_size(session, job_id, prefix)
+    boot_at = check_start_at(start_at, size)
+    job = enqueue_job(
+        session,
+        "preboot",
+        {"job_id": job_id, "prefix": prefix, "start_at": start_at.isoformat()},
+        run_after=boot_at,
+    )
+    return {
+        "preboot_job_id": job.id,
+        "vms": size,
+        "waves": math.ceil(size / settings.preboot_wave_size),
+        "boot_at": boot_at,
+    }
+
+
+def _wait_for_tasks(upids: list[str]):
+    deadline = time.monotonic() + settings.preboot_task_timeout
+    while upids and time.monotonic() < deadline:
+        upids = [upid for upid in upids if not task_finished(upid)]
+        if upids:
+            time.sleep(1)
+
+
+@job_handler("preboot")
+def preboot_job(payload: dict) -> dict:
+    if payload["job_id"] is not None:
+        with Session(get_engine()) as session:
+            bulk_job = session.get(DBJob, payload["job_id"])
+            if bulk_job is not None and bulk_job.status in ("queued", "running"):
+                # Its VMs are still being created, boot them once they all exist
+                raise JobDeferredException(
+                    datetime.datetime.now(datetime.UTC)
+                    + datetime.timedelta(seconds=settings.preboot_wave_interval)
+                )
+    return preboot_cohort(
+        payload["job_id"], payload["prefix"], datetime.datetime.fromisoformat(payload["start_at"])
+    )
+
+
+def preboot_cohort(job_id: str | None, prefix: str | None, start_at: datetime.datetime) -> dict:
+    """
+    Starts the stopped VMs of a cohort in waves. Safe to run again, running VMs are skipped.
+    """
+    vm_status_cache().clear()  # Fresh statuses, VMs may have been stopped since the last read
+    statuses = get_vm_statuses()
+    with Session(get_engine()) as session:
+        vms = [
+            (vm.id, vm.vmid, vm.name, vm.owner, vm.job_id)
+            for vm in select_cohort(session, job_id, prefix)
+        ]
+    stopped = [vm for vm in vms if statuses.get(vm[1], {}).get("status") != "running"]
+    started, failed = [], []
+    for first in range(0, len(stopped), settings.preboot_wave_size):
+        if first:
+            time.sleep(settings.preboot_wave_interval)  # Let the previous wave finish booting
+        wave = stopped[first : first + settings.preboot_wave_size]
+        upids = []
+        for vm in wave:
+            try:
+                upids.append(start_vm(vm[1]))
+            except Exception as e:
+                print(f"Failed to start VM {vm[1]} ahead of its class: {e}")
+                PREBOOTS.labels("failure").inc()
+                failed.append({"vmid": vm[1], "name": vm[2], "owner": vm[3], "error": str(e)})
+                continue
+            PREBOOTS.labels("success").inc()
+            started.append(vm)
+        _wait_for_tasks([upid for upid in upids if upid])
+
+    if started:
+        with Session(get_engine()) as session:
+            # Counted as in use until the class starts, so the idle check leaves them running
+            session.exec(
+                update(DBVirtualMachine)
+                .where(DBVirtualMachine.id.in_([vm[0] for vm in started]))
+                .values(last_active_at=start_at)
+            )
+            for vm_id, _, name, owner, vm_job_id in started:
+                publish("vm_started", owner, session=session, job_id=vm_job_id, vm_id=vm_id, name=name)
+            session.commit()
+        vm_status_cache().clear()
+    return {
+        "started": len(started),
+        "already_running": len(vms) - len(stopped),
+        "failed": failed,
+    }
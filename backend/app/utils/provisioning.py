@@ -0,0 +1,296 @@
+import time
+import random
+import datetime
+from typing import Callable
+import ldap
+from sqlmodel import Session
+from app.config import settings
+from app.database.models import DBVirtualMachine
+from app.models.vms import VirtualMachine
+from app.utils.etag import bump_revision
+from app.utils.metrics import PROVISIONING, PROVISIONING_RETRIES, COMPENSATIONS
+from app.utils.tracing import start_trace, start_span
+from app.utils.journal import record
+from app.utils.events import publish
+from app.utils.vms import (
+    create_vm,
+    new_free_id,
+    expose_vnc_port,
+    vnc_port_taken,
+    get_vm_mac_addr,
+    read_vm_config,
+    destroy_vm,
+)
+from app.ldap.main import (
+    get_user,
+    create_user,
+    set_password,
+    delete_user,
+    generate_unique_uid,
+    uid_number_taken,
+    create_vm_entry,
+    delete_vm_entry,
+    reset_conn,
+)
+from app.utils.exceptions import (
+    ProxmoxUnavailableException,
+    VMCreationException,
+    VMProvisioningException,
+)
+
+# A VM is provisioned in steps: LDAP user (bulk creation only), proxmox VM, VNC port,
+# LDAP VM entry and database row.
+# - Every step can be repeated safely, it first checks whether an earlier attempt already did it.
+# - Transient errors (proxmox lock timeouts, network errors, LDAP server unavailable) are retried
+#   with exponential backoff and full jitter, so that provisionings contending for the same
+#   proxmox lock do not retry in lockstep.
+# - When a step fails for good, the steps done so far are undone in reverse order, so the VM id,
+#   port and LDAP entries are released right away. Whatever cannot be undone is left to the reconciler.
+
+TRANSIENT_ERRORS = (
+    ProxmoxUnavailableException,
+    ldap.SERVER_DOWN,
+    ldap.TIMEOUT,
+    ldap.BUSY,
+    ldap.UNAVAILABLE,
+)
+
+
+class _VMIdTaken(Exception):
+    """
+    Another provisioning created a VM with the id we picked in the meantime. Retried with a new id.
+    """
+
+
+class _PortTaken(Exception):
+    """
+    Another provisioning exposed a VM on the VNC port we picked in the meantime. Retried with a new port.
+    """
+
+
+class _UidTaken(Exception):
+    """
+    Another provisioning created a user with the uidNumber we picked in the meantime,
+    they would own each other's files. Retried with a new uidNumber.
+    """
+
+
+def with_retries(step: str, func: Callable, *args, **kwargs):
+    """
+    Calls func, retrying up to PROVISION_RETRIES times on transient errors.
+    """
+    for attempt in range(settings.provision_retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except (*TRANSIENT_ERRORS, _VMIdTaken, _PortTaken, _UidTaken) as e:
+            if attempt == settings.provision_retries:
+                raise
+            if isinstance(e, ldap.SERVER_DOWN):
+                reset_conn()
+            PROVISIONING_RETRIES.labels(step).inc()
+            delay = min(
+                settings.provision_retry_max_delay,
+                settings.provision_retry_delay * 2**attempt,
+            )
+            print(f"Provisioning step {step} failed ({e!r}), retrying")
+            time.sleep(random.uniform(0, delay))
+
+
+def _ensure_user(
+    username: str, first_name: str, last_name: str, password: str, homedir_prefix: str
+) -> bool:
+    """
+    Creates the LDAP user unless it exists. Returns whether it was created.
+    """
+    if get_user(username) is not None:
+        return False  # Created by an earlier run of the same bulk job
+    uid_number = None
+    attempts = 0
+
+    def attempt():
+        nonlocal attempts, uid_number
+        attempts += 1
+        if uid_number is None:
+            uid_number = generate_unique_uid()
+        try:
+            create_user(first_name, last_name, username, uid_number, password, homedir_prefix)
+        except ldap.ALREADY_EXISTS:
+            if attempts == 1:
+                raise
+            # Added by the previous attempt, which failed before setting the password
+            set_password(username, password)
+        # Checked after the user is added: of two users created with the same uidNumber at once,
+        # at least the one added last sees the other one
+        if uid_number_taken(uid_number, username):
+            delete_user(username)
+            taken, uid_number = uid_number, None
+            raise _UidTaken(f"uidNumber {taken} was taken meanwhile")
+
+    with_retries("ldap_user", attempt)
+    return True
+
+
+def _create_vm(vm: VirtualMachine) -> int:
+    vmid = None
+
+    def attempt() -> int:
+        nonlocal vmid
+        if vmid is not None:
+            config = read_vm_config(vmid)
+            if config is not None and config.get("name") == vm.name:
+                return vmid  # The previous attempt went through despite the error
+            if config is not None:
+                vmid = None
+        if vmid is None:
+            vmid = new_free_id()
+        try:
+            create_vm(id=vmid, name=vm.name, core_count=vm.core_count, memory=vm.memory)
+        except VMCreationException:
+            config = read_vm_config(vmid)
+            if config is not None and config.get("name") != vm.name:
+                raise _VMIdTaken(f"VM id {vmid} was taken meanwhile")
+            raise
+        return vmid
+
+    return with_retries("vm", attempt)
+
+
+def _expose_vnc(vmid: int) -> int:
+    args = (read_vm_config(vmid) or {}).get("args", "")
+    if "-vnc" in args and not vnc_port_taken(vmid, int(args.split(":")[-1])):
+        return int(args.split(":")[-1])  # Exposed by an earlier attempt
+    port = expose_vnc_port(vmid)
+    # Like for uidNumbers, of two VMs exposed on the same port at once the one written last sees the other one
+    if vnc_port_taken(vmid, port):
+        raise _PortTaken(f"VNC port {port} was taken meanwhile")
+    return port
+
+
+def _create_vm_entry(vm: VirtualMachine, owner: str, port: int, mac_addr: str):
+    attempts = 0
+
+    def attempt():
+        nonlocal attempts
+        attempts += 1
+        try:
+            create_vm_entry(vm, owner, port=port, mac_addr=mac_addr)
+        except ldap.ALREADY_EXISTS:
+            if attempts == 1:
+                raise  # A VM of the same name exists already
+            # Otherwise added by the previous attempt
+
+    with_retries("ldap_vm", attempt)
+
+
+def _delete_vm_entry(name: str):
+    try:
+        delete_vm_entry(name)
+    except ldap.NO_SUCH_OBJECT:
+        pass
+
+
+def _compensate(compensations: list[tuple[str, Callable[[], None]]]):
+    for step, undo in reversed(compensations):
+        with start_span(f"compensate.{step}"):
+            try:
+                with_retries(f"compensate.{step}", undo)
+            except Exception as e:
+                print(f"Failed to undo provisioning step {step}, left to the reconciler: {e}")
+                COMPENSATIONS.labels(step, "failure").inc()
+            else:
+                COMPENSATIONS.labels(step, "success").inc()
+
+
+def provision_vm(
+    session: Session,
+    vm: VirtualMachine,
+    owner: str,
+    expiry: datetime.datetime,
+    job_id: str | None = None,
+    new_user: tuple[str, str, str, str] | None = None,
+    **trace_attributes,
+) -> DBVirtualMachine:
+    """
+    Creates a VM for owner in proxmox, LDAP and the database, undoing the steps done so far if
+    one of them fails for good. Raises VMProvisioningException in that case.
+    new_user: (first_name, last_name, password, homedir_prefix) to also create owner's LDAP account,
+        as bulk creation does.
+    """
+    compensations: list[tuple[str, Callable[[], None]]] = []
+    with start_trace(
+        "provision_vm", owner=owner, node=settings.proxmox_node_name, job_id=job_id, **trace_attributes
+    ) as trace:
+        try:
+            if new_user is not None:
+                with start_span("step.ldap_user"):
+                    if _ensure_user(owner, *new_user):
+                        compensations.append(("ldap_user", lambda: delete_user(owner)))
+
+            with start_span("step.vm"):
+                vmid = _create_vm(vm)
+            trace.set_attribute("vmid", vmid)
+            compensations.append(("vm", lambda: destroy_vm(vmid)))
+            publish("vm_created", owner, job_id=job_id, name=vm.name, vmid=vmid)
+
+            with start_span("step.vnc"):
+                port = with_retries("vnc", _expose_vnc, vmid)
+            trace.set_attribute("port", port)
+            publish("port_exposed", owner, job_id=job_id, name=vm.name, vmid=vmid, port=port)
+            mac_addr = with_retries("mac_addr", get_vm_mac_addr, vmid)
+
+            with start_span("step.ldap_vm"):
+                # port + 5900: The real port where proxmox listens for VNC clients is at 5900+<selected_num>
+                # This needs to be the entry in LDAP so that guacamole connects to the correct port
+                _create_vm_entry(vm, owner, port + 5900, mac_addr)
+            compensations.append(("ldap_vm", lambda: _delete_vm_entry(vm.name)))
+
+            # Add an entry to the db for future queries. LDAP query and data parsing is unnecessarily complicated
+            vm_db_entry = DBVirtualMachine(
+                vmid=vmid,
+                name=vm.name,
+                core_count=vm.core_count,
+                memory=vm.memory,
+                port=port,
+                owner=owner,
+                node=settings.proxmox_node_name,
+                job_id=job_id,
+                prefix=new_user[3] if new_user is not None else None,
+                expiry=expiry,
+            )
+            with start_span("db.commit"):
+                session.add(vm_db_entry)
+                session.flush()  # Assigns the id sent with the event
+                bump_revision(session, owner)
+                publish(
+                    "vm_ready",
+                    owner,
+                    session=session,
+                    job_id=job_id,
+                    vm_id=vm_db_entry.id,
+                    name=vm.name,
+                    vmid=vmid,
+                    port=port,
+                    expiry=expiry,
+                )
+                session.commit()
+        except Exception as e:
+            session.rollback()
+            print(f"VM creation failed: {e!r}, undoing {len(compensations)} steps")
+            PROVISIONING.labels("failure").inc()
+            trace.status = "ERROR"
+            trace.set_attribute("exception", repr(e))
+            _compensate(compensations)
+            record("vm_failed", job_id=job_id, username=owner, name=vm.name, error=repr(e))
+            publish("vm_failed", owner, job_id=job_id, name=vm.name, error=str(e))
+            raise VMProvisioningException(f"VM creation failed: {e}") from e
+    PROVISIONING.labels("success").inc()
+    record(
+        "vm_provisioned",
+        job_id=job_id,
+        username=owner,
+        name=vm.name,
+        vmid=vmid,
+        port=port,
+        expiry=expiry,
+    )
+    return vm_db_entry
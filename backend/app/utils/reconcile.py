@@ -0,0 +1,257 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from ldap import NO_SUCH_OBJECT
+from ldap.dn import str2dn
+from sqlalchemy import delete, or_
+from sqlmodel import Session, select
+from app.config import settings
+from app.database.main import get_engine
+from app.database.models import DBVirtualMachine
+from app.models.vms import VirtualMachine
+from app.utils.etag import bump_revision
+from app.utils.metrics import RECONCILE_DRIFT, RECONCILE_REPAIRS
+from app.utils.vms import list_vms, get_vm_mac_addr, destroy_vm
+from app.ldap.main import get_all_vm_entries, create_vm_entry, delete_vm_entry
+
+# A VM lives in three places: Proxmox, a guacConfigGroup entry in LDAP and a row in the database.
+# A provisioning or deletion that fails halfway leaves it in only some of them. The reconciler
+# takes one snapshot of each (one table scan, one paged LDAP search, one cluster resources call),
+# compares them in memory and finds:
+# - missing_vm: rows whose Proxmox VM is gone. Repaired by deleting the row and the LDAP entry.
+# - missing_ldap: rows whose VM exists but has no LDAP entry, so the user cannot reach it.
+#   Repaired by recreating the entry.
+# - orphan_ldap: LDAP entries with neither a VM nor a row. Repaired by deleting the entry.
+# - orphan_vm: Proxmox VMs with no row. They hold RAM, an id and a port and never expire.
+#   Only deleted with RECONCILE_DELETE_ORPHAN_VMS, since the node may host VMs not created here.
+#
+# VMs are written to Proxmox, then LDAP, then the database, and deleted in that same order.
+# Snapshots are taken in the reverse order, so that a provisioning or deletion running meanwhile
+# never shows up as drift. The exception is a VM being created, which may be in Proxmox without
+# a row yet; orphan VMs are left alone until their config is RECONCILE_GRACE_PERIOD seconds old.
+#
+# A partial Proxmox listing (missing permissions, a node or cluster hiccup) looks like every VM is gone.
+# Nothing is repaired when too many rows are missing_vm, see repair_refusal().
+
+DRIFT_KINDS = ["missing_vm", "missing_ldap", "orphan_ldap", "orphan_vm"]
+
+
+def _parse_vm_entry(entry: tuple) -> dict:
+    dn, attrs = entry
+    params = dict(
+        param.decode().split("=", 1)
+        for param in attrs.get("guacConfigParameter", [])
+        if b"=" in param
+    )
+    members = [
+        member.decode().split(",", 1)[0].removeprefix("uid=")
+        for member in attrs.get("member", [])
+    ]
+    return {
+        "name": str2dn(dn)[0][0][1],  # The cn of the DN, it is not always returned as an attribute
+        "hostname": params.get("hostname"),
+        "port": int(params["port"]) if params.get("port", "").isdigit() else None,
+        "owners": [member for member in members if member != "trcadmin"],
+    }
+
+
+def _config_age(vmid: int) -> float | None:
+    try:
+        mtime = os.stat(os.path.join(settings.proxmox_vm_config_dir, f"{vmid}.conf")).st_mtime
+    except OSError:
+        return None
+    return time.time() - mtime
+
+
+def take_snapshots() -> tuple[list[DBVirtualMachine], list[dict], list[dict]]:
+    """
+    Returns the VMs of this node as seen by the database, LDAP and Proxmox, in that order.
+    """
+    with Session(get_engine()) as session:
+        rows = session.exec(
+            select(DBVirtualMachine).where(
+                or_(
+                    DBVirtualMachine.node == settings.proxmox_node_name,
+                    DBVirtualMachine.node.is_(None),  # Created before the node was recorded
+                )
+            )
+        ).all()
+    entries = [_parse_vm_entry(entry) for entry in get_all_vm_entries()]
+    vms = [
+        vm
+        for vm in list_vms()
+        if vm.get("node") == settings.proxmox_node_name
+        and vm.get("type", "qemu") == "qemu"
+        and not vm.get("template")
+    ]
+    return rows, entries, vms
+
+
+def find_drift(rows: list[DBVirtualMachine], entries: list[dict], vms: list[dict]) -> dict:
+    """
+    Compares the snapshots. Returns the out of sync VMs of each kind in DRIFT_KINDS.
+    """
+    vms_by_id = {vm["vmid"]: vm for vm in vms}
+    entry_names = {entry["name"] for entry in entries}
+    row_names = {row.name for row in rows}
+    tracked = set()  # vmids with a matching row
+    drift = {kind: [] for kind in DRIFT_KINDS}
+
+    for row in rows:
+        vm = vms_by_id.get(row.vmid)
+        item = {"id": row.id, "vmid": row.vmid, "name": row.name, "owner": row.owner}
+        # The name is compared too, the vmid of a VM deleted outside of WebVirt can be reused
+        if vm is None or vm.get("name") != row.name:
+            drift["missing_vm"].append({**item, "ldap_entry": row.name in entry_names})
+            continue
+        tracked.add(row.vmid)
+        if row.name not in entry_names:
+            drift["missing_ldap"].append(
+                {**item, "core_count": row.core_count, "memory": row.memory, "port": row.port}
+            )
+
+    vm_names = {vm.get("name") for vm in vms}
+    for entry in entries:
+        # Only entries pointing to the VNC host were created by WebVirt, leave any other one alone
+        if entry["hostname"] != settings.vnc_hostname:
+            continue
+        if entry["name"] not in vm_names and entry["name"] not in row_names:
+            drift["orphan_ldap"].append({"name": entry["name"], "owners": entry["owners"]})
+
+    for vm in vms:
+        if vm["vmid"] in tracked:
+            continue
+        age = _config_age(vm["vmid"])
+        drift["orphan_vm"].append(
+            {
+                "vmid": vm["vmid"],
+                "name": vm.get("name"),
+                "status": vm.get("status"),
+                "ldap_entry": vm.get("name") in entry_names,
+                "settled": age is not None and age >= settings.reconcile_grace_period,
+            }
+        )
+    return drift
+
+
+def repair_refusal(rows: list[DBVirtualMachine], vms: list[dict], drift: dict) -> str | None:
+    """
+    The reason not to repair the drift, if the Proxmox snapshot does not look trustworthy.
+    """
+    missing = len(drift["missing_vm"])
+    if rows and not vms:
+        return f"Proxmox lists no VM on node {settings.proxmox_node_name}, but the database has {len(rows)}"
+    if missing > 1 and missing > settings.reconcile_max_missing_fraction * len(rows):
+        return (
+            f"{missing} of {len(rows)} database entries have no Proxmox VM, "
+            f"more than RECONCILE_MAX_MISSING_FRACTION ({settings.reconcile_max_missing_fraction})"
+        )
+    return None
+
+
+def _delete_entry(name: str):
+    try:
+        delete_vm_entry(name)
+    except NO_SUCH_OBJECT:
+        pass  # Already gone, eg: removed by a deletion running meanwhile
+
+
+def _repair(kind: str, item: dict):
+    if kind in ("missing_vm", "orphan_ldap"):
+        if kind == "orphan_ldap" or item["ldap_entry"]:
+            _delete_entry(item["name"])
+    elif kind == "missing_ldap":
+        vm = VirtualMachine(
+            name=item["name"], core_count=item["core_count"], memory=item["memory"], duration=None
+        )
+        mac_addr = get_vm_mac_addr(item["vmid"])
+        create_vm_entry(vm, item["owner"], port=item["port"] + 5900, mac_addr=mac_addr)
+    elif kind == "orphan_vm":
+        destroy_vm(item["vmid"])
+        if item["ldap_entry"]:
+            _delete_entry(item["name"])
+
+
+def _repairable(kind: str, item: dict) -> bool:
+    if kind == "orphan_vm":
+        return settings.reconcile_delete_orphan_vms and item["settled"]
+    return True
+
+
+def repair_drift(drift: dict) -> dict:
+    """
+    Repairs the drift found by find_drift(), running up to RECONCILE_WORKERS repairs at once.
+    Returns the number of repaired VMs of each kind and the repairs that failed.
+    """
+    tasks = [
+        (kind, item) for kind in DRIFT_KINDS for item in drift[kind] if _repairable(kind, item)
+    ]
+
+    def run(task: tuple[str, dict]) -> str | None:
+        kind, item = task
+        try:
+            _repair(kind, item)
+        except Exception as e:
+            print(f"Failed to repair {kind} {item.get('name')}: {e}")
+            RECONCILE_REPAIRS.labels(kind, "failure").inc()
+            return str(e)
+        RECONCILE_REPAIRS.labels(kind, "success").inc()
+        return None
+
+    with ThreadPoolExecutor(max_workers=settings.reconcile_workers) as executor:
+        errors = list(executor.map(run, tasks))
+
+    repaired = {kind: 0 for kind in DRIFT_KINDS}
+    failed = []
+    removed_rows = []
+    for (kind, item), error in zip(tasks, errors):
+        if error is not None:
+            failed.append({"kind": kind, "name": item.get("name"), "error": error})
+            continue
+        repaired[kind] += 1
+        if kind == "missing_vm":
+            removed_rows.append(item)
+
+    if removed_rows:  # Rows of VMs that are gone are deleted together, once LDAP is cleaned up
+        with Session(get_engine()) as session:
+            session.exec(
+                delete(DBVirtualMachine).where(
+                    DBVirtualMachine.id.in_([item["id"] for item in removed_rows])
+                )
+            )
+            for owner in {item["owner"] for item in removed_rows}:
+                bump_revision(session, owner)
+            session.commit()
+    return {"repaired": repaired, "failed": failed}
+
+
+def reconcile(repair: bool = False) -> dict:
+    """
+    Finds the VMs that are out of sync between Proxmox, LDAP and the database, and repairs them if asked to.
+    """
+    rows, entries, vms = take_snapshots()
+    drift = find_drift(rows, entries, vms)
+    for kind in DRIFT_KINDS:
+        RECONCILE_DRIFT.labels(kind).set(len(drift[kind]))
+    report = {"drift": drift}
+    if repair:
+        refusal = repair_refusal(rows, vms, drift)
+        if refusal is not None:
+            report["refused"] = refusal
+        else:
+            report.update(repair_drift(drift))
+    return report
+
+
+def scheduled_reconcile():
+    """
+    Run periodically by a single elected worker, see run_periodic().
+    """
+    report = reconcile(repair=settings.reconcile_repair)
+    found = {kind: len(items) for kind, items in report["drift"].items() if items}
+    if found:
+        print(f"Reconciliation found VMs out of sync: {found}")
+    if report.get("refused"):
+        print(f"Reconciliation did not repair anything: {report['refused']}")
+    if report.get("failed"):
+        print(f"Reconciliation failed to repair {len(report['failed'])} VMs")
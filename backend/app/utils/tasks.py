@@ -1,59 +1,142 @@
-import asyncio
 import datetime
 from sqlmodel import select
-from ldap import INVALID_CREDENTIALS
 from app.database.main import get_session
 from app.database.models import DBVirtualMachine
+from app.utils.etag import bump_revision
+from app.utils.metrics import TEARDOWN, EXPIRY_BACKLOG, BULK_JOBS_RUNNING
+from app.utils.provisioning import provision_vm
+from app.utils.workers import job_handler
+from app.utils.journal import record
+from app.utils.events import publish
+from app.config import settings
 from app.models.vms import VirtualMachine
-from app.utils.vms import stop_vm
-from app.utils.vms import (
-    create_vm,
-    new_free_port,
-    expose_vnc_port,
-    get_vm_mac_addr,
-    delete_vm,
-    new_free_id,
-)
-from app.ldap.main import (
-    delete_vm_entry,
-    create_vm_entry,
-    create_user,
-    generate_unique_uid,
-)
-from app.utils.exceptions import VMCreationException, VMPortExposeException
+from app.utils.vms import destroy_vm
+from app.ldap.main import delete_vm_entry
+from app.utils.exceptions import VMProvisioningException
 
 
-async def check_expiry():
-    while True:
-        session = next(get_session())
-        current_time = datetime.datetime.now(datetime.UTC)
-        statement = select(DBVirtualMachine).where(
-            DBVirtualMachine.expiry
-            <= current_time  # Check if current time is after or at expiry
-        )
-        expiring_entries = (session.exec(statement)).all()
+def check_expiry():
+    """
+    Stops and deletes every expired VM. Run periodically by a single elected worker, see run_periodic().
+    """
+    session = next(get_session())
+    current_time = datetime.datetime.now(datetime.UTC)
+    statement = select(DBVirtualMachine).where(
+        DBVirtualMachine.expiry
+        <= current_time  # Check if current time is after or at expiry
+    )
+    expiring_entries = (session.exec(statement)).all()
+    EXPIRY_BACKLOG.set(len(expiring_entries))
+    warn_expiring(session, current_time)
 
-        for entry in expiring_entries:
-            print(
-                f"Virtual machine {entry.id} with name {entry.name} expired. proceeding to delete"
+    for entry in expiring_entries:
+        print(
+            f"Virtual machine {entry.id} with name {entry.name} expired. proceeding to delete"
+        )
+        try:
+            destroy_vm(entry.vmid)
+            delete_vm_entry(entry.name)
+            session.delete(entry)
+            bump_revision(session, entry.owner)
+            publish(
+                "vm_deleted",
+                entry.owner,
+                session=session,
+                job_id=entry.job_id,
+                vm_id=entry.id,
+                name=entry.name,
+                reason="expired",
             )
-            try:
-                stop_vm(entry.vmid)
-                delete_vm(entry.vmid)
-                delete_vm_entry(entry.name)
-                session.delete(entry)
-            except Exception as e:
-                print(e)
-            finally:
-                session.commit()
-        await asyncio.sleep(60)
+            TEARDOWN.labels("success").inc()
+        except Exception as e:
+            print(e)
+            TEARDOWN.labels("failure").inc()
+        finally:
+            session.commit()
+
+
+def warn_expiring(session, current_time: datetime.datetime):
+    """
+    Sends a vm_expiring event for the VMs expiring within EXPIRY_WARNING seconds, once per VM
+    until its expiry is pushed back.
+    """
+    statement = select(DBVirtualMachine).where(
+        DBVirtualMachine.expiry > current_time,
+        DBVirtualMachine.expiry
+        <= current_time + datetime.timedelta(seconds=settings.expiry_warning),
+        DBVirtualMachine.warned_at.is_(None),
+    )
+    for entry in session.exec(statement).all():
+        entry.warned_at = current_time
+        session.add(entry)
+        publish(
+            "vm_expiring",
+            entry.owner,
+            session=session,
+            job_id=entry.job_id,
+            vm_id=entry.id,
+            name=entry.name,
+            expiry=entry.expiry,
+        )
+    session.commit()
 
 
-async def bulk_create(
-    users: list[list[str]], core_count: int, memory: int, duration: int, prefix: str
-):
+@job_handler("bulk_create")
+def bulk_create_job(payload: dict) -> dict:
+    return bulk_create(**payload)
+
+
+def bulk_create(
+    users: list[list[str]],
+    core_count: int,
+    memory: int,
+    duration: int,
+    prefix: str,
+    job_id: str | None = None,
+) -> dict:
+    with BULK_JOBS_RUNNING.track_inprogress():
+        result = _bulk_create(users, core_count, memory, duration, prefix, job_id)
+    record(
+        "bulk_job_finished",
+        job_id=job_id,
+        created=result["created"],
+        skipped=result["skipped"],
+        failed=len(result["failed"]),
+    )
+    publish(
+        "job_finished",
+        settings.api_admin_user,
+        job_id=job_id,
+        created=result["created"],
+        skipped=result["skipped"],
+        failed=len(result["failed"]),
+    )
+    return result
+
+
+def _bulk_create(
+    users: list[list[str]],
+    core_count: int,
+    memory: int,
+    duration: int,
+    prefix: str,
+    job_id: str | None,
+) -> dict:
     session = next(get_session())
-    for user in users:
+    # When a job is picked up again after its worker died, skip the users it already finished
+    done = (
+        set(
+            session.exec(
+                select(DBVirtualMachine.owner).where(DBVirtualMachine.job_id == job_id)
+            ).all()
+        )
+        if job_id
+        else set()
+    )
+    created, failed = 0, []
+    for row, user in enumerate(users, start=1):
+        if user[2] in done:
+            continue
         vm = VirtualMachine(
             name=f"{user[2]}-vm",
             core_count=core_count,
@@ -61,32 +144,23 @@ async def bulk_create(
             duration=duration,
         )
         try:
-            create_user(
-                user[0], user[1], user[2], generate_unique_uid(), user[3], prefix
+            provision_vm(
+                session,
+                vm,
+                user[2],
+                expiry=(
+                    datetime.datetime.now(datetime.UTC)
+                    + datetime.timedelta(hours=vm.duration)
+                    if vm.duration > 0
+                    else datetime.datetime.max
+                ),
+                job_id=job_id,
+                new_user=(user[0], user[1], user[3], prefix),
+                row=row,
             )
-            id = new_free_id()
-            create_vm(id=id, name=vm.name, core_count=vm.core_count, memory=vm.memory)
-            port = new_free_port()
-            expose_vnc_port(vmid=id, port=port)
-            mac_addr = get_vm_mac_addr(id)
-
-            create_vm_entry(vm, user[2], port=port + 5900, mac_addr=mac_addr)
-        except (VMCreationException, VMPortExposeException, INVALID_CREDENTIALS) as e:
-            print(f"VM creation failed: {e}")
-            break
-        vm_db_entry = DBVirtualMachine(
-            vmid=id,
-            name=vm.name,
-            core_count=vm.core_count,
-            memory=vm.memory,
-            port=port,
-            owner=user[2],
-            expiry=(
-                datetime.datetime.now(datetime.UTC)
-                + datetime.timedelta(hours=vm.duration)
-                if vm.duration > 0
-                else datetime.datetime.max
-            ),
-        )
-        session.add(vm_db_entry)
-    session.commit()
+        except VMProvisioningException as e:
+            # Its steps were undone, carry on with the rest of the batch
+            failed.append({"row": row, "username": user[2], "error": str(e)})
+            continue
+        created += 1
+    return {"created": created, "skipped": len(done), "failed": failed}
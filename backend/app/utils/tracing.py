@@ -0,0 +1,95 @@
+import json
+import time
+import secrets
+import threading
+import contextvars
+from contextlib import contextmanager
+from app.config import settings
+
+# Spans are written as JSON, one per line, when they end. The spans of a trace share its
+# context.trace_id and point to their parent through parent_id, eg: to follow one VM creation
+#   jq -c 'select(.context.trace_id == "0x...")' traces.jsonl
+# This is not an OpenTelemetry export format, OTLP collectors and tracing backends cannot ingest it.
+# Enable with TRACE_EXPORTER=file (writes to TRACE_FILE) or TRACE_EXPORTER=console.
+
+_current_span: contextvars.ContextVar["Span | None"] = contextvars.ContextVar(
+    "current_span", default=None
+)
+_export_lock = threading.Lock()
+
+
+class Span:
+    def __init__(self, name: str, trace_id: str, parent_id: str | None, attributes: dict):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.status = "OK"
+        self.start_time = time.time_ns()
+        self.end_time = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "context": {"trace_id": f"0x{self.trace_id}", "span_id": f"0x{self.span_id}"},
+            "parent_id": f"0x{self.parent_id}" if self.parent_id else None,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "duration_ms": (self.end_time - self.start_time) / 1e6,
+            "status": {"status_code": self.status},
+            "attributes": self.attributes,
+            "resource": {"service.name": "webvirt"},
+        }
+
+
+def _export(span: Span):
+    if settings.trace_exporter == "console":
+        print(json.dumps(span.to_dict(), default=str))
+    elif settings.trace_exporter == "file":
+        with _export_lock, open(settings.trace_file, "a") as tracefile:
+            tracefile.write(json.dumps(span.to_dict(), default=str) + "\n")
+
+
+@contextmanager
+def _run_span(span: Span):
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.status = "ERROR"
+        span.set_attribute("exception", repr(e))
+        raise
+    finally:
+        span.end_time = time.time_ns()
+        _current_span.reset(token)
+        _export(span)
+
+
+@contextmanager
+def start_trace(name: str, **attributes):
+    """
+    Starts a new trace with name as its root span. Spans opened inside it become its children.
+    """
+    if settings.trace_exporter == "none":
+        yield Span(name, "0" * 32, None, attributes)  # Keeps set_attribute() working
+        return
+    with _run_span(Span(name, secrets.token_hex(16), None, attributes)) as span:
+        yield span
+
+
+@contextmanager
+def start_span(name: str, **attributes):
+    """
+    Opens a child span of the current span. Does nothing outside of a trace,
+    so instrumented functions only produce spans when called while provisioning.
+    """
+    parent = _current_span.get()
+    if parent is None or settings.trace_exporter == "none":
+        yield None
+        return
+    with _run_span(Span(name, parent.trace_id, parent.span_id, attributes)) as span:
+        yield span
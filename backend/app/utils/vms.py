@@ -1,8 +1,12 @@
 import os
+import math
 import time
+from functools import cache
 import requests
 from app.config import settings
 from app.models.vms import VirtualMachine
+from app.utils.cache import TTLCache
+from app.utils.metrics import instrument, ALLOCATED
 from app.utils.exceptions import (
     VMCreationException,
     VMPortExposeException,
@@ -10,12 +14,48 @@ from app.utils.exceptions import (
     VMRunningException,
     VMUpdationException,
     VMStopException,
+    VMSuspendException,
+    VMStartException,
+    VMQueryException,
+    ProxmoxUnavailableException,
 )
 
 # Suppress no cert warnings since everything is run locally
 requests.packages.urllib3.disable_warnings()
 
 
+@cache
+def proxmox_client() -> requests.Session:
+    """
+    Shared HTTP session for the pve API, created on first use.
+    Keeps connections to proxmox alive across calls instead of a new TLS handshake per request.
+    """
+    return requests.Session()
+
+
+def _proxmox_busy(response: requests.Response) -> bool:
+    """
+    Proxmox answers 500 "can't lock file ... got timeout" when another operation holds the
+    VM or node config lock for too long, typically while many VMs are created at once.
+    Like gateway errors, the same call usually succeeds a moment later.
+    """
+    return response.status_code in (502, 503, 504) or (
+        response.status_code == 500 and "got timeout" in response.reason
+    )
+
+
+def ping_proxmox():
+    response = proxmox_client().get(
+        url=settings.proxmox_base_url
+        + f":{settings.proxmox_base_port}/api2/json/version",
+        headers={"Authorization": settings.proxmox_access_token},
+        verify=False,
+        timeout=5,
+    )
+    if response.status_code != 200:
+        raise VMCreationException(f"pve API did not respond with OK: {response.reason}")
+
+
 def validate_specs(vm: VirtualMachine) -> bool:
     """
     The Virtual machine must satisfy the following conditions.
@@ -35,6 +75,7 @@ def validate_specs(vm: VirtualMachine) -> bool:
     return True
 
 
+@instrument("proxmox")
 def create_vm(id: int, name: str, core_count: int, memory: int):
     """
     Uses the API token generated from proxmox to create virtual machine using the pve API.
@@ -61,14 +102,16 @@ def create_vm(id: int, name: str, core_count: int, memory: int):
         "Authorization": settings.proxmox_access_token,
     }
     try:
-        response = requests.post(
+        response = proxmox_client().post(
             url=VM_CREATE_URL, json=payload, headers=headers, verify=False
         )
     except requests.exceptions.RequestException as e:
         # The request failed. App cannot reach proxmox API
-        raise VMCreationException(
+        raise ProxmoxUnavailableException(
             f"Failed creating virtual machine. possible network error: {e}"
         )
+    if _proxmox_busy(response):
+        raise ProxmoxUnavailableException(f"pve API is busy: {response.reason}")
     if response.status_code != 200:
         # App could reach proxmox API but it did not complete the operation.
         # Maybe wrong token?
@@ -85,33 +128,124 @@ def create_vm(id: int, name: str, core_count: int, memory: int):
         )
 
 
-def update_vm_specs(vmid: int, vm: VirtualMachine):
-    VM_UPDATE_URL = (
+def _config_int(value: str | None, default: int) -> int:
+    """
+    Numeric value of a VM config entry, eg: "2048" or "current=2048" for memory.
+    """
+    if not value:
+        return default
+    return int(value.split(",")[0].split("=")[-1])
+
+
+def _resize_payload(config: dict, pending: dict, vm: VirtualMachine, running: bool) -> dict:
+    """
+    The config change giving the VM vm.core_count cores and vm.memory MB of memory,
+    preferring settings that Proxmox applies to a running VM:
+    - CPU: with cpu hotplug, vcpus (the active vCPUs) can change live up to sockets * cores.
+    - Memory: with memory hotplug (which needs NUMA) memory changes live. Otherwise the memory of a
+      running VM only changes once it is restarted, but with the balloon driver lowering the balloon
+      target takes the memory back from it in the meantime.
+    Anything else is left pending by Proxmox until the VM is restarted. A stopped VM gets everything at once.
+    config is the current config of the VM and pending its changes waiting for a restart (see parse_vm_config()).
+    """
+    hotplug = config.get("hotplug", "network,disk,usb").split(",")
+    cores = _config_int(config.get("cores"), 1)
+    max_vcpus = _config_int(config.get("sockets"), 1) * cores
+    memory = _config_int(config.get("memory"), 512)
+    changes = {}  # key -> new value, None to remove it
+    if "cpu" in hotplug and vm.core_count <= max_vcpus:
+        changes["vcpus"] = vm.core_count
+    else:
+        changes["cores"] = vm.core_count
+        changes["vcpus"] = None
+    changes["memory"] = vm.memory
+    live_memory = "memory" in hotplug and config.get("numa") == "1"
+    balloon = config.get("balloon")
+    if running and not live_memory and balloon != "0" and vm.memory < memory:
+        changes["balloon"] = vm.memory
+    elif balloon not in (None, "0") and _config_int(balloon, 0) > vm.memory:
+        changes["balloon"] = vm.memory  # The balloon target cannot be above the memory
+
+    pending_deletes = set(pending.get("delete", "").split(",")) - {""}
+    payload, deletes, reverts = {}, [], []
+    for key, value in changes.items():
+        if config.get(key) == (None if value is None else str(value)):
+            # Already so, but an earlier change still waiting for a restart would undo it
+            if key in pending or key in pending_deletes:
+                reverts.append(key)
+        elif value is None:
+            deletes.append(key)
+        else:
+            payload[key] = value
+    if deletes:
+        payload["delete"] = ",".join(deletes)
+    if reverts:
+        payload["revert"] = ",".join(reverts)
+    return payload
+
+
+@instrument("proxmox")
+def _pending_keys(vmid: int) -> set[str]:
+    VM_PENDING_URL = (
         settings.proxmox_base_url
-        + f":{settings.proxmox_base_port}/api2/json/nodes/{settings.proxmox_node_name}/qemu/{vmid}"
+        + f":{settings.proxmox_base_port}/api2/json/nodes/{settings.proxmox_node_name}/qemu/{vmid}/pending"
     )
-    payload = {
-        "cores": f"{vm.core_count}",
-        "memory": f"{vm.memory}",
+    headers = {"Authorization": settings.proxmox_access_token}
+    try:
+        response = proxmox_client().get(VM_PENDING_URL, headers=headers, verify=False)
+    except requests.exceptions.RequestException as e:
+        raise ProxmoxUnavailableException(
+            f"Failed reading pending vm changes. possible network error: {e}"
+        )
+    if response.status_code != 200:
+        raise VMUpdationException("Failed reading pending vm changes. pve API did not respond with OK")
+    return {
+        entry["key"]
+        for entry in response.json().get("data") or []
+        if "pending" in entry or entry.get("delete")
     }
+
+
+@instrument("proxmox")
+def update_vm_specs(vmid: int, vm: VirtualMachine) -> bool:
+    """
+    Changes the core count and memory of the VM, live when its config allows it (see _resize_payload()).
+    Returns True if some of the change only applies once the VM is restarted.
+    """
+    VM_UPDATE_URL = (
+        settings.proxmox_base_url
+        + f":{settings.proxmox_base_port}/api2/json/nodes/{settings.proxmox_node_name}/qemu/{vmid}/config"
+    )
+    sections = read_vm_config_sections(vmid)
+    if sections is None:
+        raise VMUpdationException(f"Failed updating vm specs. VM {vmid} does not exist")
+    running = get_vm_statuses().get(vmid, {}).get("status") == "running"
+    payload = _resize_payload(sections[""], sections.get("PENDING", {}), vm, running)
+    if not payload:
+        return False  # Already has these specs
     headers = {
         "content-type": "application/json",
         "Authorization": settings.proxmox_access_token,
     }
     try:
-        response = requests.put(
+        response = proxmox_client().put(
             VM_UPDATE_URL, json=payload, headers=headers, verify=False
         )
     except requests.exceptions.RequestException as e:
-        raise VMUpdationException(
+        raise ProxmoxUnavailableException(
             f"Failed updating virtual machine specs. possible network error: {e}"
         )
+    if _proxmox_busy(response):
+        raise ProxmoxUnavailableException(f"pve API is busy: {response.reason}")
     if response.status_code != 200:
         raise VMUpdationException(
             "Failed updating vm specs. pve API did not respond with OK"
         )
+    changed = set(payload) - {"delete", "revert"} | set(payload.get("delete", "").split(",")) - {""}
+    return bool(_pending_keys(vmid) & changed)
 
 
+@instrument("proxmox")
 def delete_vm(vmid: int):
     VM_DELETE_URL = (
         settings.proxmox_base_url
@@ -122,11 +256,13 @@ def delete_vm(vmid: int):
         "Authorization": settings.proxmox_access_token,
     }
     try:
-        response = requests.delete(url=VM_DELETE_URL, headers=headers, verify=False)
+        response = proxmox_client().delete(url=VM_DELETE_URL, headers=headers, verify=False)
     except requests.exceptions.RequestException as e:
-        raise VMDeletionException(
+        raise ProxmoxUnavailableException(
             f"Failed deleting virtual machine. possible network error: {e}"
         )
+    if _proxmox_busy(response):
+        raise ProxmoxUnavailableException(f"pve API is busy: {response.reason}")
     if response.status_code != 200:
         print(response.reason)
         if "running" in response.reason:
@@ -137,6 +273,7 @@ def delete_vm(vmid: int):
             )
 
 
+@instrument("proxmox")
 def stop_vm(vmid: int):
     VM_STOP_URL = (
         settings.proxmox_base_url
@@ -148,11 +285,13 @@ def stop_vm(vmid: int):
         "forceStop": "1",
     }
     try:
-        respose = requests.post(url=VM_STOP_URL, headers=headers, verify=False)
+        respose = proxmox_client().post(url=VM_STOP_URL, headers=headers, verify=False)
     except requests.exceptions.RequestException as e:
-        raise VMStopException(
+        raise ProxmoxUnavailableException(
             f"Failed to stop virtual machine. possible network error: {e}"
         )
+    if _proxmox_busy(respose):
+        raise ProxmoxUnavailableException(f"pve API is busy: {respose.reason}")
     if respose.status_code != 200:
         print(respose.reason)
         raise VMStopException(
@@ -160,6 +299,179 @@ def stop_vm(vmid: int):
         )
 
 
+@instrument("proxmox")
+def force_stop_vm(vmid: int) -> str:
+    """
+    Powers the VM off without waiting for its guest to shut down. Returns the id (UPID) of the stop task,
+    the VM runs until it is over.
+    """
+    VM_STOP_URL = (
+        settings.proxmox_base_url
+        + f":{settings.proxmox_base_port}/api2/json/nodes/{settings.proxmox_node_name}/qemu/{vmid}/status/stop"
+    )
+    headers = {"Authorization": settings.proxmox_access_token}
+    try:
+        response = proxmox_client().post(url=VM_STOP_URL, headers=headers, verify=False)
+    except requests.exceptions.RequestException as e:
+        raise ProxmoxUnavailableException(
+            f"Failed to stop virtual machine. possible network error: {e}"
+        )
+    if _proxmox_busy(response):
+        raise ProxmoxUnavailableException(f"pve API is busy: {response.reason}")
+    if response.status_code != 200:
+        print(response.reason)
+        raise VMStopException(
+            "Failed to stop virtual machine. pve API did not respond with OK."
+        )
+    return response.json().get("data")
+
+
+def destroy_vm(vmid: int):
+    """
+    Deletes the VM, powering it off first if it is running.
+    status/shutdown and status/stop only start a task, so the stop is waited for (up to VM_STOP_TIMEOUT
+    seconds) before deleting.
+    """
+    try:
+        delete_vm(vmid)
+    except VMRunningException:
+        upid = force_stop_vm(vmid)
+        for _ in range(max(1, math.ceil(settings.vm_stop_timeout))):
+            if not upid or task_finished(upid):
+                break
+            time.sleep(1)
+        else:
+            raise VMStopException(f"VM {vmid} did not stop within {settings.vm_stop_timeout} seconds")
+        delete_vm(vmid)
+
+
+@instrument("proxmox")
+def start_vm(vmid: int) -> str:
+    """
+    Starts the VM, or resumes it if it was suspended. Returns the id (UPID) of the start task.
+    """
+    VM_START_URL = (
+        settings.proxmox_base_url
+        + f":{settings.proxmox_base_port}/api2/json/nodes/{settings.proxmox_node_name}/qemu/{vmid}/status/start"
+    )
+    headers = {"Authorization": settings.proxmox_access_token}
+    try:
+        response = proxmox_client().post(url=VM_START_URL, headers=headers, verify=False)
+    except requests.exceptions.RequestException as e:
+        raise ProxmoxUnavailableException(
+            f"Failed to start virtual machine. possible network error: {e}"
+        )
+    if _proxmox_busy(response):
+        raise ProxmoxUnavailableException(f"pve API is busy: {response.reason}")
+    if response.status_code != 200:
+        print(response.reason)
+        raise VMStartException(
+            "Failed to start virtual machine. pve API did not respond with OK."
+        )
+    return response.json().get("data")
+
+
+@instrument("proxmox")
+def task_finished(upid: str) -> bool:
+    """
+    Whether the proxmox task is over, eg: the start of a VM returned by start_vm().
+    """
+    TASK_STATUS_URL = (
+        settings.proxmox_base_url
+        + f":{settings.proxmox_base_port}/api2/json/nodes/{settings.proxmox_node_name}/tasks/{upid}/status"
+    )
+    headers = {"Authorization": settings.proxmox_access_token}
+    try:
+        response = proxmox_client().get(url=TASK_STATUS_URL, headers=headers, verify=False)
+    except requests.exceptions.RequestException as e:
+        raise ProxmoxUnavailableException(
+            f"Failed to query task status. possible network error: {e}"
+        )
+    if response.status_code != 200:
+        raise VMQueryException("Failed to query task status, pve API did not respond with OK")
+    return response.json()["data"]["status"] == "stopped"
+
+
+@instrument("proxmox")
+def suspend_vm(vmid: int):
+    """
+    Hibernates the VM: its RAM is saved to disk and freed on the host. Starting the VM resumes it.
+    """
+    VM_SUSPEND_URL = (
+        settings.proxmox_base_url
+        + f":{settings.proxmox_base_port}/api2/json/nodes/{settings.proxmox_node_name}/qemu/{vmid}/status/suspend"
+    )
+    headers = {
+        "content-type": "application/json",
+        "Authorization": settings.proxmox_access_token,
+    }
+    try:
+        response = proxmox_client().post(
+            url=VM_SUSPEND_URL, json={"todisk": 1}, headers=headers, verify=False
+        )
+    except requests.exceptions.RequestException as e:
+        raise ProxmoxUnavailableException(
+            f"Failed to suspend virtual machine. possible network error: {e}"
+        )
+    if _proxmox_busy(response):
+        raise ProxmoxUnavailableException(f"pve API is busy: {response.reason}")
+    if response.status_code != 200:
+        print(response.reason)
+        raise VMSuspendException(
+            "Failed to suspend virtual machine. pve API did not respond with OK."
+        )
+
+
+@instrument("proxmox")
+def list_vms() -> list[dict]:
+    """
+    Every VM of the cluster in a single call, with its vmid, name, node, status and specs.
+    """
+    CLUSTER_RESOURCES_URL = (
+        settings.proxmox_base_url
+        + f":{settings.proxmox_base_port}/api2/json/cluster/resources"
+    )
+    headers = {"Authorization": settings.proxmox_access_token}
+    try:
+        response = proxmox_client().get(
+            url=CLUSTER_RESOURCES_URL, params={"type": "vm"}, headers=headers, verify=False
+        )
+    except requests.exceptions.RequestException as e:
+        raise VMQueryException(f"Failed to list virtual machines. possible network error: {e}")
+    if response.status_code != 200:
+        print(response.reason)
+        raise VMQueryException(
+            "Failed to list virtual machines, pve API did not respond with OK"
+        )
+    vms = response.json().get("data")
+    if not isinstance(vms, list):
+        raise VMQueryException("Failed to list virtual machines, pve API returned no list")
+    return vms
+
+
+@cache
+def vm_status_cache() -> TTLCache:
+    return TTLCache(maxsize=1, ttl=settings.vm_status_cache_ttl)
+
+
+def get_vm_statuses() -> dict[int, dict]:
+    """
+    Status and usage of every VM of this node by vmid: status, uptime, cpu (fraction of its cores
+    in use), netin/netout (bytes since boot), ...
+    Read from one cluster resources call, cached for VM_STATUS_CACHE_TTL seconds.
+    """
+
+    def load() -> dict[int, dict]:
+        return {
+            vm["vmid"]: vm
+            for vm in list_vms()
+            if vm.get("node") == settings.proxmox_node_name and vm.get("type", "qemu") == "qemu"
+        }
+
+    return vm_status_cache().get_or_load("statuses", load)
+
+
+@instrument("proxmox")
 def get_vm_mac_addr(vmid: str) -> str:
     time.sleep(1)  # Wait for VM to finish creating
     QUERY_VM_URL = (
@@ -171,11 +483,13 @@ def get_vm_mac_addr(vmid: str) -> str:
         "Authorization": settings.proxmox_access_token,
     }
     try:
-        response = requests.get(url=QUERY_VM_URL, headers=headers, verify=False)
+        response = proxmox_client().get(url=QUERY_VM_URL, headers=headers, verify=False)
     except requests.exceptions.RequestException:
-        raise VMCreationException(
+        raise ProxmoxUnavailableException(
             "Failed to query Vm's MAC address. possible network error. "
         )
+    if _proxmox_busy(response):
+        raise ProxmoxUnavailableException(f"pve API is busy: {response.reason}")
     if response.status_code != 200:
         print(response.reason)
         raise VMCreationException(
@@ -185,12 +499,14 @@ def get_vm_mac_addr(vmid: str) -> str:
     return data.get("data").get("net0").split(",")[0].split("=")[1]
 
 
+@instrument("config_dir")
 def new_free_id() -> int:
     """
     Returns lowest unique ID for VM (100 - 999999999)
     """
     existing_vms = os.listdir(settings.proxmox_vm_config_dir)
     existing_vms = sorted(list(map(lambda vm: int(vm.split(".")[0]), existing_vms)))
+    ALLOCATED.labels("vmid").set(len(existing_vms))
     if len(existing_vms) == 0:
         return 100  # No VMs created yet, highly unlikely but hey.
     if (
@@ -203,26 +519,94 @@ def new_free_id() -> int:
     return existing_vms[-1] + 1
 
 
-def new_free_port() -> int:
+def vnc_ports() -> dict[int, int]:
     """
-    Returns the lowest available port for exposing VNC
+    Returns the VNC port exposed by each VM that has one, by vmid
     """
-    existing_vms = os.listdir(settings.proxmox_vm_config_dir)
-    used_ports = []
-    for vm in existing_vms:
-        with open(os.path.join(settings.proxmox_vm_config_dir, vm), "r") as conf:
+    ports = {}
+    for name in os.listdir(settings.proxmox_vm_config_dir):
+        with open(os.path.join(settings.proxmox_vm_config_dir, name), "r") as conf:
             for line in conf:
                 if "vnc" in line:
-                    used_ports.append(int(line.split(":")[-1]))
-    return sorted(used_ports)[-1] + 1
+                    ports[int(name.removesuffix(".conf"))] = int(line.split(":")[-1])
+    return ports
 
 
-def expose_vnc_port(vmid: int, port: int):
-    vms = os.listdir(settings.proxmox_vm_config_dir)
-    if str(vmid) + ".conf" not in vms:
+@instrument("config_dir")
+def new_free_port() -> int:
+    """
+    Returns the port after the highest one exposed for VNC
+    """
+    ports = vnc_ports()
+    ALLOCATED.labels("vnc_port").set(len(ports))
+    return max(ports.values()) + 1
+
+
+@instrument("config_dir")
+def vnc_port_taken(vmid: int, port: int) -> bool:
+    """
+    Whether a VM other than vmid exposes port. Ports are not reserved, two VMs exposed at once can get the same one.
+    """
+    return any(other != vmid and other_port == port for other, other_port in vnc_ports().items())
+
+
+def parse_vm_config(text: str) -> dict[str, dict]:
+    """
+    Splits a VM config file into its sections by name: "" for the current config,
+    "PENDING" for the changes waiting for a restart and one per snapshot, eg:
+    {"": {"name": "...", "cores": "2"}, "PENDING": {"cores": "4"}, "before-upgrade": {...}}
+    """
+    sections = {"": {}}
+    section = sections[""]
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith("[") and line.endswith("]"):
+            section = sections.setdefault(line[1:-1], {})
+        elif ": " in line and not line.startswith("#"):
+            key, value = line.split(": ", 1)
+            section[key] = value
+    return sections
+
+
+@instrument("config_dir")
+def read_vm_config_sections(vmid: int) -> dict[str, dict] | None:
+    """
+    Every section of the config file of a VM, see parse_vm_config(). None if there is no such VM.
+    """
+    try:
+        with open(os.path.join(settings.proxmox_vm_config_dir, f"{vmid}.conf"), "r") as conf:
+            return parse_vm_config(conf.read())
+    except FileNotFoundError:
+        return None
+
+
+def read_vm_config(vmid: int) -> dict | None:
+    """
+    Returns the current settings of a VM from its config file, eg: {"name": "...", "args": "-vnc 0.0.0.0:12"}
+    Pending changes and snapshots are left out. None if there is no such VM.
+    """
+    sections = read_vm_config_sections(vmid)
+    return None if sections is None else sections[""]
+
+
+@instrument("config_dir")
+def expose_vnc_port(vmid: int) -> int:
+    """
+    Exposes the VNC display of a VM on a free port, replacing the port it had. Returns the port.
+    The port is picked right before it is written, see vnc_port_taken() for whether another VM got it too.
+    """
+    path = os.path.join(settings.proxmox_vm_config_dir, str(vmid) + ".conf")
+    if not os.path.exists(path):
         raise VMPortExposeException("No such Virtual machine")
     time.sleep(5)  # Wait for VM config file to be ready
-    with open(
-        os.path.join(settings.proxmox_vm_config_dir, str(vmid) + ".conf"), "a"
-    ) as conf:
-        conf.write(f"\nargs: -vnc 0.0.0.0:{port}")
+    port = new_free_port()
+    with open(path, "r") as conf:
+        lines = conf.read().splitlines()
+    if any(line.startswith("args: -vnc") for line in lines):
+        lines = [line for line in lines if not line.startswith("args: -vnc")]
+        with open(path, "w") as conf:
+            conf.write("\n".join([*lines, f"args: -vnc 0.0.0.0:{port}"]) + "\n")
+    else:
+        with open(path, "a") as conf:
+            conf.write(f"\nargs: -vnc 0.0.0.0:{port}")
+    return port
@@ -0,0 +1,282 @@
+import os
+import uuid
+import socket
+import asyncio
+import datetime
+from typing import Callable
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import and_, or_, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+from app.config import settings
+from app.database.main import get_engine
+from app.database.models import DBJob, DBLease
+from app.utils.exceptions import JobDeferredException
+
+# Background work is coordinated through the database, so the API can run with several
+# uvicorn workers (or on several hosts sharing the database):
+# - Periodic tasks run only in the worker holding that task's lease, at most once per interval
+#   across all workers. The lease is renewed for as long as a run lasts.
+# - Jobs are queued in DBJob and each one is claimed by a single worker. A claim expires
+#   if its worker stops renewing it, so jobs of a dead worker are picked up again.
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+JOB_HANDLERS: dict[str, Callable[[dict], dict | None]] = {}
+
+
+def utcnow() -> datetime.datetime:
+    return datetime.datetime.now(datetime.UTC)
+
+
+def job_handler(kind: str) -> Callable:
+    """
+    Registers the decorated function as the handler of jobs of the given kind.
+    It is called in a worker thread with the job's payload, and may return a result dict.
+    It can raise JobDeferredException to be run again later.
+    """
+
+    def decorator(func: Callable) -> Callable:
+        JOB_HANDLERS[kind] = func
+        return func
+
+    return decorator
+
+
+def acquire_lease(name: str) -> bool:
+    """
+    Takes or renews the named lease for this worker. Returns False if another live worker holds it.
+    """
+    now = utcnow()
+    expires_at = now + datetime.timedelta(seconds=settings.lease_seconds)
+    with Session(get_engine()) as session:
+        result = session.exec(
+            update(DBLease)
+            .where(
+                DBLease.name == name,
+                or_(DBLease.holder == WORKER_ID, DBLease.expires_at < now),
+            )
+            .values(holder=WORKER_ID, expires_at=expires_at)
+        )
+        if result.rowcount == 1:
+            session.commit()
+            return True
+        if session.get(DBLease, name) is not None:
+            return False
+        session.add(DBLease(name=name, holder=WORKER_ID, expires_at=expires_at))
+        try:
+            session.commit()
+        except IntegrityError:  # Another worker created the lease first
+            return False
+        return True
+
+
+def start_run(name: str, interval: float) -> bool:
+    """
+    Takes the named lease for a run of its periodic task, if no other live worker holds it and the
+    last run (by any worker) started at least interval seconds ago. Returns False otherwise.
+    """
+    now = utcnow()
+    expires_at = now + datetime.timedelta(seconds=settings.lease_seconds)
+    with Session(get_engine()) as session:
+        result = session.exec(
+            update(DBLease)
+            .where(
+                DBLease.name == name,
+                or_(DBLease.holder == WORKER_ID, DBLease.expires_at < now),
+                or_(
+                    DBLease.last_run_at.is_(None),
+                    DBLease.last_run_at <= now - datetime.timedelta(seconds=interval),
+                ),
+            )
+            .values(holder=WORKER_ID, expires_at=expires_at, last_run_at=now)
+        )
+        if result.rowcount == 1:
+            session.commit()
+            return True
+        if session.get(DBLease, name) is not None:
+            return False
+        session.add(DBLease(name=name, holder=WORKER_ID, expires_at=expires_at, last_run_at=now))
+        try:
+            session.commit()
+        except IntegrityError:  # Another worker created the lease first
+            return False
+        return True
+
+
+def release_leases():
+    with Session(get_engine()) as session:
+        session.exec(
+            update(DBLease)
+            .where(DBLease.holder == WORKER_ID)
+            .values(expires_at=utcnow())
+        )
+        session.commit()
+
+
+def enqueue_job(
+    session: Session,
+    kind: str,
+    payload: dict,
+    job_id: str | None = None,
+    run_after: datetime.datetime | None = None,
+) -> DBJob:
+    """
+    Adds a job to the queue. Committed with the caller's session.
+    run_after: the job is not picked up before this time.
+    """
+    job = DBJob(id=job_id or uuid.uuid4().hex, kind=kind, payload=payload, run_after=run_after)
+    session.add(job)
+    return job
+
+
+def _claimable(now: datetime.datetime):
+    return or_(
+        and_(
+            DBJob.status == "queued",
+            or_(DBJob.run_after.is_(None), DBJob.run_after <= now),
+        ),
+        and_(DBJob.status == "running", DBJob.locked_until < now),
+    )
+
+
+def claim_job() -> DBJob | None:
+    now = utcnow()
+    with Session(get_engine()) as session:
+        candidates = session.exec(
+            select(DBJob.id)
+            .where(_claimable(now))
+            .order_by(DBJob.created_at)
+            .limit(10)
+        ).all()
+        for job_id in candidates:
+            # Conditional update, only one worker can win the claim
+            result = session.exec(
+                update(DBJob)
+                .where(DBJob.id == job_id, _claimable(now))
+                .values(
+                    status="running",
+                    locked_by=WORKER_ID,
+                    locked_until=now + datetime.timedelta(seconds=settings.lease_seconds),
+                    attempts=DBJob.attempts + 1,
+                )
+            )
+            session.commit()
+            if result.rowcount == 1:
+                return session.get(DBJob, job_id)
+    return None
+
+
+def renew_claim(job_id: str):
+    with Session(get_engine()) as session:
+        session.exec(
+            update(DBJob)
+            .where(DBJob.id == job_id, DBJob.locked_by == WORKER_ID)
+            .values(locked_until=utcnow() + datetime.timedelta(seconds=settings.lease_seconds))
+        )
+        session.commit()
+
+
+def finish_job(job_id: str, result: dict | None = None, error: str | None = None):
+    with Session(get_engine()) as session:
+        job = session.get(DBJob, job_id)
+        if job.locked_by != WORKER_ID:
+            return  # Our claim ran out and another worker owns the job now
+        if error is not None and job.attempts < settings.job_max_attempts:
+            job.status, job.error = "queued", error  # Retried by the next free worker
+        else:
+            job.status = "failed" if error is not None else "done"
+            job.result, job.error = result, error
+            job.payload = None  # May hold user credentials, not needed once the job is over
+            job.finished_at = utcnow()
+        job.locked_by, job.locked_until = None, None
+        session.add(job)
+        session.commit()
+
+
+def defer_job(job_id: str, run_after: datetime.datetime):
+    """
+    Queues the job again, to run after run_after. Waiting does not count as an attempt.
+    """
+    with Session(get_engine()) as session:
+        session.exec(
+            update(DBJob)
+            .where(DBJob.id == job_id, DBJob.locked_by == WORKER_ID)
+            .values(
+                status="queued",
+                run_after=run_after,
+                attempts=DBJob.attempts - 1,
+                locked_by=None,
+                locked_until=None,
+            )
+        )
+        session.commit()
+
+
+async def _keep_lease(name: str):
+    while True:
+        await asyncio.sleep(settings.lease_seconds / 3)
+        if not await run_in_threadpool(acquire_lease, name):
+            print(f"Lost the {name} lease while running it")
+
+
+async def _keep_claim(job_id: str):
+    while True:
+        await asyncio.sleep(settings.lease_seconds / 3)
+        await run_in_threadpool(renew_claim, job_id)
+
+
+async def run_job(job: DBJob):
+    handler = JOB_HANDLERS.get(job.kind)
+    if job.attempts > settings.job_max_attempts:  # Claimed again after its workers kept dying
+        await run_in_threadpool(finish_job, job.id, error=f"Gave up after {job.attempts - 1} attempts")
+        return
+    if handler is None:
+        await run_in_threadpool(finish_job, job.id, error=f"No handler for job kind {job.kind}")
+        return
+    renewer = asyncio.create_task(_keep_claim(job.id))
+    try:
+        result = await run_in_threadpool(handler, job.payload)
+    except JobDeferredException as e:
+        await run_in_threadpool(defer_job, job.id, e.run_after)
+    except Exception as e:
+        print(f"Job {job.id} ({job.kind}) failed on attempt {job.attempts}: {e}")
+        await run_in_threadpool(finish_job, job.id, error=str(e))
+    else:
+        await run_in_threadpool(finish_job, job.id, result=result)
+    finally:
+        renewer.cancel()
+
+
+async def run_jobs():
+    """
+    Job worker loop. Every process runs one, so jobs are spread over the workers.
+    """
+    while True:
+        try:
+            job = await run_in_threadpool(claim_job)
+        except Exception as e:
+            print(f"Failed to claim job: {e}")
+            job = None
+        if job is None:
+            await asyncio.sleep(settings.worker_poll_interval)
+            continue
+        await run_job(job)
+
+
+async def run_periodic(name: str, interval: float, func: Callable[[], None]):
+    """
+    Runs func every interval seconds, in whichever single worker holds the lease called name.
+    Every worker checks whether a run is due at least every LEASE_SECONDS / 3 seconds.
+    """
+    while True:
+        try:
+            if await run_in_threadpool(start_run, name, interval):
+                renewer = asyncio.create_task(_keep_lease(name))
+                try:
+                    await run_in_threadpool(func)
+                finally:
+                    renewer.cancel()
+        except Exception as e:
+            print(f"Periodic task {name} failed: {e}")
+        await asyncio.sleep(min(interval, settings.lease_seconds / 3))
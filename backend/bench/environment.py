@@ -0,0 +1,104 @@
+# Wires the app to the fake Proxmox and LDAP servers, in a throwaway working directory.
+# Must run before anything from `app` is imported, since settings are read at import time.
+import os
+import types
+import tempfile
+from dataclasses import dataclass
+from bench.fake_proxmox import FakeProxmox
+from bench.fake_ldap import FakeLDAP
+
+LDAP_DN = "dc=bench,dc=local"
+LDAP_USER_DN = f"ou=People,{LDAP_DN}"
+LDAP_VM_DN = f"ou=Groups,{LDAP_DN}"
+LDAP_ADMIN_USER = "admin"
+LDAP_ADMIN_PASS = "admin"
+API_ADMIN_USER = "webadmin"
+NODE = "pve"
+
+
+@dataclass
+class BenchEnvironment:
+    workdir: str
+    config_dir: str
+    proxmox: FakeProxmox
+    ldap: FakeLDAP
+
+    def add_ldap_user(self, username: str, uid_number: int, password: str = "password"):
+        dn = f"uid={username},{LDAP_USER_DN}"
+        self.ldap.entries[dn] = {
+            "objectClass": [b"inetOrgPerson", b"posixAccount"],
+            "uid": [username.encode()],
+            "cn": [username.encode()],
+            "sn": [username.encode()],
+            "uidNumber": [str(uid_number).encode()],
+            "gidNumber": [b"5000"],
+            "homeDirectory": [f"/home/{username}".encode()],
+            "loginShell": [b"/bin/bash"],
+        }
+        # verify_password binds with cn=<user>,<base dn>
+        self.ldap.passwords[self.ldap._key(f"cn={username},{LDAP_DN}")] = password
+
+    def stop(self):
+        self.proxmox.stop()
+
+
+def setup(
+    proxmox_latency: float = 0.0,
+    ldap_latency: float = 0.0,
+    lock_timeout: float = 10.0,
+    real_sleeps: bool = False,
+) -> BenchEnvironment:
+    """
+    real_sleeps: keep the fixed time.sleep() waits in app.utils.vms. They are skipped by default
+        so that benchmarks measure the code rather than the waits.
+    """
+    workdir = tempfile.mkdtemp(prefix="webvirt-bench-")
+    config_dir = os.path.join(workdir, "qemu-server")  # Mimics /etc/pve/qemu-server
+    os.makedirs(config_dir)
+    os.chdir(workdir)  # database.db, journal.jsonl and traces land here
+
+    proxmox = FakeProxmox(config_dir, node=NODE, latency=proxmox_latency, lock_timeout=lock_timeout).start()
+    os.environ.update(
+        {
+            "LDAP_URL": "ldap://127.0.0.1:1/",
+            "LDAP_DN": LDAP_DN,
+            "LDAP_VM_DN": LDAP_VM_DN,
+            "LDAP_USER_DN": LDAP_USER_DN,
+            "LDAP_ADMIN_USER": LDAP_ADMIN_USER,
+            "LDAP_ADMIN_PASS": LDAP_ADMIN_PASS,
+            "LDAP_BASE_GROUP_ID": "5000",
+            "VNC_HOSTNAME": "127.0.0.1",
+            "ALGORITHM": "HS256",
+            "SECRET_KEY": "bench",
+            "API_ADMIN_USER": API_ADMIN_USER,
+            "PROXMOX_HOST": "127.0.0.1",
+            "PROXMOX_BASE_URL": proxmox.base_url,
+            "PROXMOX_BASE_PORT": str(proxmox.port),
+            "PROXMOX_NODE_NAME": NODE,
+            "PROXMOX_ACCESS_TOKEN": "PVEAPIToken=bench@pve!bench=secret",
+            "PROXMOX_VM_NETBRIDGE": "vmbr0",
+            "PROXMOX_VM_CONFIG_DIR": config_dir,
+            "ALLOWED_CSV_FIELDS": '["first_name","last_name"]',
+            "TRACE_EXPORTER": "none",
+        }
+    )
+
+    fake_ldap = FakeLDAP(latency=ldap_latency)
+    fake_ldap.entries[LDAP_USER_DN] = {"objectClass": [b"organizationalUnit"], "ou": [b"People"]}
+    fake_ldap.entries[LDAP_VM_DN] = {"objectClass": [b"organizationalUnit"], "ou": [b"Groups"]}
+    fake_ldap.passwords[fake_ldap._key(f"cn={LDAP_ADMIN_USER},{LDAP_DN}")] = LDAP_ADMIN_PASS
+
+    import app.ldap.main
+    import app.utils.vms
+    from app.database.models import init_db
+
+    init_db()
+
+    app.ldap.main._open_conn = lambda: fake_ldap
+    app.ldap.main.reset_conn()
+    if not real_sleeps:
+        app.utils.vms.time = types.SimpleNamespace(sleep=lambda seconds: None)
+
+    env = BenchEnvironment(workdir, config_dir, proxmox, fake_ldap)
+    env.add_ldap_user("trcadmin", 10000)
+    return env
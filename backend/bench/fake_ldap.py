@@ -0,0 +1,140 @@
+# In-memory stand-in for the python-ldap connection object used by app.ldap.main.
+# Implements just the calls the app makes (bind, search with paged results, add,
+# delete, passwd) with a small subset of the filter syntax: equality, presence
+# and &, | of those.
+import re
+import time
+import itertools
+import threading
+import ldap
+from ldap.controls import SimplePagedResultsControl
+
+
+def _unescape(value: str) -> str:
+    return re.sub(r"\\([0-9a-fA-F]{2})", lambda m: chr(int(m[1], 16)), value)
+
+
+def _split_filters(body: str) -> list[str]:
+    parts, depth, start = [], 0, 0
+    for i, char in enumerate(body):
+        if char == "(":
+            if depth == 0:
+                start = i
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth == 0:
+                parts.append(body[start : i + 1])
+    return parts
+
+
+def matches(filterstr: str, attrs: dict[str, list[bytes]]) -> bool:
+    filterstr = filterstr.strip()
+    if filterstr.startswith("(") and filterstr.endswith(")"):
+        filterstr = filterstr[1:-1]
+    if filterstr[:1] in "&|":
+        results = (matches(part, attrs) for part in _split_filters(filterstr[1:]))
+        return all(results) if filterstr[0] == "&" else any(results)
+    if filterstr.startswith("!"):
+        return not matches(filterstr[1:], attrs)
+    attr, value = filterstr.split("=", 1)
+    values = next((v for k, v in attrs.items() if k.lower() == attr.lower()), None)
+    if values is None:
+        return False
+    if value == "*":
+        return True
+    value = _unescape(value).lower()
+    return any(v.decode("utf-8").lower() == value for v in values)
+
+
+class FakeLDAP:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.entries: dict[str, dict[str, list[bytes]]] = {}
+        self.passwords: dict[str, str] = {}
+        self.operations = 0
+        self._pending: dict[int, tuple] = {}
+        self._msgids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _op(self):
+        self.operations += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _key(self, dn: str) -> str:
+        return re.sub(r"\s*,\s*", ",", dn).lower()
+
+    def bind_s(self, who: str, cred: str):
+        self._op()
+        if self.passwords.get(self._key(who)) != cred:
+            raise ldap.INVALID_CREDENTIALS({"desc": "Invalid credentials"})
+
+    def unbind_s(self):
+        pass
+
+    def _search(self, base, filterstr, attrlist):
+        base = self._key(base)
+        with self._lock:
+            items = list(self.entries.items())
+        results = []
+        for dn, attrs in items:
+            if not self._key(dn).endswith(base) or not matches(filterstr, attrs):
+                continue
+            if attrlist:
+                wanted = {a.lower() for a in attrlist}
+                attrs = {k: v for k, v in attrs.items() if k.lower() in wanted}
+            results.append((dn, dict(attrs)))
+        return results
+
+    def search_s(self, base, scope, filterstr="(objectClass=*)", attrlist=None):
+        self._op()
+        return self._search(base, filterstr, attrlist)
+
+    def search_ext(self, base, scope, filterstr="(objectClass=*)", attrlist=None, serverctrls=None):
+        self._op()
+        results = self._search(base, filterstr, attrlist)
+        control = next(
+            (c for c in serverctrls or [] if c.controlType == SimplePagedResultsControl.controlType),
+            None,
+        )
+        response_controls = []
+        if control is not None:
+            offset = int(control.cookie or 0)
+            end = offset + control.size
+            cookie = str(end).encode() if end < len(results) else b""  # Empty cookie marks the last page
+            response_controls.append(
+                SimplePagedResultsControl(False, size=len(results), cookie=cookie)
+            )
+            results = results[offset:end]
+        msgid = next(self._msgids)
+        self._pending[msgid] = (results, response_controls)
+        return msgid
+
+    def result3(self, msgid):
+        results, controls = self._pending.pop(msgid)
+        return ldap.RES_SEARCH_RESULT, results, msgid, controls
+
+    def add_s(self, dn: str, modlist):
+        self._op()
+        with self._lock:
+            if any(self._key(existing) == self._key(dn) for existing in self.entries):
+                raise ldap.ALREADY_EXISTS({"desc": "Already exists"})
+            self.entries[dn] = {attr: list(values) for attr, values in modlist}
+
+    def delete_s(self, dn: str):
+        self._op()
+        with self._lock:
+            for existing in list(self.entries):
+                if self._key(existing) == self._key(dn):
+                    del self.entries[existing]
+                    return
+        raise ldap.NO_SUCH_OBJECT({"desc": "No such object"})
+
+    def whoami_s(self) -> str:
+        self._op()
+        return ""
+
+    def passwd_s(self, user: str, oldpw, newpw: str):
+        self._op()
+        self.passwords[self._key(user)] = newpw
@@ -0,0 +1,276 @@
+# In-process stand-in for the parts of the Proxmox VE API that WebVirt uses.
+# VMs are backed by real <vmid>.conf files in a config directory, so the code
+# that scans PROXMOX_VM_CONFIG_DIR sees the same state as the API.
+import os
+import re
+import json
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeProxmox:
+    """
+    latency: seconds every API call takes
+    task_duration: seconds a UPID task stays "running"
+    shutdown_duration: seconds a guest takes to shut down. Like PVE, status/shutdown and status/stop
+        return their task right away and the VM keeps running until the task is over.
+    lock_timeout: how long a mutating call waits for the node lock before failing
+        the way PVE does ("can't lock file ... got timeout"). Mutating calls hold the
+        lock for `latency`, so concurrent callers contend for it.
+    fail_rate: probability of a call failing with 500
+    """
+
+    def __init__(
+        self,
+        config_dir: str,
+        node: str = "pve",
+        latency: float = 0.0,
+        task_duration: float = 0.0,
+        shutdown_duration: float = 1.0,
+        lock_timeout: float = 10.0,
+        fail_rate: float = 0.0,
+    ):
+        self.config_dir = config_dir
+        self.node = node
+        self.latency = latency
+        self.task_duration = task_duration
+        self.shutdown_duration = shutdown_duration
+        self.lock_timeout = lock_timeout
+        self.fail_rate = fail_rate
+        self.status: dict[int, str] = {}
+        self.started: dict[int, float] = {}  # vmid -> time.time() it was started at
+        self.usage: dict[int, dict] = {}  # vmid -> cpu, netin and netout reported while running
+        self.pending: dict[int, dict] = {}  # vmid -> config changes applied on the next start, see write_config()
+        self.tasks: dict[str, float] = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    # VM state helpers, also handy to seed a benchmark
+
+    def conf_path(self, vmid: int) -> str:
+        return os.path.join(self.config_dir, f"{vmid}.conf")
+
+    def add_vm(self, vmid: int, name: str, cores: int = 1, memory: int = 512, vnc_port: int | None = None, running: bool = False):
+        mac = "BC:24:11:%02X:%02X:%02X" % (vmid >> 16 & 0xFF, vmid >> 8 & 0xFF, vmid & 0xFF)
+        lines = [
+            f"cores: {cores}",
+            f"memory: {memory}",
+            f"name: {name}",
+            f"net0: virtio={mac},bridge=vmbr0,firewall=1",
+        ]
+        if vnc_port is not None:
+            lines.append(f"args: -vnc 0.0.0.0:{vnc_port}")
+        with open(self.conf_path(vmid), "w") as conf:
+            conf.write("\n".join(lines) + "\n")
+        self.status[vmid] = "running" if running else "stopped"
+        self.started[vmid] = time.time()
+
+    def read_config(self, vmid: int) -> dict | None:
+        """
+        The current config, without the pending changes.
+        """
+        try:
+            with open(self.conf_path(vmid)) as conf:
+                current = conf.read().split("[PENDING]")[0]
+        except FileNotFoundError:
+            return None
+        return dict(line.split(": ", 1) for line in current.splitlines() if ": " in line)
+
+    def write_config(self, vmid: int, keys: dict[str, str], deleted: list[str]):
+        config = self.read_config(vmid)
+        config = {key: value for key, value in config.items() if key not in deleted} | keys
+        # Like PVE, pending changes go to a [PENDING] section and are dropped once they match the config
+        pending = {key: value for key, value in self.pending.get(vmid, {}).items() if config.get(key) != value}
+        self.pending[vmid] = pending
+        lines = [f"{key}: {value}" for key, value in config.items()]
+        if pending:
+            lines += ["", "[PENDING]"] + [f"{key}: {value}" for key, value in pending.items()]
+        with open(self.conf_path(vmid), "w") as conf:
+            conf.write("\n".join(lines) + "\n")
+
+    def new_task(self, kind: str, vmid: int, duration: float | None = None) -> str:
+        upid = f"UPID:{self.node}:{os.getpid():08X}:{random.getrandbits(32):08X}:{int(time.time()):08X}:{kind}:{vmid}:root@pam:"
+        self.tasks[upid] = time.monotonic() + (self.task_duration if duration is None else duration)
+        return upid
+
+    def stop_later(self, vmid: int, delay: float):
+        def stop():
+            with self._lock:
+                self.status[vmid] = "stopped"
+                self.started[vmid] = time.time()
+
+        if delay <= 0:
+            self.status[vmid] = "stopped"
+            self.started[vmid] = time.time()
+        else:
+            threading.Timer(delay, stop).start()
+
+    # HTTP handling
+
+    def handle(self, method: str, path: str, body: dict) -> tuple[int, str, dict | None]:
+        self.requests += 1
+        if method == "GET":
+            time.sleep(self.latency)  # Mutating calls sleep while holding the lock instead
+        if self.fail_rate and random.random() < self.fail_rate:
+            return 500, "Injected failure", None
+
+        node = re.escape(self.node)
+        if method == "GET" and path == "/api2/json/version":
+            return 200, "OK", {"data": {"version": "8.2.4", "release": "8.2"}}
+        if method == "GET" and path == "/api2/json/cluster/resources":
+            return 200, "OK", {"data": self.resources()}
+        if m := re.fullmatch(rf"/api2/json/nodes/{node}/tasks/([^/]+)/status", path):
+            done = time.monotonic() >= self.tasks.get(m[1], 0)
+            return 200, "OK", {"data": {"status": "stopped" if done else "running", "exitstatus": "OK" if done else None}}
+        if method == "GET" and (m := re.fullmatch(rf"/api2/json/nodes/{node}/qemu/(\d+)/config", path)):
+            config = self.read_config(int(m[1]))
+            return (200, "OK", {"data": config}) if config else (500, f"Configuration file 'nodes/{self.node}/qemu-server/{m[1]}.conf' does not exist", None)
+        if method == "GET" and (m := re.fullmatch(rf"/api2/json/nodes/{node}/qemu/(\d+)/status/current", path)):
+            vmid = int(m[1])
+            if self.read_config(vmid) is None:
+                return 500, "VM does not exist", None
+            return 200, "OK", {"data": {"vmid": vmid, "status": self.status.get(vmid, "stopped")}}
+        if method == "GET" and (m := re.fullmatch(rf"/api2/json/nodes/{node}/qemu/(\d+)/pending", path)):
+            vmid = int(m[1])
+            config = self.read_config(vmid)
+            if config is None:
+                return 500, "VM does not exist", None
+            entries = [{"key": key, "value": value} for key, value in config.items()]
+            entries += [{"key": key, "pending": value} for key, value in self.pending.get(vmid, {}).items()]
+            return 200, "OK", {"data": entries}
+
+        # Everything below mutates state and contends for the node lock, like PVE's config lock
+        if not self._lock.acquire(timeout=self.lock_timeout):
+            return 500, "can't lock file '/var/lock/qemu-server/lock.conf' - got timeout", None
+        try:
+            time.sleep(self.latency)
+            return self.mutate(method, path, body)
+        finally:
+            self._lock.release()
+
+    def mutate(self, method: str, path: str, body: dict) -> tuple[int, str, dict | None]:
+        node = re.escape(self.node)
+        if method == "POST" and path == f"/api2/json/nodes/{self.node}/qemu":
+            vmid = int(body["vmid"])
+            if self.read_config(vmid) is not None:
+                return 500, f"VM {vmid} already exists", None
+            self.add_vm(vmid, body.get("name", f"VM{vmid}"), int(body.get("cores", 1)), int(body.get("memory", 512)))
+            return 200, "OK", {"data": self.new_task("qmcreate", vmid)}
+        if m := re.fullmatch(rf"/api2/json/nodes/{node}/qemu/(\d+)(/config)?", path):
+            vmid = int(m[1])
+            config = self.read_config(vmid)
+            if config is None:
+                return 500, f"VM {vmid} does not exist", None
+            if method == "PUT":
+                keys = {key: str(value) for key, value in body.items() if key not in ("delete", "revert")}
+                deleted = [key for key in body.get("delete", "").split(",") if key]
+                for key in body.get("revert", "").split(","):
+                    self.pending.get(vmid, {}).pop(key, None)
+                if self.status.get(vmid) == "running":
+                    # Like PVE, only hot-pluggable changes apply to a running VM, the rest waits for a restart
+                    hotplug = config.get("hotplug", "network,disk,usb").split(",")
+                    live = {"balloon"}
+                    live |= {"vcpus"} if "cpu" in hotplug else set()
+                    live |= {"memory"} if "memory" in hotplug and config.get("numa") == "1" else set()
+                    self.pending.setdefault(vmid, {}).update(
+                        {key: value for key, value in keys.items() if key not in live}
+                    )
+                    keys = {key: value for key, value in keys.items() if key in live}
+                    for key in keys:
+                        self.pending[vmid].pop(key, None)
+                self.write_config(vmid, keys, deleted)
+                return 200, "OK", {"data": None}
+            if method == "DELETE":
+                if self.status.get(vmid) == "running":
+                    return 500, f"VM {vmid} is running - destroy failed", None
+                os.remove(self.conf_path(vmid))
+                self.status.pop(vmid, None)
+                return 200, "OK", {"data": self.new_task("qmdestroy", vmid)}
+        if method == "POST" and (m := re.fullmatch(rf"/api2/json/nodes/{node}/qemu/(\d+)/status/(start|shutdown|stop|suspend)", path)):
+            vmid, action = int(m[1]), m[2]
+            if self.read_config(vmid) is None:
+                return 500, f"VM {vmid} does not exist", None
+            if action in ("shutdown", "stop"):
+                # The VM stops once the task is over
+                duration = self.shutdown_duration if action == "shutdown" else self.task_duration
+                self.stop_later(vmid, duration)
+                return 200, "OK", {"data": self.new_task(f"qm{action}", vmid, duration)}
+            self.status[vmid] = "running" if action == "start" else "stopped"
+            self.started[vmid] = time.time()
+            if action == "start" and self.pending.get(vmid):
+                self.write_config(vmid, self.pending.pop(vmid), [])
+            return 200, "OK", {"data": self.new_task(f"qm{action}", vmid)}
+        return 501, "Method not implemented", None
+
+    def resources(self) -> list[dict]:
+        resources = []
+        for conf in os.listdir(self.config_dir):
+            if not conf.endswith(".conf"):
+                continue
+            vmid = int(conf.split(".")[0])
+            config = self.read_config(vmid) or {}
+            running = self.status.get(vmid) == "running"
+            usage = self.usage.get(vmid, {}) if running else {}
+            resources.append(
+                {
+                    "id": f"qemu/{vmid}",
+                    "type": "qemu",
+                    "vmid": vmid,
+                    "node": self.node,
+                    "name": config.get("name"),
+                    "status": self.status.get(vmid, "stopped"),
+                    "maxcpu": int(config.get("cores", 1)),
+                    "maxmem": int(config.get("memory", 512)) * 1024 * 1024,
+                    "uptime": int(time.time() - self.started.get(vmid, time.time())) if running else 0,
+                    "cpu": usage.get("cpu", 0.0),
+                    "netin": usage.get("netin", 0),
+                    "netout": usage.get("netout", 0),
+                }
+            )
+        return resources
+
+    # Server lifecycle
+
+    @property
+    def base_url(self) -> str:
+        return "http://127.0.0.1"
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self) -> "FakeProxmox":
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _dispatch(self):
+                length = int(self.headers.get("content-length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                try:
+                    body = json.loads(raw) if raw else {}
+                except ValueError:
+                    body = {}
+                code, reason, payload = fake.handle(self.command, self.path.split("?")[0], body)
+                data = json.dumps(payload).encode() if payload is not None else b""
+                self.send_response(code, reason)
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _dispatch
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,228 @@
+# WebVirt HTTP load profile: a classroom logging in through /auth/login at once and then
+# polling GET /vms, optionally while an admin CSV import runs.
+# By default the app is started in-process with uvicorn, wired to the fake Proxmox and
+# LDAP servers from bench.environment, and one VM per student is seeded in the database.
+# Pass --url to drive an already running deployment instead (the users must exist there).
+#
+# Usage (from the backend directory):
+#   python -m bench.loadtest [--users 100] [--ramp 10] [--duration 60]
+#                            [--poll-interval 5] [--import-rows 50]
+#                            [--proxmox-latency 0.02] [--ldap-latency 0.002]
+#                            [--url http://host:8000 --user-prefix student --admin webadmin]
+#                            [--password password]
+#                            [--output loadtest_results.json]
+#
+#   --users: number of students
+#   --ramp: seconds over which the students start logging in
+#   --duration: seconds each student keeps polling after logging in
+#   --poll-interval: seconds between two polls of a student
+#   --import-rows: rows of the admin CSV import started with the storm, 0 to disable
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import threading
+from collections import defaultdict
+import requests
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def request(self, route: str, method: str, url: str, **kwargs) -> requests.Response | None:
+        start = time.perf_counter()
+        try:
+            response = requests.request(method, url, timeout=60, **kwargs)
+        except requests.exceptions.RequestException:
+            response = None
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.samples[route].append(elapsed)
+            if response is None or response.status_code >= 400:
+                self.errors[route] += 1
+        return response
+
+    def report(self, wall_time: float) -> dict:
+        report = {}
+        for route, samples in sorted(self.samples.items()):
+            ordered = sorted(samples)
+
+            def percentile(p: float) -> float:
+                return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000
+
+            report[route] = {
+                "requests": len(ordered),
+                "errors": self.errors[route],
+                "error_rate": self.errors[route] / len(ordered),
+                "requests_per_second": len(ordered) / wall_time,
+                "p50_ms": percentile(50),
+                "p95_ms": percentile(95),
+                "p99_ms": percentile(99),
+                "max_ms": ordered[-1] * 1000,
+            }
+        return report
+
+
+def student(recorder: Recorder, url: str, username: str, password: str, start_at: float, args):
+    time.sleep(max(0.0, start_at - time.monotonic()))
+    response = recorder.request(
+        "POST /auth/login", "POST", f"{url}/auth/login",
+        data={"username": username, "password": password},
+    )
+    if response is None or response.status_code != 200:
+        return
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    stop_at = time.monotonic() + args.duration
+    # Spread the first poll so that students do not poll in lock step forever
+    time.sleep(random.uniform(0, args.poll_interval))
+    while time.monotonic() < stop_at:
+        response = recorder.request("GET /vms", "GET", f"{url}/vms", headers=headers)
+        if response is not None and "ETag" in response.headers:
+            headers["If-None-Match"] = response.headers["ETag"]
+        time.sleep(args.poll_interval)
+
+
+def admin_import(recorder: Recorder, url: str, admin: str, admin_password: str, rows: int):
+    response = recorder.request(
+        "POST /auth/login", "POST", f"{url}/auth/login",
+        data={"username": admin, "password": admin_password},
+    )
+    if response is None or response.status_code != 200:
+        return
+    body = "first_name,last_name\n" + "".join(f"import{i},student{i}\n" for i in range(rows))
+    recorder.request(
+        "POST /admin/csv", "POST", f"{url}/admin/csv",
+        headers={"Authorization": f"Bearer {response.json()['access_token']}"},
+        params={"core_count": 1, "memory": 512, "duration": 1, "prefix": "/home"},
+        files={"file": ("students.csv", body, "text/csv")},
+    )
+
+
+def start_local_app(args) -> tuple[str, list[str], str, object]:
+    from bench import environment
+
+    env = environment.setup(
+        proxmox_latency=args.proxmox_latency, ldap_latency=args.ldap_latency
+    )
+    env.proxmox.add_vm(100, "management", vnc_port=0)
+
+    import uvicorn
+    from sqlmodel import Session
+    from app.config import settings
+    from app.database.main import get_engine
+    from app.database.models import DBVirtualMachine
+    from app.routers import vms
+    from app.routers.main import app
+
+    # GET /vms is not mounted in the shipped app yet, but it is what students poll
+    if not any(getattr(route, "path", None) == "/vms" for route in app.routes):
+        app.include_router(vms.router)
+
+    usernames = [f"student{i}" for i in range(args.users)]
+    with Session(get_engine()) as session:
+        for i, username in enumerate(usernames):
+            env.add_ldap_user(username, 20000 + i, args.password)
+            env.proxmox.add_vm(1000 + i, f"{username}-vm", vnc_port=1 + i)
+            session.add(
+                DBVirtualMachine(
+                    vmid=1000 + i, name=f"{username}-vm", core_count=1, memory=512,
+                    port=1 + i, owner=username, node=settings.proxmox_node_name,
+                    expiry=datetime.datetime.now(datetime.UTC) + datetime.timedelta(days=1),
+                )
+            )
+        session.commit()
+    # The API admin authenticates against LDAP like everyone else
+    env.add_ldap_user(environment.API_ADMIN_USER, 19999, args.password)
+
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning", lifespan="on")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    port = server.servers[0].sockets[0].getsockname()[1]
+
+    def stop():
+        server.should_exit = True
+        thread.join()
+        env.stop()
+
+    return f"http://127.0.0.1:{port}", usernames, environment.API_ADMIN_USER, stop
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="WebVirt login storm and polling load test")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--ramp", type=float, default=10.0)
+    parser.add_argument("--duration", type=float, default=60.0)
+    parser.add_argument("--poll-interval", type=float, default=5.0)
+    parser.add_argument("--import-rows", type=int, default=50)
+    parser.add_argument("--proxmox-latency", type=float, default=0.0)
+    parser.add_argument("--ldap-latency", type=float, default=0.0)
+    parser.add_argument("--url", help="Target a running deployment instead of an in-process app")
+    parser.add_argument("--user-prefix", default="student", help="Usernames used with --url")
+    parser.add_argument("--admin", default=None, help="API admin user used with --url")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--output", default="loadtest_results.json")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    if args.url:
+        url = args.url.rstrip("/")
+        usernames = [f"{args.user_prefix}{i}" for i in range(args.users)]
+        admin, stop = args.admin, lambda: None
+    else:
+        url, usernames, admin, stop = start_local_app(args)
+
+    recorder = Recorder()
+    now = time.monotonic()
+    threads = [
+        threading.Thread(
+            target=student,
+            args=(recorder, url, username, args.password, now + args.ramp * i / max(1, args.users), args),
+        )
+        for i, username in enumerate(usernames)
+    ]
+    if args.import_rows and admin:
+        threads.append(
+            threading.Thread(
+                target=admin_import, args=(recorder, url, admin, args.password, args.import_rows)
+            )
+        )
+    start = time.perf_counter()
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        stop()
+    wall_time = time.perf_counter() - start
+
+    report = {
+        "timestamp": datetime.datetime.now(datetime.UTC).isoformat(),
+        "parameters": {key: value for key, value in vars(args).items() if key != "password"},
+        "wall_time_seconds": wall_time,
+        "routes": recorder.report(wall_time),
+    }
+    print(f"{'route':<20}{'requests':>10}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for route, stats in report["routes"].items():
+        print(
+            f"{route:<20}{stats['requests']:>10}{stats['errors']:>8}"
+            f"{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}"
+        )
+    with open(output, "w") as outfile:
+        json.dump(report, outfile, indent=2)
+    print(f"Results written to {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+# WebVirt benchmark suite.
+# Runs the real provisioning, CSV and expiry code against an in-process fake Proxmox API,
+# a fake LDAP connection and a temporary config directory, and writes the results as JSON
+# so that runs can be compared over time.
+#
+# Usage (from the backend directory, with the backend dependencies installed):
+#   python -m bench.run [--only bulk_create,process_csv,check_expiry,allocators]
+#                       [--rows 10,50,100] [--vm-counts 100,1000,2000]
+#                       [--proxmox-latency 0.02] [--ldap-latency 0.002]
+#                       [--real-sleeps] [--output bench_results.json]
+#
+#   --rows: row counts to run bulk_create, process_csv and check_expiry with
+#   --vm-counts: number of existing VMs to measure new_free_id/new_free_port against
+#   --proxmox-latency / --ldap-latency: seconds added to every fake API call
+#   --real-sleeps: keep the fixed waits in app/utils/vms.py (skipped by default)
+#
+# Runs against SQLite in the temporary directory. Set DATABASE_URL to run against another
+# database (such as an empty PostgreSQL database) instead.
+import io
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import datetime
+import subprocess
+from bench import environment
+
+
+def timed(func, *args, **kwargs) -> tuple[float, object]:
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def csv_rows(count: int, tag: str) -> list[list[str]]:
+    return [[f"first{tag}{i}", f"last{tag}{i}"] for i in range(count)]
+
+
+def bench_bulk_create(env, rows: list[int]) -> list[dict]:
+    from app.utils.tasks import bulk_create
+
+    results = []
+    for count in rows:
+        tag = f"bc{count}"
+        users = [[first, last, f"{first}{last}", "password"] for first, last in csv_rows(count, tag)]
+        elapsed, _ = timed(bulk_create, users, 1, 512, 1, "/home", tag)
+        results.append(
+            {"rows": count, "seconds": elapsed, "vms_per_second": count / elapsed}
+        )
+    return results
+
+
+def bench_process_csv(env, rows: list[int]) -> list[dict]:
+    from sqlmodel import Session
+    from fastapi import Response, UploadFile
+    from starlette.datastructures import Headers
+    from app.models.token import TokenData
+    from app.database.main import get_engine
+    from app.routers.admin import process_csv
+
+    results = []
+    for count in rows:
+        body = "first_name,last_name\n" + "".join(
+            f"{first},{last}\n" for first, last in csv_rows(count, f"pc{count}")
+        )
+        upload = UploadFile(
+            io.BytesIO(body.encode()), headers=Headers({"content-type": "text/csv"})
+        )
+        # Called directly so the bulk_create job is queued but not run
+        with Session(get_engine()) as session:
+            elapsed, _ = timed(
+                asyncio.run,
+                process_csv(
+                    file=upload,
+                    core_count=1,
+                    memory=512,
+                    duration=1,
+                    prefix="/home",
+                    response=Response(),
+                    session=session,
+                    current_user=TokenData(username=environment.API_ADMIN_USER),
+                ),
+            )
+        results.append(
+            {"rows": count, "seconds": elapsed, "ms_per_row": elapsed / count * 1000}
+        )
+    return results
+
+
+def bench_check_expiry(env, rows: list[int]) -> list[dict]:
+    from sqlmodel import Session
+    from app.config import settings
+    from app.database.main import get_engine
+    from app.database.models import DBVirtualMachine
+    from app.utils.tasks import check_expiry
+
+    results = []
+    vmid = 500000
+    for count in rows:
+        expired = datetime.datetime.now(datetime.UTC) - datetime.timedelta(minutes=1)
+        with Session(get_engine()) as session:
+            for i in range(count):
+                vmid += 1
+                name = f"expiry{count}-{i}-vm"
+                env.proxmox.add_vm(vmid, name, running=True)
+                env.ldap.entries[f"cn={name},{settings.ldap_vm_dn}"] = {"cn": [name.encode()]}
+                session.add(
+                    DBVirtualMachine(
+                        vmid=vmid, name=name, core_count=1, memory=512, port=0,
+                        owner=f"expiry{i}", node=settings.proxmox_node_name, expiry=expired,
+                    )
+                )
+            session.commit()
+        elapsed, _ = timed(check_expiry)
+        results.append(
+            {"rows": count, "seconds": elapsed, "teardowns_per_second": count / elapsed}
+        )
+    return results
+
+
+def bench_allocators(env, vm_counts: list[int], iterations: int = 5) -> list[dict]:
+    from app.config import settings
+    from app.utils.vms import new_free_id, new_free_port
+    from bench.fake_proxmox import FakeProxmox
+
+    results = []
+    original_dir = settings.proxmox_vm_config_dir
+    for count in vm_counts:
+        config_dir = os.path.join(env.workdir, f"allocators-{count}")
+        os.makedirs(config_dir)
+        seeded = FakeProxmox(config_dir)
+        for i in range(count):
+            seeded.add_vm(100 + i, f"vm{i}", vnc_port=i)
+        settings.proxmox_vm_config_dir = config_dir
+        try:
+            id_time = sum(timed(new_free_id)[0] for _ in range(iterations)) / iterations
+            port_time = sum(timed(new_free_port)[0] for _ in range(iterations)) / iterations
+        finally:
+            settings.proxmox_vm_config_dir = original_dir
+        results.append(
+            {"vms": count, "new_free_id_ms": id_time * 1000, "new_free_port_ms": port_time * 1000}
+        )
+    return results
+
+
+BENCHMARKS = {
+    "bulk_create": lambda env, args: bench_bulk_create(env, args.rows),
+    "process_csv": lambda env, args: bench_process_csv(env, args.rows),
+    "check_expiry": lambda env, args: bench_check_expiry(env, args.rows),
+    "allocators": lambda env, args: bench_allocators(env, args.vm_counts),
+}
+
+
+def int_list(value: str) -> list[int]:
+    return [int(item) for item in value.split(",")]
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="WebVirt benchmark suite")
+    parser.add_argument("--only", default=",".join(BENCHMARKS))
+    parser.add_argument("--rows", type=int_list, default=[10, 50, 100])
+    parser.add_argument("--vm-counts", type=int_list, default=[100, 1000, 2000])
+    parser.add_argument("--proxmox-latency", type=float, default=0.0)
+    parser.add_argument("--ldap-latency", type=float, default=0.0)
+    parser.add_argument("--real-sleeps", action="store_true")
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args()
+
+    selected = args.only.split(",")
+    unknown = [name for name in selected if name not in BENCHMARKS]
+    if unknown:
+        print(f"Unknown benchmarks: {unknown}. Available: {list(BENCHMARKS)}")
+        return 1
+
+    output = os.path.abspath(args.output)
+    env = environment.setup(
+        proxmox_latency=args.proxmox_latency,
+        ldap_latency=args.ldap_latency,
+        real_sleeps=args.real_sleeps,
+    )
+    # new_free_port needs at least one exposed VM, like the management VM on a real host
+    env.proxmox.add_vm(100, "management", vnc_port=0)
+
+    report = {
+        "timestamp": datetime.datetime.now(datetime.UTC).isoformat(),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "parameters": {
+            "rows": args.rows,
+            "vm_counts": args.vm_counts,
+            "proxmox_latency": args.proxmox_latency,
+            "ldap_latency": args.ldap_latency,
+            "real_sleeps": args.real_sleeps,
+        },
+        "results": {},
+    }
+    try:
+        for name in selected:
+            print(f"Running {name}...", file=sys.stderr)
+            report["results"][name] = BENCHMARKS[name](env, args)
+            print(json.dumps(report["results"][name], indent=2), file=sys.stderr)
+    finally:
+        env.stop()
+
+    with open(output, "w") as outfile:
+        json.dump(report, outfile, indent=2)
+    print(f"Results written to {output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,27 @@
+import os
+
+# Settings without a default, so that the app can be imported without a .env
+REQUIRED_SETTINGS = {
+    "LDAP_URL": "ldap://127.0.0.1:389/",
+    "LDAP_DN": "dc=test,dc=local",
+    "LDAP_VM_DN": "ou=Groups,dc=test,dc=local",
+    "LDAP_USER_DN": "ou=People,dc=test,dc=local",
+    "LDAP_ADMIN_USER": "admin",
+    "LDAP_ADMIN_PASS": "admin",
+    "LDAP_BASE_GROUP_ID": "5000",
+    "VNC_HOSTNAME": "127.0.0.1",
+    "ALGORITHM": "HS256",
+    "SECRET_KEY": "test",
+    "API_ADMIN_USER": "webadmin",
+    "PROXMOX_HOST": "127.0.0.1",
+    "PROXMOX_BASE_URL": "https://127.0.0.1",
+    "PROXMOX_BASE_PORT": "8006",
+    "PROXMOX_NODE_NAME": "pve",
+    "PROXMOX_ACCESS_TOKEN": "PVEAPIToken=test@pve!test=secret",
+    "PROXMOX_VM_NETBRIDGE": "vmbr0",
+    "PROXMOX_VM_CONFIG_DIR": "/tmp",
+    "ALLOWED_CSV_FIELDS": '["first_name","last_name"]',
+    "TRACE_EXPORTER": "none",
+}
+for name, value in REQUIRED_SETTINGS.items():
+    os.environ.setdefault(name, value)
@@ -0,0 +1,73 @@
+import datetime
+import pytest
+from app.config import settings
+from app.database.models import DBVirtualMachine
+from app.utils import reconcile
+from app.utils.reconcile import find_drift, repair_refusal
+
+
+def row(id: int) -> DBVirtualMachine:
+    return DBVirtualMachine(
+        id=id,
+        vmid=100 + id,
+        name=f"student{id}-vm",
+        core_count=1,
+        memory=1024,
+        port=id,
+        owner=f"student{id}",
+        node=settings.proxmox_node_name,
+        expiry=datetime.datetime.now(datetime.UTC),
+    )
+
+
+def vm(id: int) -> dict:
+    return {"vmid": 100 + id, "name": f"student{id}-vm", "node": settings.proxmox_node_name}
+
+
+def entry(id: int) -> dict:
+    return {"name": f"student{id}-vm", "hostname": settings.vnc_hostname, "port": id, "owners": []}
+
+
+ROWS = [row(id) for id in range(1, 21)]
+ENTRIES = [entry(id) for id in range(1, 21)]
+
+
+@pytest.fixture
+def repairs(monkeypatch):
+    repaired = []
+    monkeypatch.setattr(reconcile, "repair_drift", lambda drift: repaired.append(drift) or {})
+    return repaired
+
+
+def snapshots(monkeypatch, vms: list[dict]):
+    monkeypatch.setattr(reconcile, "take_snapshots", lambda: (ROWS, ENTRIES, vms))
+
+
+def test_empty_listing_is_not_repaired(monkeypatch, repairs):
+    snapshots(monkeypatch, [])
+    report = reconcile.reconcile(repair=True)
+    assert len(report["drift"]["missing_vm"]) == 20
+    assert "lists no VM" in report["refused"]
+    assert repairs == []
+
+
+def test_partial_listing_is_not_repaired(monkeypatch, repairs):
+    snapshots(monkeypatch, [vm(id) for id in range(1, 11)])
+    report = reconcile.reconcile(repair=True)
+    assert len(report["drift"]["missing_vm"]) == 10
+    assert "RECONCILE_MAX_MISSING_FRACTION" in report["refused"]
+    assert repairs == []
+
+
+def test_a_few_missing_vms_are_repaired(monkeypatch, repairs):
+    snapshots(monkeypatch, [vm(id) for id in range(1, 19)])
+    report = reconcile.reconcile(repair=True)
+    assert len(report["drift"]["missing_vm"]) == 2
+    assert "refused" not in report
+    assert len(repairs) == 1
+
+
+def test_single_missing_vm_is_always_repairable():
+    rows = [row(1), row(2)]
+    drift = find_drift(rows, [entry(1), entry(2)], [vm(1)])
+    assert repair_refusal(rows, [vm(1)], drift) is None
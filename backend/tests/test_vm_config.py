@@ -0,0 +1,114 @@
+from types import SimpleNamespace
+import pytest
+from app.config import get_settings
+from app.models.vms import VirtualMachine
+from app.utils import vms
+from app.utils.vms import (
+    parse_vm_config,
+    _resize_payload,
+    expose_vnc_port,
+    vnc_port_taken,
+    vnc_ports,
+)
+
+CONFIG = """boot: order=scsi0
+cores: 2
+memory: 2048
+name: student-1
+args: -vnc 0.0.0.0:12
+parent: before-upgrade
+
+[PENDING]
+cores: 4
+memory: 4096
+
+[before-upgrade]
+cores: 1
+memory: 1024
+snaptime: 1718000000
+"""
+
+
+def specs(core_count: int, memory: int) -> VirtualMachine:
+    return VirtualMachine(core_count=core_count, memory=memory, duration=None)
+
+
+def test_sections_do_not_override_the_current_config():
+    sections = parse_vm_config(CONFIG)
+    assert sections[""]["cores"] == "2"
+    assert sections[""]["memory"] == "2048"
+    assert sections[""]["args"] == "-vnc 0.0.0.0:12"
+    assert "snaptime" not in sections[""]
+    assert sections["PENDING"] == {"cores": "4", "memory": "4096"}
+    assert sections["before-upgrade"]["cores"] == "1"
+
+
+def test_config_without_sections():
+    sections = parse_vm_config("# comment: ignored\ncores: 2\nmemory: 2048\n")
+    assert sections == {"": {"cores": "2", "memory": "2048"}}
+
+
+def test_resend_of_a_pending_change_is_sent_again():
+    sections = parse_vm_config(CONFIG)
+    payload = _resize_payload(sections[""], sections["PENDING"], specs(4, 4096), running=True)
+    assert payload == {"cores": 4, "memory": 4096}
+
+
+def test_pending_change_is_reverted_when_the_current_config_matches():
+    sections = parse_vm_config(CONFIG)
+    payload = _resize_payload(sections[""], sections["PENDING"], specs(2, 2048), running=True)
+    assert payload == {"revert": "cores,memory"}
+
+
+def test_unchanged_specs_send_nothing():
+    sections = parse_vm_config("cores: 2\nmemory: 2048\n")
+    assert _resize_payload(sections[""], {}, specs(2, 2048), running=True) == {}
+
+
+def test_pending_delete_is_reverted():
+    config = {"cores": "4", "memory": "2048", "hotplug": "cpu", "vcpus": "2"}
+    payload = _resize_payload(config, {"delete": "vcpus"}, specs(2, 2048), running=True)
+    assert payload == {"revert": "vcpus"}
+
+
+def test_stopped_vm_gets_its_memory_directly():
+    config = {"cores": "2", "memory": "4096"}
+    assert _resize_payload(config, {}, specs(2, 2048), running=False) == {"memory": 2048}
+
+
+def test_running_vm_shrinks_through_the_balloon():
+    config = {"cores": "2", "memory": "4096"}
+    payload = _resize_payload(config, {}, specs(2, 2048), running=True)
+    assert payload == {"memory": 2048, "balloon": 2048}
+
+
+def test_balloon_disabled_leaves_the_shrink_pending():
+    config = {"cores": "2", "memory": "4096", "balloon": "0"}
+    assert _resize_payload(config, {}, specs(2, 2048), running=True) == {"memory": 2048}
+
+
+def test_balloon_target_is_kept_below_the_memory():
+    config = {"cores": "2", "memory": "4096", "balloon": "3072"}
+    payload = _resize_payload(config, {}, specs(2, 2048), running=False)
+    assert payload == {"memory": 2048, "balloon": 2048}
+
+
+@pytest.fixture
+def config_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(get_settings(), "proxmox_vm_config_dir", str(tmp_path))
+    monkeypatch.setattr(vms, "time", SimpleNamespace(sleep=lambda seconds: None))
+    (tmp_path / "100.conf").write_text("name: management\nargs: -vnc 0.0.0.0:1\n")
+    return tmp_path
+
+
+def test_vnc_port_taken_by_another_vm(config_dir):
+    (config_dir / "101.conf").write_text("name: student-1\nargs: -vnc 0.0.0.0:1\n")
+    assert vnc_port_taken(101, 1)
+    assert not vnc_port_taken(101, 2)
+
+
+def test_exposing_again_replaces_the_port(config_dir):
+    (config_dir / "101.conf").write_text("name: student-1\nargs: -vnc 0.0.0.0:1\n")
+    assert expose_vnc_port(101) == 2
+    assert (config_dir / "101.conf").read_text() == "name: student-1\nargs: -vnc 0.0.0.0:2\n"
+    assert vnc_ports() == {100: 1, 101: 2}
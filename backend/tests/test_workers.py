@@ -0,0 +1,51 @@
+import datetime
+import pytest
+from sqlmodel import Session
+from app.config import settings
+from app.database.main import get_engine
+from app.database.models import init_db, DBLease
+from app.utils import workers
+from app.utils.workers import start_run, acquire_lease
+
+
+@pytest.fixture
+def database(tmp_path):
+    url = settings.database_url
+    settings.database_url = f"sqlite:///{tmp_path / 'database.db'}"
+    get_engine.cache_clear()
+    init_db()
+    yield get_engine()
+    get_engine().dispose()
+    get_engine.cache_clear()
+    settings.database_url = url
+
+
+def set_lease(name: str, **values):
+    with Session(get_engine()) as session:
+        lease = session.get(DBLease, name)
+        for key, value in values.items():
+            setattr(lease, key, value)
+        session.add(lease)
+        session.commit()
+
+
+def ago(seconds: float) -> datetime.datetime:
+    return datetime.datetime.now(datetime.UTC) - datetime.timedelta(seconds=seconds)
+
+
+def test_one_run_per_interval_across_workers(database, monkeypatch):
+    assert start_run("expiry", 60)
+    assert not start_run("expiry", 60)  # Ran less than an interval ago
+    set_lease("expiry", expires_at=ago(1))  # Run over, lease ran out
+    monkeypatch.setattr(workers, "WORKER_ID", "other-worker")
+    assert not start_run("expiry", 60)  # Still not due, even for another worker
+    set_lease("expiry", last_run_at=ago(61))
+    assert start_run("expiry", 60)
+
+
+def test_run_waits_for_the_live_holder(database, monkeypatch):
+    assert start_run("reconcile", 60)
+    set_lease("reconcile", last_run_at=ago(61))  # Due, but its holder is still running it
+    monkeypatch.setattr(workers, "WORKER_ID", "other-worker")
+    assert not start_run("reconcile", 60)
+    assert not acquire_lease("reconcile")
@@ -3,29 +3,58 @@
 # WebVirt Utility to expose Proxmox VNC outside of the host.
 # This script will add a VNC configuration to all VMs in the Proxmox host
 # that do not already have a VNC configuration.
-# The VNC port will be the default VNC port (5900) + the VM's ID.
+# The VNC port will be the default VNC port (5900) + the assigned display number.
 # This script is intended to be run on the Proxmox host itself.
 #
+# The run is split in two phases:
+#   1. Plan: every config is read (in parallel), the display numbers already
+#      used by existing `-vnc` args are collected and only free numbers,
+#      starting at --start-port, are handed out to configs without VNC.
+#      Configs that already have VNC do not consume a number.
+#   2. Apply: a rollback journal is written first, then each config is
+#      rewritten atomically (write to a temp file in the same directory,
+#      fsync, rename over the original).
+#
 # Usage:
-#   python3 bulk_expose.py --start-port <port_number> [--dry-run]
+#   python3 bulk_expose.py --start-port <port_number> [--dry-run] [--json]
+#                          [--ignore <config>]... [--journal <path>]
+#                          [--workers <n>]
+#   python3 bulk_expose.py --rollback <journal>
 #
-#   --start-port: The port number to start the VNC port mapping from.
-#   --dry-run: Do not make any changes, just print the port mappings.
+#   --start-port: The lowest display number to hand out.
+#   --dry-run: Do not make any changes, just print the plan.
+#   --json: Print the plan (and the result) as JSON instead of a table.
+#   --ignore: Config file to leave untouched. May be repeated.
+#             Defaults to the IGNORED_CONFIGS environment variable
+#             (comma separated), or 100.conf,800.conf,900.conf.
+#   --journal: Where to write the rollback journal.
+#              Defaults to ./bulk_expose-<timestamp>.journal.json
+#   --workers: Number of threads used to read config files.
+#   --rollback: Restore every config recorded in the given journal.
 #
 # Example:
 #   To start exposing VNC from port 5900:
-#   python3 bulk_expose.py --start-port 5900
+#   python3 bulk_expose.py --start-port 0
 #
 #   To see the port mappings without making any changes:
-#   python3 bulk_expose.py --start-port 5900 --dry-run
-# 
+#   python3 bulk_expose.py --start-port 0 --dry-run
+#
+#   To undo a run:
+#   python3 bulk_expose.py --rollback bulk_expose-20240101-120000.journal.json
+#
 # The script accepts CONFIG_DIR environment variable to specify the path to the
 # directory containing the Proxmox VM configuration files. If not specified, it
 # defaults to the current directory.
 
+import argparse
+import hashlib
+import json
 import os
+import re
 import sys
-from typing import TextIO
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
 
 # Default values
 
@@ -33,41 +62,250 @@ from typing import TextIO
 CONFIG_DIR_PATH = os.environ.get("CONFIG_DIR", ".")
 
 # Blacklisted config files that we don't want to touch.
-IGNORED_CONFIGS = ["100.conf","800.conf","900.conf"]
+IGNORED_CONFIGS = [
+    config.strip()
+    for config in os.environ.get(
+        "IGNORED_CONFIGS", "100.conf,800.conf,900.conf"
+    ).split(",")
+    if config.strip()
+]
+
+# Highest display number QEMU accepts for -vnc (5900 + 59635 = 65535)
+MAX_DISPLAY = 65535 - 5900
+
+VNC_ARG_PATTERN = re.compile(r"-vnc\s+\S*?:(\d+)")
+
+
+@dataclass
+class ConfigState:
+    config: str
+    sha256: str
+    has_vnc: bool
+    ports: list[int]
+
+
+@dataclass
+class PlanEntry:
+    config: str
+    action: str  # "expose" or "skip"
+    port: int | None
+    reason: str = ""
+
+
+def sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def read_config(config_dir: str, config: str) -> ConfigState:
+    with open(os.path.join(config_dir, config), "rb") as cfile:
+        data = cfile.read()
+    text = data.decode("utf-8", errors="replace")
+    return ConfigState(
+        config=config,
+        sha256=sha256(data),
+        has_vnc="vnc" in text,
+        ports=[int(port) for port in VNC_ARG_PATTERN.findall(text)],
+    )
 
 
-def write_config(filehandle: TextIO, port: int) -> bool:
-    vnc_config = f"args: -vnc 0.0.0.0:{port}\n"
-    filehandle.write(vnc_config)
-    return True
+def scan_configs(
+    config_dir: str, ignored: list[str], workers: int
+) -> tuple[list[ConfigState], set[int]]:
+    """
+    Reads every proxmox config in parallel.
+    Returns the states of the configs we are allowed to touch, and the set of
+    display numbers used by *all* configs, including the ignored ones.
+    """
+    configs = sorted(
+        config for config in os.listdir(config_dir) if config.endswith(".conf")
+    )
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        states = list(pool.map(lambda config: read_config(config_dir, config), configs))
+
+    used_ports = {port for state in states for port in state.ports}
+    return [state for state in states if state.config not in ignored], used_ports
+
+
+def build_plan(
+    states: list[ConfigState], used_ports: set[int], start_port: int
+) -> list[PlanEntry]:
+    """
+    Hands out the lowest free display numbers >= start_port, in config order.
+    Configs that already have VNC are skipped and do not use up a number.
+    """
+    plan = []
+    port = start_port
+    for state in states:
+        if state.has_vnc:
+            plan.append(PlanEntry(state.config, "skip", None, "Mapping exists"))
+            continue
+        while port in used_ports:
+            port += 1
+        if port > MAX_DISPLAY:
+            plan.append(PlanEntry(state.config, "skip", None, "No free port left"))
+            continue
+        used_ports.add(port)
+        plan.append(PlanEntry(state.config, "expose", port))
+        port += 1
+    return plan
+
+
+def atomic_write(path: str, data: bytes):
+    # Temp file must stay in the same directory (and filesystem) for rename to be atomic,
+    # and must not end in .conf so proxmox does not pick it up.
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, "wb") as tmp:
+        tmp.write(data)
+        tmp.flush()
+        os.fsync(tmp.fileno())
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        os.unlink(tmp_path)
+        raise
+
+
+def exposed_config(original: bytes, port: int) -> bytes:
+    if original and not original.endswith(b"\n"):
+        original += b"\n"
+    return original + f"args: -vnc 0.0.0.0:{port}\n".encode()
+
 
-def print_help():
-    print(
-        f"{sys.argv[0]}: Expose Proxmox VNC output in bulk\n"
-        f"Usage: {sys.argv[0]} --start-port <port_number> [--dry-run]"
+def write_journal(path: str, config_dir: str, entries: list[dict]):
+    atomic_write(
+        path,
+        json.dumps(
+            {
+                "config_dir": os.path.abspath(config_dir),
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "entries": entries,
+            },
+            indent=2,
+        ).encode(),
     )
 
+
+def apply_plan(
+    config_dir: str,
+    plan: list[PlanEntry],
+    states: dict[str, ConfigState],
+    journal_path: str,
+) -> list[dict]:
+    """
+    Writes the rollback journal first, then rewrites each config atomically.
+    A config that changed since it was scanned is left alone.
+    """
+    journal = []
+    pending = []
+    for entry in plan:
+        if entry.action != "expose":
+            continue
+        path = os.path.join(config_dir, entry.config)
+        with open(path, "rb") as cfile:
+            original = cfile.read()
+        if sha256(original) != states[entry.config].sha256:
+            entry.action, entry.reason = "skip", "Changed since scan"
+            continue
+        updated = exposed_config(original, entry.port)
+        journal.append(
+            {
+                "config": entry.config,
+                "port": entry.port,
+                "original": original.decode("utf-8", errors="surrogateescape"),
+                "written_sha256": sha256(updated),
+            }
+        )
+        pending.append((entry, path, updated))
+
+    write_journal(journal_path, config_dir, journal)
+
+    results = []
+    for entry, path, updated in pending:
+        try:
+            atomic_write(path, updated)
+            results.append({"config": entry.config, "port": entry.port, "status": "ok"})
+        except OSError as e:
+            results.append(
+                {"config": entry.config, "port": entry.port, "status": f"failed: {e}"}
+            )
+    return results
+
+
+def rollback(journal_path: str) -> int:
+    try:
+        with open(journal_path, "r") as jfile:
+            journal = json.load(jfile)
+    except (OSError, ValueError) as e:
+        print(f"Cannot read journal: {e}")
+        return 1
+
+    failed = False
+    for entry in journal["entries"]:
+        path = os.path.join(journal["config_dir"], entry["config"])
+        try:
+            with open(path, "rb") as cfile:
+                current = cfile.read()
+        except OSError:
+            print(f"{entry['config']}\t\tMissing, not restored")
+            failed = True
+            continue
+        if sha256(current) != entry["written_sha256"]:
+            # Someone (proxmox or the admin) changed the file after us, don't clobber it.
+            print(f"{entry['config']}\t\tModified after expose, not restored")
+            failed = True
+            continue
+        atomic_write(path, entry["original"].encode("utf-8", errors="surrogateescape"))
+        print(f"{entry['config']}\t\tRestored")
+    return 1 if failed else 0
+
+
+def print_plan(plan: list[PlanEntry], dry_run: bool):
+    print("Config File\t\tPort Mapping")
+    for entry in plan:
+        if entry.action == "skip":
+            print(f"{entry.config}\t\t{entry.reason}")
+        else:
+            print(f"{entry.config}\t\t5900 + {entry.port}{' [Dry Run]' if dry_run else ''}")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog=sys.argv[0], description="Expose Proxmox VNC output in bulk"
+    )
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument("--start-port", type=int, help="Lowest display number to hand out")
+    action.add_argument("--rollback", metavar="JOURNAL", help="Undo a previous run")
+    parser.add_argument("--dry-run", action="store_true", help="Only print the plan")
+    parser.add_argument("--json", action="store_true", help="Machine-readable output")
+    parser.add_argument(
+        "--ignore", action="append", metavar="CONFIG", help="Config file to leave untouched"
+    )
+    parser.add_argument("--journal", help="Path of the rollback journal")
+    parser.add_argument(
+        "--workers", type=int, default=min(32, (os.cpu_count() or 1) * 4)
+    )
+    return parser.parse_args()
+
+
 def main() -> int:
     if os.geteuid() != 0:
         print("Not root, Exiting...")
         # return 1
 
-    if "--help" in sys.argv:
-        print_help()
-        return 0
+    args = parse_args()
+    if args.rollback:
+        return rollback(args.rollback)
 
-    # print help message for improper cmdline args
-    if len(sys.argv) < 3:
-        print_help()
-        return 1
-    try:
-        START_PORT = int(sys.argv[2])
-    except ValueError:
+    if not 0 <= args.start_port <= MAX_DISPLAY:
         print("Invalid port number")
         return 1
 
+    ignored = args.ignore if args.ignore is not None else IGNORED_CONFIGS
     try:
-        configs = os.listdir(CONFIG_DIR_PATH)
+        # Get rid of any pre-defined config files that we don't want to touch,
+        # as well as any non proxmox config files/dirs.
+        # This includes our management VM's config.
+        states, used_ports = scan_configs(CONFIG_DIR_PATH, ignored, args.workers)
     except OSError:
         print(
             "Cannot find proxmox config directory. "
@@ -75,28 +313,39 @@ def main() -> int:
         )
         return 1
 
-    # Get rid of any pre-defined config files that we don't want to touch,
-    # as well as any non proxmox config files/dirs.
-    # This includes our management VM's config.
-    configs = [
-        config
-        for config in configs
-        if config not in IGNORED_CONFIGS and config.endswith("conf")
-    ]
-    configs.sort()
-    print("Config File\t\tPort Mapping")
-    for port_num, config in enumerate(configs, start=START_PORT):
-        with open(os.path.join(CONFIG_DIR_PATH, config), "r+") as cfile:
-            if "vnc" in cfile.read():
-                print(f"{config}\t\tMapping exists")
-                continue  # skip configs with existing vnc configuration setup.
-            if sys.argv[-1] == "--dry-run":
-                print(f"{config}\t\t5900 + {port_num} [Dry Run]")
-                continue
-            print(f"{config}\t\t5900 + {port_num}")
-            if not write_config(filehandle=cfile, port=port_num):
-                print("Partial/broken setup. Please revert manually")
-                return 1
+    plan = build_plan(states, used_ports, args.start_port)
+    if args.dry_run:
+        if args.json:
+            print(json.dumps({"plan": [asdict(entry) for entry in plan]}, indent=2))
+        else:
+            print_plan(plan, dry_run=True)
+        return 0
+
+    journal_path = args.journal or time.strftime("bulk_expose-%Y%m%d-%H%M%S.journal.json")
+    results = apply_plan(
+        CONFIG_DIR_PATH, plan, {state.config: state for state in states}, journal_path
+    )
+    failed = [result for result in results if result["status"] != "ok"]
+
+    if args.json:
+        print(
+            json.dumps(
+                {
+                    "plan": [asdict(entry) for entry in plan],
+                    "results": results,
+                    "journal": journal_path,
+                },
+                indent=2,
+            )
+        )
+    else:
+        print_plan(plan, dry_run=False)
+        for result in failed:
+            print(f"{result['config']}\t\t{result['status']}")
+        print(f"Rollback journal written to {journal_path}")
+    if failed:
+        print("Partial setup. Revert with --rollback", file=sys.stderr)
+        return 1
     return 0
 
 